@@ -0,0 +1,137 @@
+from collections import deque
+import threading
+import logging
+import time
+
+import video_utilities
+
+logger = logging.getLogger(__name__)
+# seconds the failures of a dataset and creator are collected before the digest is sent
+ALERT_WINDOW = 300
+# failures listed in a digest, the rest are counted only
+MAX_DIGEST_ITEMS = 50
+# open windows, the oldest is sent early when a new dataset / creator fails
+MAX_GROUPS = 100
+# characters of a failure message kept in the digest
+MAX_MESSAGE_LENGTH = 500
+
+
+class AlertGroup:
+    """
+    the failures of one dataset and creator in the current window
+    """
+
+    def __init__(self, project_id, dataset_id, creator):
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.creator = creator
+        self.opened = time.monotonic()
+        self.failures = deque(maxlen=MAX_DIGEST_ITEMS)
+        self.nb_failures = 0
+        self.nb_events = 0
+        self.timer = None
+
+
+class AlertAggregator:
+    """
+    buffer the conversion failures per dataset and creator over a time window and send a single digest mail and
+    notification per window, a failure storm costs a few api calls instead of a mail and a notification per item
+    """
+
+    def __init__(self, mail_handler, window=ALERT_WINDOW):
+        """
+        :param MailHandler mail_handler: sends the digest mails
+        :param float window: seconds of a window, 0 sends every failure right away
+        """
+        self.mail_handler = mail_handler
+        self.window = window
+        self._groups = dict()
+        self._lock = threading.Lock()
+
+    def add_failure(self, item, msg, execution_id=None):
+        """
+        a failed conversion - mailed to the item creator and notified in the digest of its window
+
+        :param dl.Item item: the failed item
+        :param str msg: the failure message
+        :param str execution_id: the execution that failed
+        """
+        with self._lock:
+            group = self._group(item=item)
+            group.nb_failures += 1
+            group.failures.append({'item_id': item.id,
+                                   'name': item.name,
+                                   'url': item.platform_url,
+                                   'execution_id': execution_id or '',
+                                   'msg': str(msg)[-MAX_MESSAGE_LENGTH:]})
+        self._send_if_due(group=group)
+
+    def add_event(self, item):
+        """
+        a webm that failed the verification - notified in the digest of its window
+        """
+        with self._lock:
+            group = self._group(item=item)
+            group.nb_events += 1
+        self._send_if_due(group=group)
+
+    def flush(self):
+        """
+        send the digests of all the open windows
+        """
+        with self._lock:
+            groups = list(self._groups.values())
+            self._groups.clear()
+        for group in groups:
+            self._send(group=group)
+
+    def _group(self, item):
+        key = (item.datasetId, item.creator)
+        group = self._groups.get(key, None)
+        if group is None:
+            if len(self._groups) >= MAX_GROUPS:
+                # bounded memory, the oldest window is closed early
+                oldest_key = min(self._groups, key=lambda k: self._groups[k].opened)
+                threading.Thread(target=self._send, args=(self._groups.pop(oldest_key),), daemon=True).start()
+            group = AlertGroup(project_id=item.project_id, dataset_id=item.datasetId, creator=item.creator)
+            self._groups[key] = group
+            if self.window:
+                group.timer = threading.Timer(self.window, self._close, args=(key, group))
+                group.timer.daemon = True
+                group.timer.start()
+        return group
+
+    def _send_if_due(self, group):
+        if not self.window:
+            with self._lock:
+                self._groups.pop((group.dataset_id, group.creator), None)
+            self._send(group=group)
+
+    def _close(self, key, group):
+        with self._lock:
+            if self._groups.get(key, None) is not group:
+                # already sent
+                return
+            self._groups.pop(key)
+        self._send(group=group)
+
+    def _send(self, group):
+        if group.timer is not None:
+            group.timer.cancel()
+        if group.nb_failures == 0 and group.nb_events == 0:
+            return
+        logger.info('sending alert digest of dataset {}: {} failed, {} failed verification'.format(group.dataset_id,
+                                                                                                   group.nb_failures,
+                                                                                                   group.nb_events))
+        if group.nb_failures > 0:
+            self.mail_handler.send_digest(email=group.creator,
+                                          project_id=group.project_id,
+                                          dataset_id=group.dataset_id,
+                                          failures=list(group.failures),
+                                          nb_failures=group.nb_failures)
+        try:
+            video_utilities.send_error_digest_event(project_id=group.project_id,
+                                                    dataset_id=group.dataset_id,
+                                                    nb_items=group.nb_failures + group.nb_events)
+        except Exception:
+            logger.exception('Failed to send the error notification of dataset {}'.format(group.dataset_id))
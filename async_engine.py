@@ -0,0 +1,251 @@
+"""
+Asyncio execution engine
+
+One event loop drives the ffmpeg / ffprobe subprocesses of many items: execute_cmd_async reads stdout, stderr and
+the ffmpeg progress pipe with asyncio streams instead of a selector per thread. The stages of an item keep running in
+a pipeline thread, their execute_cmd calls are sent to the loop, and the platform calls made from async code go to a
+bounded executor. Cancelling the task of an item kills its running command and stops its pipeline at the next one.
+The loop reaps the processes itself, the resource usage of a command is sampled from /proc while it runs.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+import threading
+import functools
+import asyncio
+import logging
+import time
+import os
+
+import instrumentation
+import video_utilities
+
+logger = logging.getLogger(__name__)
+# platform calls made from async code at the same time
+SDK_WORKERS = 8
+
+
+async def execute_cmd_async(cmd,
+                            progress=None,
+                            nb_frames=None,
+                            on_progress=None,
+                            stdin=None,
+                            timeout=None,
+                            stall_timeout=None):
+    """
+    execute_cmd on the running event loop, the process is killed when the task is cancelled
+
+    :param list cmd: list of the bash command
+    :param progress: dl.Progress like object, to follow the work progress
+    :param int nb_frames: number of frames
+    :param on_progress: callable getting the ffmpeg progress reports, see execute_cmd
+    :param stdin: file object / fd for the command stdin
+    :param float timeout: wall clock budget in seconds, None for no limit
+    :param float stall_timeout: seconds without progress before the command is killed, None for no limit
+
+    :return: the command output
+    """
+    # the task runs in a copy of the context of the pipeline thread, the usage goes to the stage that sent the command
+    usage = {'cpu_time': 0, 'peak_rss_mb': 0}
+
+    def sample_usage():
+        sample = video_utilities.process_usage(pid=proc.pid)
+        if sample is not None:
+            usage['cpu_time'] = max(usage['cpu_time'], sample[0])
+            usage['peak_rss_mb'] = max(usage['peak_rss_mb'], sample[1])
+
+    progress_parser = None
+    progress_read = None
+    pass_fds = ()
+    if os.path.basename(cmd[0]) == 'ffmpeg':
+        progress_parser = video_utilities.FfmpegProgress(progress=progress, nb_frames=nb_frames,
+                                                         on_progress=on_progress)
+        progress_read, progress_write = os.pipe()
+        cmd = video_utilities.progress_cmd(cmd=cmd, progress_fd=progress_write)
+        pass_fds = (progress_write,)
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd,
+                                                    stdin=stdin,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE,
+                                                    pass_fds=pass_fds)
+    except BaseException:
+        if progress_read is not None:
+            os.close(progress_read)
+        raise
+    finally:
+        if progress_read is not None:
+            # the child has its own copy, closing ours gives EOF when the child exits
+            os.close(progress_write)
+
+    stdout_chunks = list()
+    stderr_tail = video_utilities.OutputTail()
+    reads = {'last_at': time.monotonic()}
+
+    async def pump(reader, consume):
+        while True:
+            data = await reader.read(video_utilities.READ_SIZE)
+            if not data:
+                return
+            reads['last_at'] = time.monotonic()
+            consume(data)
+
+    tasks = [asyncio.ensure_future(pump(proc.stdout, stdout_chunks.append)),
+             asyncio.ensure_future(pump(proc.stderr, stderr_tail.feed))]
+    progress_transport = None
+    try:
+        if progress_read is not None:
+            progress_reader = asyncio.StreamReader()
+            pipe = os.fdopen(progress_read, 'rb', 0)
+            progress_read = None
+            try:
+                progress_transport, _ = await asyncio.get_running_loop().connect_read_pipe(
+                    lambda: asyncio.StreamReaderProtocol(progress_reader), pipe)
+            except BaseException:
+                pipe.close()
+                raise
+            tasks.append(asyncio.ensure_future(pump(progress_reader, progress_parser.feed)))
+        started_at = time.monotonic()
+        while True:
+            done, pending = await asyncio.wait(tasks, timeout=video_utilities.WATCHDOG_INTERVAL)
+            sample_usage()
+            for task in done:
+                task.result()
+            if not pending:
+                break
+            now = time.monotonic()
+            if timeout and now - started_at > timeout:
+                raise video_utilities.CommandTimeoutError('{} exceeded its time budget of {}[s]\nstderr:{}'.format(
+                    cmd[0], timeout, stderr_tail.text()))
+            advanced_at = progress_parser.advanced_at if progress_parser is not None else reads['last_at']
+            if stall_timeout and now - advanced_at > stall_timeout:
+                raise video_utilities.CommandStalledError('{} stalled, no progress for {}[s]\nstderr:{}'.format(
+                    cmd[0], stall_timeout, stderr_tail.text()))
+        await proc.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        instrumentation.record_command_usage(cpu_time=usage['cpu_time'], peak_rss_mb=usage['peak_rss_mb'])
+        if progress_transport is not None:
+            progress_transport.close()
+        if progress_read is not None:
+            os.close(progress_read)
+
+    if proc.returncode != 0:
+        raise Exception('stderr:{}'.format(stderr_tail.text()))
+    logger.debug(b''.join(stdout_chunks))
+    return b''.join(stdout_chunks)
+
+
+class Cancellation:
+    """
+    the commands of a pipeline running on the loop, cancel() kills them and fails the next ones
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def add(self, future):
+        with self._lock:
+            if self.cancelled:
+                future.cancel()
+            self._futures.add(future)
+
+    def discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+
+class OffloadedProgress:
+    """
+    dl.Progress updates of a command on the loop, sent from the sdk executor so the loop never waits on the platform
+    """
+
+    def __init__(self, progress, loop, executor):
+        self.progress = progress
+        self.loop = loop
+        self.executor = executor
+
+    def update(self, **kwargs):
+        self.loop.run_in_executor(self.executor, functools.partial(self.progress.update, **kwargs))
+
+
+class AsyncEngine:
+    """
+    runs the conversion pipelines of many items from one event loop
+    """
+
+    def __init__(self, sdk_workers=SDK_WORKERS, pipeline_workers=None):
+        """
+        :param int sdk_workers: platform calls made from async code at the same time
+        :param int pipeline_workers: items whose stages run at the same time, the others wait in the queue
+        """
+        self.sdk_executor = ThreadPoolExecutor(max_workers=sdk_workers, thread_name_prefix='sdk')
+        self.pipeline_executor = ThreadPoolExecutor(max_workers=pipeline_workers, thread_name_prefix='pipeline')
+
+    async def sdk(self, fn, *args, **kwargs):
+        """
+        a blocking platform call, in the sdk executor
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.sdk_executor, functools.partial(fn, *args, **kwargs))
+
+    async def run_pipeline(self, fn, *args, **kwargs):
+        """
+        run the blocking stages of an item in a pipeline thread, its commands run on the loop
+        cancelling the task kills the running command, the pipeline fails with CommandCancelledError at the next one
+
+        :return: the return value of fn
+        """
+        loop = asyncio.get_running_loop()
+        cancellation = Cancellation()
+        runner = functools.partial(self._run_on_loop, loop, cancellation)
+
+        def target():
+            with video_utilities.command_runner(runner=runner):
+                return fn(*args, **kwargs)
+
+        concurrent_future = self.pipeline_executor.submit(target)
+        future = asyncio.wrap_future(concurrent_future)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not concurrent_future.cancel():
+                cancellation.cancel()
+                # the resources of the pipeline are released by its thread, wait until it is out
+                await asyncio.wait([future])
+                if not future.cancelled() and future.exception() is not None:
+                    logger.info('cancelled pipeline stopped: {}'.format(future.exception()))
+            raise
+
+    def _run_on_loop(self, loop, cancellation, cmd, progress=None, **kwargs):
+        """
+        execute_cmd of a pipeline thread, waits for execute_cmd_async on the loop
+        """
+        if cancellation.cancelled:
+            raise video_utilities.CommandCancelledError('{} not started, the execution was cancelled'.format(cmd[0]))
+        if progress is not None:
+            progress = OffloadedProgress(progress=progress, loop=loop, executor=self.sdk_executor)
+        future = asyncio.run_coroutine_threadsafe(execute_cmd_async(cmd=cmd, progress=progress, **kwargs), loop)
+        cancellation.add(future)
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            raise video_utilities.CommandCancelledError('{} killed, the execution was cancelled'.format(cmd[0]))
+        finally:
+            cancellation.discard(future)
+
+    def close(self):
+        self.sdk_executor.shutdown(wait=True)
+        self.pipeline_executor.shutdown(wait=True)
@@ -0,0 +1,270 @@
+"""
+Offline encoder benchmark
+
+Generates deterministic test clips with ffmpeg lavfi sources, runs every conversion method over them and
+reports wall time, frames/s, peak RSS, output size and verification result as JSON.
+Runs without the platform, compare the output of two commits to see if a change made things faster or slower.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --methods ffmpeg --profiles realtime balanced --resolutions 1280x720 --durations 10
+    python benchmark.py --reference /data/clips --output bench.json
+"""
+import multiprocessing
+import subprocess
+import itertools
+import resource
+import argparse
+import datetime
+import platform
+import logging
+import shutil
+import types
+import json
+import time
+import glob
+import os
+
+from webm_converter import WebmConverter, ConversionMethod, VerificationLevel, ENCODER_PROFILES
+import video_utilities
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESOLUTIONS = ['640x360', '1280x720', '1920x1080']
+DEFAULT_FPS = ['25', '30000/1001']
+DEFAULT_DURATIONS = [5, 20]
+DEFAULT_CLIPS_DIR = '.bench_clips'
+
+
+def generate_clip(clips_dir, width, height, fps, duration, audio):
+    """
+    generate a deterministic h264 clip from the lavfi test sources, existing clips are reused
+
+    :param str clips_dir: dir for the generated clips
+    :param int width: frame width
+    :param int height: frame height
+    :param str fps: frame rate, can be a fraction e.g 30000/1001
+    :param int duration: clip length in seconds
+    :param bool audio: add a sine audio track
+
+    :return: the clip file path
+    """
+    name = 'testsrc_{}x{}_{}fps_{}s_{}.mp4'.format(width, height, fps.replace('/', '-'), duration,
+                                                   'audio' if audio else 'noaudio')
+    clip_filepath = os.path.join(clips_dir, name)
+    if os.path.isfile(clip_filepath):
+        return clip_filepath
+    cmd = ['ffmpeg',
+           '-f', 'lavfi',
+           '-i', 'testsrc2=size={}x{}:rate={}:duration={}'.format(width, height, fps, duration)]
+    if audio:
+        cmd += ['-f', 'lavfi',
+                '-i', 'sine=frequency=440:sample_rate=48000:duration={}'.format(duration),
+                '-c:a', 'aac',
+                '-b:a', '128k']
+    cmd += ['-c:v', 'libx264',
+            '-preset', 'veryfast',
+            '-pix_fmt', 'yuv420p',
+            # single thread and bitexact flags keep the clip identical between runs and machines
+            '-threads', '1',
+            '-fflags', '+bitexact',
+            '-flags', '+bitexact',
+            '-map_metadata', '-1',
+            '-hide_banner',
+            '-y',
+            clip_filepath]
+    video_utilities.execute_cmd(cmd=cmd)
+    return clip_filepath
+
+
+def _local_item(clip_filepath):
+    """
+    minimal stand in for the dl.Item fields the converter methods use
+    """
+    name = os.path.basename(clip_filepath)
+    return types.SimpleNamespace(id=os.path.splitext(name)[0],
+                                 name=name,
+                                 metadata={'system': {}},
+                                 update=lambda *args, **kwargs: None)
+
+
+def _run_case(case, clip_filepath, workdir, queue):
+    """
+    convert and verify one clip, runs in a child process so the peak RSS belongs to this case only
+    """
+    result = dict(case)
+    try:
+        converter = WebmConverter(method=case['method'],
+                                  encoder_profile=case['profile'],
+                                  segment_duration=case['segment_duration'],
+                                  verification=case['verification'])
+        item = _local_item(clip_filepath)
+        orig_metadata = video_utilities.metadata_extractor_from_ffmpeg(stream=clip_filepath,
+                                                                       with_headers=False,
+                                                                       count_frames=True)
+        nb_frames = video_utilities.frame_count(metadata=orig_metadata)
+        webm_filepath = os.path.join(workdir, '{}.webm'.format(item.id))
+
+        tic = time.time()
+        if case['method'] == ConversionMethod.OPENCV:
+            shutil.copy(clip_filepath, os.path.join(workdir, item.name))
+            converter.convert_to_webm_opencv(item=item,
+                                             dir_path=workdir,
+                                             nb_streams=orig_metadata.get('nb_streams', 1))
+        elif case['segment_duration']:
+            converter.convert_to_webm_ffmpeg_segmented(input_filepath=clip_filepath,
+                                                       output_filepath=webm_filepath,
+                                                       fps=orig_metadata['fps'],
+                                                       workdir=workdir,
+                                                       nb_frames=nb_frames)
+        else:
+            converter.convert_to_webm_ffmpeg(input_filepath=clip_filepath,
+                                             output_filepath=webm_filepath,
+                                             fps=orig_metadata['fps'],
+                                             nb_frames=nb_frames)
+        wall_time = time.time() - tic
+        # ru_maxrss is in KB on linux, children covers the encoder processes
+        peak_rss_kb = max(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+        same, summary = converter.verify_webm_conversion(webm_filepath=webm_filepath,
+                                                         orig_metadata=orig_metadata,
+                                                         item=item,
+                                                         orig_filepath=clip_filepath)
+        validate, _, _ = video_utilities.validate_video(fps=summary['webm_fps'],
+                                                        duration=summary['webm_duration'],
+                                                        r_frames=summary['webm_nb_read_frames'],
+                                                        default_start_time=summary['webm_start_time'],
+                                                        prefix_check='web')
+        result.update({
+            'wall_time': round(wall_time, 3),
+            'frames': nb_frames,
+            'fps': round(nb_frames / wall_time, 2) if nb_frames and wall_time > 0 else None,
+            'peak_rss_mb': round(peak_rss_kb / 1024, 1),
+            'input_size': os.path.getsize(clip_filepath),
+            # the cost model inputs, see cost_model.records_from_benchmark
+            'width': orig_metadata.get('width', None),
+            'height': orig_metadata.get('height', None),
+            'codec': orig_metadata['ffmpeg'].get('codec_name', None),
+            'threads': video_utilities.available_cpus(),
+            'output_size': os.path.getsize(webm_filepath),
+            'verified': bool(same and validate),
+            'summary': summary,
+            'error': None
+        })
+    except Exception as e:
+        result.update({'verified': False, 'error': str(e)[-2000:]})
+    queue.put(result)
+
+
+def run_case(case, clip_filepath, workdir):
+    """
+    run a benchmark case in a forked child process
+
+    :param dict case: method, profile and segment_duration of the run
+    :param str clip_filepath: the input clip
+    :param str workdir: scratch dir of the case, removed after the run
+
+    :return: dict of the case results
+    """
+    os.makedirs(workdir, exist_ok=True)
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_case, args=(case, clip_filepath, workdir, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def environment_info():
+    """
+    describe the machine and the code the benchmark ran on
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        ffmpeg_version = video_utilities.execute_cmd(cmd=['ffmpeg', '-version']).decode().splitlines()[0]
+    except Exception:
+        ffmpeg_version = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': video_utilities.available_cpus(),
+        'ffmpeg': ffmpeg_version
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline webm encoder benchmark')
+    parser.add_argument('--methods', nargs='+', default=[ConversionMethod.FFMPEG, ConversionMethod.OPENCV])
+    parser.add_argument('--profiles', nargs='+', default=[''] + list(ENCODER_PROFILES),
+                        help='encoder profiles of the ffmpeg method, empty string for the ffmpeg defaults')
+    parser.add_argument('--segment-durations', nargs='+', type=int, default=[0],
+                        help='segmented encoding of the ffmpeg method, 0 for a single process')
+    parser.add_argument('--verification', choices=[VerificationLevel.FAST, VerificationLevel.STRICT, VerificationLevel.PACKETS],
+                        default=VerificationLevel.STRICT)
+    parser.add_argument('--resolutions', nargs='+', default=DEFAULT_RESOLUTIONS)
+    parser.add_argument('--fps', nargs='+', default=DEFAULT_FPS)
+    parser.add_argument('--durations', nargs='+', type=int, default=DEFAULT_DURATIONS)
+    parser.add_argument('--audio', nargs='+', choices=['yes', 'no'], default=['no', 'yes'])
+    parser.add_argument('--reference', help='dir of reference videos to benchmark in addition to the generated clips')
+    parser.add_argument('--clips-dir', default=DEFAULT_CLIPS_DIR)
+    parser.add_argument('--workdir', default='.bench_work')
+    parser.add_argument('--output', help='json output path, stdout when missing')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    os.makedirs(args.clips_dir, exist_ok=True)
+    clips = list()
+    for resolution, fps, duration, audio in itertools.product(args.resolutions, args.fps, args.durations, args.audio):
+        width, height = [int(v) for v in resolution.split('x')]
+        logger.info('generating clip {} {}fps {}s audio={}'.format(resolution, fps, duration, audio))
+        clips.append(generate_clip(clips_dir=args.clips_dir,
+                                   width=width,
+                                   height=height,
+                                   fps=fps,
+                                   duration=duration,
+                                   audio=audio == 'yes'))
+    if args.reference:
+        clips += sorted(path for path in glob.glob(os.path.join(args.reference, '*')) if os.path.isfile(path))
+
+    cases = list()
+    for method in args.methods:
+        if method == ConversionMethod.OPENCV:
+            cases.append({'method': method,
+                          'profile': None,
+                          'segment_duration': 0,
+                          'verification': args.verification})
+            continue
+        for profile, segment_duration in itertools.product(args.profiles, args.segment_durations):
+            cases.append({'method': method,
+                          'profile': profile or None,
+                          'segment_duration': segment_duration,
+                          'verification': args.verification})
+
+    results = list()
+    for clip_filepath, case in itertools.product(clips, cases):
+        logger.info('running {} on {}'.format(case, os.path.basename(clip_filepath)))
+        result = run_case(case=case,
+                          clip_filepath=clip_filepath,
+                          workdir=os.path.join(args.workdir, 'case'))
+        result['clip'] = os.path.basename(clip_filepath)
+        results.append(result)
+
+    report = {'environment': environment_info(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import dtlpy as dl
+import threading
+import hashlib
+import logging
+import shutil
+import glob
+import os
+
+logger = logging.getLogger(__name__)
+READ_SIZE = 1024 * 1024
+# metadata field of the webm items that holds the cache key of their source
+CACHE_KEY_FIELD = 'webmConverter.cacheKey'
+# metadata field of the webm items that holds the id of their seek index sidecar
+SEEK_INDEX_FIELD = 'webmConverter.seekIndexItemId'
+
+
+def file_md5(filepath):
+    """
+    md5 of a local file, read in chunks
+    """
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def cache_key(content_hash, method, encoder_profile=None, keyframe_interval=None, seek_index=False):
+    """
+    key of a conversion - the same source converted with the same settings gives the same webm
+    the seekability settings are in the key only when set, the keys of the default settings are unchanged
+
+    :param str content_hash: hash of the source content
+    :param str method: conversion method
+    :param str encoder_profile: encoder profile, None for the ffmpeg defaults
+    :param float keyframe_interval: max seconds between keyframes, 0/None for the encoder default
+    :param bool seek_index: the cues are written at the start of the file
+    """
+    key = '{}-{}-{}'.format(content_hash, method, encoder_profile or 'default')
+    if keyframe_interval:
+        key += '-g{}'.format(keyframe_interval)
+    if keyframe_interval or seek_index:
+        key += '-cues'
+    return key
+
+
+def cache_key_metadata(key, seek_index_item_id=None):
+    """
+    item metadata marking a webm item as the conversion of key
+
+    :param str key: the cache key
+    :param str seek_index_item_id: id of the seek index sidecar of the webm, None when it has none
+    """
+    group, field = CACHE_KEY_FIELD.split('.')
+    metadata = {group: {field: key}}
+    if seek_index_item_id is not None:
+        metadata[group][SEEK_INDEX_FIELD.split('.')[1]] = seek_index_item_id
+    return metadata
+
+
+def seek_index_item_id(webm_item: dl.Item):
+    """
+    id of the seek index sidecar of a cached webm item, None when it has none
+    """
+    group, field = SEEK_INDEX_FIELD.split('.')
+    return webm_item.metadata.get(group, dict()).get(field, None)
+
+
+def find_webm_item(dataset: dl.Dataset, key):
+    """
+    find a webm item in the dataset that was converted from the same source with the same settings
+
+    :param dl.Dataset dataset: the dataset to search in
+    :param str key: the cache key
+
+    :return: the webm item, None when there is none
+    """
+    filters = dl.Filters(field='metadata.{}'.format(CACHE_KEY_FIELD), values=key, use_defaults=False)
+    filters.add(field='dir', values='/.dataloop/webm*')
+    pages = dataset.items.list(filters=filters)
+    for page in pages:
+        for webm_item in page:
+            return webm_item
+    return None
+
+
+class LocalConversionCache:
+    """
+    webm outputs on local disk by cache key, bounded by size. the least recently used are removed first
+    """
+
+    def __init__(self, cache_dir, max_size_bytes):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{}.webm'.format(key))
+
+    def get(self, key, output_filepath):
+        """
+        copy the cached webm of key to output_filepath
+
+        :return: True on a hit
+        """
+        with self._lock:
+            cached_filepath = self._path(key)
+            if not os.path.isfile(cached_filepath):
+                return False
+            # mtime is the last use
+            os.utime(cached_filepath)
+            shutil.copyfile(cached_filepath, output_filepath)
+        return True
+
+    def put(self, key, webm_filepath):
+        """
+        add a webm to the cache and evict the least recently used ones over the size budget
+        """
+        if os.path.getsize(webm_filepath) > self.max_size_bytes:
+            return
+        with self._lock:
+            cached_filepath = self._path(key)
+            tmp_filepath = cached_filepath + '.tmp'
+            shutil.copyfile(webm_filepath, tmp_filepath)
+            os.replace(tmp_filepath, cached_filepath)
+            self._evict()
+
+    def _evict(self):
+        entries = list()
+        for filepath in glob.glob(os.path.join(self.cache_dir, '*.webm')):
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filepath))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, filepath in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(filepath)
+                total_size -= size
+            except OSError:
+                logger.warning('failed to evict {} from the conversion cache'.format(filepath))
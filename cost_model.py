@@ -0,0 +1,224 @@
+"""
+Conversion cost model
+
+Predicts the encode wall time and the webm size of a conversion from the source codec, resolution, fps and frame
+count. The encode time is linear in the megapixel frames (frames x width x height / 1e6), scaled by the decode cost
+of the source codec and divided by the speedup of the encoder threads. The coefficients per encoder profile are
+calibrated with least squares from benchmark results and from the metrics json lines of the service.
+
+    python cost_model.py --benchmark bench.json --metrics metrics.jsonl --output cost_model.json
+"""
+import numpy as np
+import argparse
+import logging
+import json
+
+logger = logging.getLogger(__name__)
+# key of the ffmpeg default encoder settings (no encoder profile)
+DEFAULT_PROFILE = 'default'
+# encode seconds per megapixel frame on one thread, by encoder profile
+SECONDS_PER_MEGAPIXEL_FRAME = {
+    DEFAULT_PROFILE: 0.3,
+    'realtime': 0.01,
+    'balanced': 0.06,
+    'archival': 0.4
+}
+# webm bytes per megapixel frame, by encoder profile
+BYTES_PER_MEGAPIXEL_FRAME = {
+    DEFAULT_PROFILE: 5000,
+    'realtime': 4000,
+    'balanced': 3000,
+    'archival': 6000
+}
+# decode cost of the source codec relative to h264
+DECODE_FACTORS = {
+    'hevc': 1.3,
+    'av1': 1.5,
+    'prores': 1.2
+}
+# seconds of every conversion (process start, probe of the output, mux)
+OVERHEAD_SECONDS = 2
+# bytes per second of a remux (the video stream is copied)
+REMUX_BYTES_PER_SECOND = 200 * 1024 * 1024
+# speedup of n encoder threads is n ** PARALLEL_EXPONENT
+PARALLEL_EXPONENT = 0.7
+# vp9 tiles are at least 256 pixels wide, row-mt runs two rows of a tile at once
+MIN_TILE_WIDTH = 256
+# records of a profile needed to replace its coefficients
+MIN_FIT_RECORDS = 3
+
+
+def megapixel_frames(width, height, frames):
+    return float(frames) * float(width) * float(height) / 1e6
+
+
+def useful_threads(width, threads):
+    """
+    encoder threads that speed up the encode of a frame width, the rest would wait
+    """
+    if not width:
+        return threads
+    return max(1, min(threads, 2 * max(1, int(width) // MIN_TILE_WIDTH)))
+
+
+class CostModel:
+    """
+    encode time and output size predictions, see the module docstring for the model
+    """
+
+    def __init__(self, seconds_per_megapixel_frame=None, bytes_per_megapixel_frame=None):
+        self.seconds_per_megapixel_frame = dict(SECONDS_PER_MEGAPIXEL_FRAME)
+        self.seconds_per_megapixel_frame.update(seconds_per_megapixel_frame or dict())
+        self.bytes_per_megapixel_frame = dict(BYTES_PER_MEGAPIXEL_FRAME)
+        self.bytes_per_megapixel_frame.update(bytes_per_megapixel_frame or dict())
+
+    @classmethod
+    def load(cls, path):
+        """
+        the calibrated model of a json file written by save(), the default coefficients when path is None
+        """
+        if not path:
+            return cls()
+        with open(path) as f:
+            coefficients = json.load(f)
+        return cls(seconds_per_megapixel_frame=coefficients.get('seconds_per_megapixel_frame', None),
+                   bytes_per_megapixel_frame=coefficients.get('bytes_per_megapixel_frame', None))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'seconds_per_megapixel_frame': self.seconds_per_megapixel_frame,
+                       'bytes_per_megapixel_frame': self.bytes_per_megapixel_frame}, f, indent=2)
+
+    def predict(self, width, height, frames, codec=None, profile=None, threads=1, copy=False, input_bytes=None):
+        """
+        predict a conversion
+
+        :param int width: frame width
+        :param int height: frame height
+        :param int frames: number of frames
+        :param str codec: codec name of the source video stream
+        :param str profile: encoder profile, None for the ffmpeg defaults
+        :param int threads: encoder threads
+        :param bool copy: the video stream is copied, not encoded
+        :param int input_bytes: size of the source, used for a copy
+
+        :return: dict of encode_seconds and output_bytes, None when the frames or the resolution are unknown
+        """
+        if copy:
+            input_bytes = input_bytes or 0
+            return {'encode_seconds': OVERHEAD_SECONDS + input_bytes / REMUX_BYTES_PER_SECOND,
+                    'output_bytes': input_bytes}
+        if not (width and height and frames):
+            return None
+        profile = profile or DEFAULT_PROFILE
+        work = megapixel_frames(width=width, height=height, frames=frames)
+        speedup = useful_threads(width=width, threads=threads or 1) ** PARALLEL_EXPONENT
+        encode_seconds = (OVERHEAD_SECONDS +
+                          self.seconds_per_megapixel_frame[profile] * DECODE_FACTORS.get(codec, 1) * work / speedup)
+        return {'encode_seconds': encode_seconds,
+                'output_bytes': int(self.bytes_per_megapixel_frame[profile] * work)}
+
+    def fit(self, records):
+        """
+        calibrate the coefficients of the profiles with enough records, least squares through the origin
+
+        :param list records: dicts of profile, codec, width, height, frames, threads, encode_seconds, output_bytes
+        :return: number of records used per profile
+        """
+        used = dict()
+        by_profile = dict()
+        for record in records:
+            if not (record.get('width') and record.get('height') and record.get('frames')):
+                continue
+            by_profile.setdefault(record.get('profile', None) or DEFAULT_PROFILE, list()).append(record)
+        for profile, profile_records in by_profile.items():
+            if len(profile_records) < MIN_FIT_RECORDS:
+                continue
+            work = np.array([megapixel_frames(width=r['width'], height=r['height'], frames=r['frames'])
+                             for r in profile_records])
+            decode = np.array([DECODE_FACTORS.get(r.get('codec', None), 1) for r in profile_records])
+            speedup = np.array([useful_threads(width=r['width'], threads=r.get('threads', None) or 1)
+                                for r in profile_records]) ** PARALLEL_EXPONENT
+            seconds = np.array([r['encode_seconds'] for r in profile_records], dtype=np.float64)
+            output_bytes = np.array([r.get('output_bytes', None) or np.nan for r in profile_records],
+                                    dtype=np.float64)
+            x = work * decode / speedup
+            y = np.maximum(seconds - OVERHEAD_SECONDS, 0)
+            self.seconds_per_megapixel_frame[profile] = float(np.dot(x, y) / np.dot(x, x))
+            known = ~np.isnan(output_bytes)
+            if np.any(known):
+                self.bytes_per_megapixel_frame[profile] = float(np.dot(work[known], output_bytes[known]) /
+                                                                np.dot(work[known], work[known]))
+            used[profile] = len(profile_records)
+        return used
+
+
+def records_from_benchmark(report):
+    """
+    fit records of a benchmark.py json report, the ffmpeg method without segments
+    """
+    records = list()
+    for result in report.get('results', list()):
+        if result.get('error', None) or result.get('method', None) != 'ffmpeg' or result.get('segment_duration'):
+            continue
+        records.append({'profile': result.get('profile', None),
+                        'codec': result.get('codec', None),
+                        'width': result.get('width', None),
+                        'height': result.get('height', None),
+                        'frames': result.get('frames', None),
+                        'threads': result.get('threads', None) or report.get('environment', dict()).get('cpus', None),
+                        'encode_seconds': result['wall_time'],
+                        'output_bytes': result.get('output_size', None)})
+    return records
+
+
+def records_from_metrics(lines):
+    """
+    fit records of the metrics json lines of the service (metrics_json_path), the encoded items that succeeded
+    """
+    records = list()
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        metrics = json.loads(line)
+        source = metrics.get('source', None) or dict()
+        encode = metrics.get('stages', dict()).get('encode', None)
+        if not metrics.get('success') or encode is None or source.get('copy') or source.get('segmented'):
+            continue
+        # a retried encode adds up, use the mean of the runs
+        records.append({'profile': source.get('profile', None),
+                        'codec': source.get('codec', None),
+                        'width': source.get('width', None),
+                        'height': source.get('height', None),
+                        'frames': source.get('frames', None),
+                        'threads': source.get('threads', None),
+                        'encode_seconds': encode['wall_time'] / max(1, encode['runs']),
+                        'output_bytes': metrics.get('output_bytes', None)})
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate the conversion cost model')
+    parser.add_argument('--benchmark', nargs='*', default=list(), help='benchmark.py json reports')
+    parser.add_argument('--metrics', nargs='*', default=list(), help='metrics json lines files of the service')
+    parser.add_argument('--base', default=None, help='cost model json to start from, the defaults when not set')
+    parser.add_argument('--output', required=True, help='cost model json path')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    records = list()
+    for path in args.benchmark:
+        with open(path) as f:
+            records += records_from_benchmark(report=json.load(f))
+    for path in args.metrics:
+        with open(path) as f:
+            records += records_from_metrics(lines=f)
+    model = CostModel.load(path=args.base)
+    used = model.fit(records=records)
+    logger.info('calibrated {} from {} records'.format(used, len(records)))
+    model.save(path=args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import dtlpy as dl
 import os
 
+from video_utilities import TRIGGER_FILTER
+
 package_name = 'custom-webm-converter'
 project_name = 'projectName'
 
@@ -15,13 +17,58 @@ module = [
         name='webm_module',
         class_name='WebmConverter',
         entry_point='webm_converter.py',
-        init_inputs=[dl.FunctionIO(type=dl.PackageInputType.STRING, name="method")],
+        init_inputs=[dl.FunctionIO(type=dl.PackageInputType.STRING, name="method"),
+                     dl.FunctionIO(type=dl.PackageInputType.STRING, name="input_mode"),
+                     dl.FunctionIO(type=dl.PackageInputType.INT, name="segment_duration"),
+                     dl.FunctionIO(type=dl.PackageInputType.INT, name="segment_workers"),
+                     dl.FunctionIO(type=dl.PackageInputType.STRING, name="encoder_profile"),
+                     dl.FunctionIO(type=dl.PackageInputType.STRING, name="verification"),
+                     dl.FunctionIO(type=dl.PackageInputType.INT, name="stall_timeout"),
+                     dl.FunctionIO(type=dl.PackageInputType.STRING, name="metrics_json_path"),
+                     dl.FunctionIO(type=dl.PackageInputType.STRING, name="metrics_prometheus_path"),
+                     dl.FunctionIO(type=dl.PackageInputType.BOOLEAN, name="metrics_to_item"),
+                     dl.FunctionIO(type=dl.PackageInputType.STRING, name="cache_dir"),
+                     dl.FunctionIO(type=dl.PackageInputType.INT, name="cache_max_size_mb"),
+                     dl.FunctionIO(type=dl.PackageInputType.BOOLEAN, name="cache_lookup_platform"),
+                     dl.FunctionIO(type=dl.PackageInputType.STRING, name="scratch_root"),
+                     dl.FunctionIO(type=dl.PackageInputType.INT, name="disk_budget_mb"),
+                     dl.FunctionIO(type=dl.PackageInputType.INT, name="concurrency"),
+                     dl.FunctionIO(type=dl.PackageInputType.BOOLEAN, name="preview"),
+                     dl.FunctionIO(type=dl.PackageInputType.INT, name="preview_height"),
+                     dl.FunctionIO(type=dl.PackageInputType.JSON, name="renditions"),
+                     dl.FunctionIO(type=dl.PackageInputType.INT, name="thumbnail_strip"),
+                     dl.FunctionIO(type=dl.PackageInputType.FLOAT, name="keyframe_interval"),
+                     dl.FunctionIO(type=dl.PackageInputType.BOOLEAN, name="seek_index"),
+                     dl.FunctionIO(type=dl.PackageInputType.BOOLEAN, name="reject_unverified"),
+                     dl.FunctionIO(type=dl.PackageInputType.INT, name="alert_window"),
+                     dl.FunctionIO(type=dl.PackageInputType.STRING, name="cost_model_path"),
+                     dl.FunctionIO(type=dl.PackageInputType.BOOLEAN, name="auto_tune"),
+                     dl.FunctionIO(type=dl.PackageInputType.INT, name="heavy_encode_seconds"),
+                     dl.FunctionIO(type=dl.PackageInputType.STRING, name="heavy_service_name"),
+                     dl.FunctionIO(type=dl.PackageInputType.FLOAT, name="encode_budget_factor")],
         functions=[
             dl.PackageFunction(
                 inputs=[dl.FunctionIO(type=dl.PackageInputType.ITEM, name="item")],
                 outputs=[dl.FunctionIO(type=dl.PackageInputType.ITEM, name="item")],
                 name='run',
                 description='Run Webm converter on input item, except method as param, possible values: ffmpeg, opencv. default to ffmpeg'),
+            dl.PackageFunction(
+                inputs=[dl.FunctionIO(type=dl.PackageInputType.DATASET, name="dataset"),
+                        dl.FunctionIO(type=dl.PackageInputType.JSON, name="query")],
+                outputs=[],
+                name='run_batch',
+                description='Convert the video items of a dataset (optionally filtered by query), downloads, encodes and uploads overlap'),
+            dl.PackageFunction(
+                inputs=[dl.FunctionIO(type=dl.PackageInputType.DATASET, name="dataset"),
+                        dl.FunctionIO(type=dl.PackageInputType.JSON, name="query")],
+                outputs=[],
+                name='audit',
+                description='Pre-flight audit of the video items of a dataset: items that will fail, frame count mismatches and conversion cost'),
+            dl.PackageFunction(
+                inputs=[dl.FunctionIO(type=dl.PackageInputType.ITEM, name="item")],
+                outputs=[],
+                name='predict',
+                description='Predicted encode time and webm size of an item from its platform metadata'),
         ]
     )
 ]
@@ -57,7 +104,35 @@ package = project.packages.get(package_name=package_name)
 ###########
 # deploy a new service
 service = package.services.deploy(
-    init_input={'method': 'ffmpeg'},
+    init_input={'method': 'ffmpeg',
+                'input_mode': 'download',
+                'segment_duration': 0,
+                'segment_workers': 0,
+                'encoder_profile': 'balanced',
+                'verification': 'fast',
+                'stall_timeout': 120,
+                'metrics_json_path': '',
+                'metrics_prometheus_path': '',
+                'metrics_to_item': False,
+                'cache_dir': '',
+                'cache_max_size_mb': 0,
+                'cache_lookup_platform': True,
+                'scratch_root': '',
+                'disk_budget_mb': 0,
+                'concurrency': 1,
+                'preview': False,
+                'preview_height': 360,
+                'renditions': [],
+                'thumbnail_strip': 0,
+                'keyframe_interval': 0,
+                'seek_index': False,
+                'reject_unverified': False,
+                'alert_window': 300,
+                'cost_model_path': '',
+                'auto_tune': False,
+                'heavy_encode_seconds': 1800,
+                'heavy_service_name': '',
+                'encode_budget_factor': 5},
     service_name=package_name,
     execution_timeout=2 * 60 * 60,
     module_name=module[0].name,
@@ -82,36 +157,7 @@ if triggers.items_count < 1:
         execution_mode=dl.TriggerExecutionMode.ONCE,
         resource='Item',
         actions=['Updated'],
-        filters={
-            '$and': [
-                {
-                    'metadata.system.mimetype': {
-                        '$eq': 'video*'
-                    }
-                },
-                {
-                    'metadata.system.size': {
-                        '$lt': 536870912
-                    }
-                },
-                {
-                    'metadata.system.mimetype': {
-                        '$ne': 'video/webm'
-                    }
-                },
-                {
-                    "metadata.system.fps": {
-                        "$gt": 0
-                    }
-                },
-                {
-                    "hidden": False
-                },
-                {
-                    "type": "file"
-                }
-            ]
-        }
+        filters=TRIGGER_FILTER
     )
 else:
     trigger = triggers.items[0]
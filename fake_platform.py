@@ -0,0 +1,512 @@
+"""
+Local stand-in for the Dataloop SDK
+
+Implements the dtlpy calls of the converter modules - item get / download / upload / update / delete / clone,
+modalities.create, items.update and items.list with filters, projects / datasets / services get, the notifications
+request and _send_mail - over files on local disk. Every platform call can be delayed and fail at random, the calls
+and the injected failures are counted by name.
+
+The stand-in replaces the dtlpy module, install() it before the converter modules are imported:
+
+    import fake_platform
+    platform = fake_platform.install(root_dir='.fake_platform', latency=0.05, failure_rates={'upload': 0.1})
+    from webm_converter import WebmConverter
+"""
+from collections import Counter
+import threading
+import datetime
+import fnmatch
+import random
+import shutil
+import types
+import copy
+import time
+import uuid
+import sys
+import os
+
+# modules that import dtlpy, they would keep the real sdk when imported before install()
+CONVERTER_MODULES = ['webm_converter', 'video_utilities', 'mail_handler', 'metadata_session', 'conversion_cache',
+                     'alert_aggregator', 'preflight_audit']
+# calls of the sdk that are local, they are counted without latency or failures
+LOCAL_CALLS = ['modality_create', 'modality_delete']
+DEFAULT_PROJECT_ID = 'fake-project'
+DEFAULT_DATASET_ID = 'fake-dataset'
+DEFAULT_CREATOR = 'load-test@dataloop.ai'
+
+
+class PlatformException(Exception):
+    """
+    an injected failure of a platform call
+    """
+
+
+class Filters:
+    """
+    dl.Filters of equality / wildcard conditions on item fields, a custom filter matches all the items
+    """
+
+    def __init__(self, field=None, values=None, use_defaults=True, custom_filter=None):
+        self.conditions = list()
+        self.custom_filter = custom_filter
+        self.page_size = 1000
+        if field is not None:
+            self.add(field=field, values=values)
+
+    def add(self, field, values):
+        self.conditions.append((field, values))
+
+    def match(self, record):
+        return all(_match_value(value=_field_value(record=record, field=field), expected=expected)
+                   for field, expected in self.conditions)
+
+
+def _field_value(record, field):
+    if field == 'dir':
+        return os.path.dirname(record['filename'])
+    if field == 'id':
+        return record['id']
+    value = record
+    for key in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key, None)
+    return value
+
+
+def _match_value(value, expected):
+    if isinstance(expected, str) and '*' in expected:
+        return isinstance(value, str) and fnmatch.fnmatch(value, expected)
+    return value == expected
+
+
+class Progress:
+    def update(self, progress=None, **kwargs):
+        pass
+
+
+class Context:
+    def __init__(self, execution_id=None, service_name=None):
+        self.execution_id = execution_id or str(uuid.uuid4())
+        self.service_name = service_name
+
+
+class BaseServiceRunner:
+    pass
+
+
+class Modalities:
+    def __init__(self, item):
+        self.item = item
+
+    def create(self, modality_type, ref, ref_type=None, name=None, timestamp=None, **kwargs):
+        """
+        local change of the item metadata as in the sdk, saved with item.update
+        """
+        self.item.platform.call(name='modality_create')
+        modalities = self.item.metadata['system'].setdefault('modalities', list())
+        modalities.append({'type': modality_type, 'ref': ref, 'refType': ref_type, 'name': name,
+                           'timestamp': timestamp})
+
+    def delete(self, name):
+        self.item.platform.call(name='modality_delete')
+        modalities = self.item.metadata['system'].get('modalities', list())
+        self.item.metadata['system']['modalities'] = [modality for modality in modalities
+                                                      if modality.get('name', None) != name]
+
+
+class Item:
+    """
+    a copy of the item record, changes of its metadata are saved by update()
+    """
+
+    def __init__(self, platform, record):
+        self.platform = platform
+        self.id = record['id']
+        self.name = record['name']
+        self.filename = record['filename']
+        self.datasetId = record['datasetId']
+        self.dataset_id = record['datasetId']
+        self.project_id = record['projectId']
+        self.creator = record['creator']
+        self.created_at = record['createdAt']
+        self.metadata = copy.deepcopy(record['metadata'])
+        self.modalities = Modalities(item=self)
+
+    @property
+    def platform_url(self):
+        return 'file://{}'.format(self.platform.filepath(item_id=self.id))
+
+    @property
+    def stream(self):
+        return self.platform.filepath(item_id=self.id)
+
+    @property
+    def height(self):
+        return self.metadata['system'].get('height', None)
+
+    @property
+    def width(self):
+        return self.metadata['system'].get('width', None)
+
+    @property
+    def dataset(self):
+        return self.platform.datasets.get(dataset_id=self.datasetId)
+
+    @property
+    def project(self):
+        return self.platform.projects.get(project_id=self.project_id)
+
+    def download(self, local_path=None, **kwargs):
+        return self.platform.download(item_id=self.id, local_path=local_path)
+
+    def update(self, system_metadata=False):
+        self.platform.update_item(item=self)
+        return self
+
+    def clone(self, dst_dataset_id=None, remote_filepath=None, metadata=None, with_metadata=True, **kwargs):
+        return self.platform.clone_item(item_id=self.id,
+                                        dataset_id=dst_dataset_id or self.datasetId,
+                                        remote_filepath=remote_filepath or self.filename,
+                                        metadata=metadata,
+                                        with_metadata=with_metadata)
+
+
+class ItemsRepository:
+    def __init__(self, platform, dataset_id=None):
+        self.platform = platform
+        self.dataset_id = dataset_id
+
+    def get(self, item_id):
+        self.platform.call(name='item_get')
+        return self.platform.item(item_id=item_id)
+
+    def delete(self, item_id):
+        self.platform.call(name='item_delete')
+        self.platform.delete_item(item_id=item_id)
+        return True
+
+    def upload(self, local_path, remote_path='/', overwrite=False, item_metadata=None, **kwargs):
+        return self.platform.upload(dataset_id=self.dataset_id,
+                                    local_path=local_path,
+                                    remote_path=remote_path,
+                                    overwrite=overwrite,
+                                    item_metadata=item_metadata)
+
+    def list(self, filters=None):
+        self.platform.call(name='items_list')
+        records = self.platform.find(dataset_id=self.dataset_id, filters=filters)
+        page_size = filters.page_size if filters is not None else 1000
+        return [[self.platform.entity(record=record) for record in records[i:i + page_size]]
+                for i in range(0, len(records), page_size)]
+
+    def update(self, filters=None, system_update_values=None, system_metadata=False, **kwargs):
+        self.platform.call(name='items_update')
+        return self.platform.update_items(dataset_id=self.dataset_id,
+                                          filters=filters,
+                                          system_update_values=system_update_values or dict())
+
+
+class Dataset:
+    def __init__(self, platform, dataset_id):
+        self.id = dataset_id
+        self.name = dataset_id
+        self.items = ItemsRepository(platform=platform, dataset_id=dataset_id)
+
+
+class DatasetsRepository:
+    def __init__(self, platform):
+        self.platform = platform
+
+    def get(self, dataset_id=None, fetch=True, **kwargs):
+        if fetch:
+            self.platform.call(name='dataset_get')
+        return Dataset(platform=self.platform, dataset_id=dataset_id)
+
+
+class Project:
+    def __init__(self, platform, project_id):
+        self.id = project_id
+        self.name = project_id
+        self.org = {'id': 'fake-org'}
+        self.datasets = DatasetsRepository(platform=platform)
+
+
+class ProjectsRepository:
+    def __init__(self, platform):
+        self.platform = platform
+
+    def get(self, project_id=None, **kwargs):
+        self.platform.call(name='project_get')
+        return Project(platform=self.platform, project_id=project_id)
+
+    def _send_mail(self, project_id, send_to, title, content):
+        self.platform.call(name='mail')
+        with self.platform.lock:
+            self.platform.mails.append({'project_id': project_id, 'send_to': send_to, 'title': title})
+
+
+class Service:
+    def __init__(self, platform, name):
+        self.platform = platform
+        self.name = name
+
+    def execute(self, function_name=None, item_id=None, project_id=None, **kwargs):
+        self.platform.call(name='service_execute')
+        with self.platform.lock:
+            self.platform.executions.append({'service': self.name, 'function': function_name, 'item_id': item_id})
+
+
+class ServicesRepository:
+    def __init__(self, platform):
+        self.platform = platform
+
+    def get(self, service_name=None, **kwargs):
+        self.platform.call(name='service_get')
+        return Service(platform=self.platform, name=service_name)
+
+
+class ClientApi:
+    def __init__(self, platform):
+        self.platform = platform
+        self.auth = {'authorization': 'Bearer fake'}
+        self.environment = 'https://gate.dataloop.ai/api/v1'
+
+    def add_environment(self, **kwargs):
+        pass
+
+    def gen_request(self, req_type, path, json_req=None, **kwargs):
+        self.platform.call(name='notification' if path == '/notifications/publish' else 'request')
+        return True, None
+
+
+class FakePlatform:
+    """
+    items of the platform as records in memory and their files in root_dir
+    """
+
+    def __init__(self, root_dir, latency=0.0, jitter=0.0, bandwidth=None, failure_rates=None, seed=None):
+        """
+        :param str root_dir: dir of the uploaded files
+        :param float latency: seconds of every platform call
+        :param float jitter: the latency of a call is drawn in latency x (1 +- jitter)
+        :param float bandwidth: bytes per second of the downloads and uploads, unlimited when None
+        :param dict failure_rates: failure probability by call name (download, upload, item_update, items_update,
+                                   item_get, items_list, notification, mail...), '*' for the other calls
+        :param int seed: seed of the latency and failure draws
+        """
+        self.root_dir = root_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.failure_rates = failure_rates or dict()
+        self.calls = Counter()
+        self.failures = Counter()
+        self.mails = list()
+        self.executions = list()
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._records = dict()
+        os.makedirs(root_dir, exist_ok=True)
+        self.items = ItemsRepository(platform=self)
+        self.datasets = DatasetsRepository(platform=self)
+        self.projects = ProjectsRepository(platform=self)
+        self.services = ServicesRepository(platform=self)
+        self.client_api = ClientApi(platform=self)
+
+    def seed(self, seed):
+        with self.lock:
+            self._random.seed(seed)
+
+    def call(self, name, nb_bytes=0):
+        """
+        count a platform call, wait its latency and transfer time and raise an injected failure
+        """
+        with self.lock:
+            self.calls[name] += 1
+            if name in LOCAL_CALLS:
+                return
+            delay = self.latency * (1 + self.jitter * self._random.uniform(-1, 1))
+            failed = self._random.random() < self.failure_rates.get(name, self.failure_rates.get('*', 0))
+            if failed:
+                self.failures[name] += 1
+        if self.bandwidth and nb_bytes:
+            delay += nb_bytes / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            raise PlatformException('injected failure of {}'.format(name))
+
+    def add_item(self, filepath, name=None, remote_path='/', dataset_id=DEFAULT_DATASET_ID,
+                 project_id=DEFAULT_PROJECT_ID, creator=DEFAULT_CREATOR, metadata=None):
+        """
+        add an item served from a file on disk, the file is not copied
+
+        :return: the item
+        """
+        name = name or os.path.basename(filepath)
+        system = {'mimetype': 'video/{}'.format(os.path.splitext(name)[1].lstrip('.') or 'mp4'),
+                  'size': os.path.getsize(filepath)}
+        item_metadata = copy.deepcopy(metadata) if metadata is not None else dict()
+        item_metadata.setdefault('system', dict()).update(system)
+        record = self._add_record(filepath=filepath,
+                                  filename=os.path.join(remote_path, name),
+                                  dataset_id=dataset_id,
+                                  project_id=project_id,
+                                  creator=creator,
+                                  metadata=item_metadata)
+        return self.entity(record=record)
+
+    def _add_record(self, filepath, filename, dataset_id, project_id, creator, metadata):
+        record = {'id': uuid.uuid4().hex[:24],
+                  'name': os.path.basename(filename),
+                  'filename': filename,
+                  'datasetId': dataset_id,
+                  'projectId': project_id,
+                  'creator': creator,
+                  'createdAt': datetime.datetime.utcnow().isoformat(),
+                  'filepath': filepath,
+                  'metadata': metadata,
+                  'spec': dict()}
+        with self.lock:
+            self._records[record['id']] = record
+        return record
+
+    def _record(self, item_id):
+        with self.lock:
+            if item_id not in self._records:
+                raise PlatformException('item not found: {}'.format(item_id))
+            return self._records[item_id]
+
+    def filepath(self, item_id):
+        return self._record(item_id=item_id)['filepath']
+
+    def entity(self, record):
+        # the record may be updated by another thread while its metadata is copied
+        with self.lock:
+            return Item(platform=self, record=record)
+
+    def item(self, item_id):
+        return self.entity(record=self._record(item_id=item_id))
+
+    def download(self, item_id, local_path=None):
+        filepath = self.filepath(item_id=item_id)
+        self.call(name='download', nb_bytes=os.path.getsize(filepath))
+        if local_path is None:
+            local_path = os.path.join(self.root_dir, 'downloads')
+        if os.path.isdir(local_path):
+            local_path = os.path.join(local_path, os.path.basename(filepath))
+        shutil.copyfile(filepath, local_path)
+        return local_path
+
+    def upload(self, dataset_id, local_path, remote_path, overwrite, item_metadata):
+        self.call(name='upload', nb_bytes=os.path.getsize(local_path))
+        filename = os.path.join(remote_path, os.path.basename(local_path))
+        metadata = copy.deepcopy(item_metadata) if item_metadata is not None else dict()
+        metadata.setdefault('system', dict()).update({'mimetype': 'video/webm', 'size': os.path.getsize(local_path)})
+        with self.lock:
+            existing = next((record for record in self._records.values()
+                             if record['datasetId'] == dataset_id and record['filename'] == filename), None)
+        if existing is not None and not overwrite:
+            return self.entity(record=existing)
+        stored_filepath = os.path.join(self.root_dir, uuid.uuid4().hex + os.path.splitext(local_path)[1])
+        shutil.copyfile(local_path, stored_filepath)
+        if existing is not None:
+            with self.lock:
+                os.remove(existing['filepath'])
+                existing.update({'filepath': stored_filepath, 'metadata': metadata})
+            return self.entity(record=existing)
+        record = self._add_record(filepath=stored_filepath,
+                                  filename=filename,
+                                  dataset_id=dataset_id,
+                                  project_id=DEFAULT_PROJECT_ID,
+                                  creator=DEFAULT_CREATOR,
+                                  metadata=metadata)
+        return self.entity(record=record)
+
+    def clone_item(self, item_id, dataset_id, remote_filepath, metadata, with_metadata):
+        record = self._record(item_id=item_id)
+        self.call(name='item_clone')
+        with self.lock:
+            exists = any(other['datasetId'] == dataset_id and other['filename'] == remote_filepath
+                         for other in self._records.values())
+        if exists:
+            raise PlatformException('item already exists: {}'.format(remote_filepath))
+        stored_filepath = os.path.join(self.root_dir, uuid.uuid4().hex + os.path.splitext(record['filepath'])[1])
+        shutil.copyfile(record['filepath'], stored_filepath)
+        clone_metadata = copy.deepcopy(record['metadata']) if with_metadata else dict()
+        clone_metadata.update(copy.deepcopy(metadata or dict()))
+        clone = self._add_record(filepath=stored_filepath,
+                                 filename=remote_filepath,
+                                 dataset_id=dataset_id,
+                                 project_id=record['projectId'],
+                                 creator=DEFAULT_CREATOR,
+                                 metadata=clone_metadata)
+        return self.entity(record=clone)
+
+    def update_item(self, item):
+        self.call(name='item_update')
+        record = self._record(item_id=item.id)
+        with self.lock:
+            record['metadata'] = copy.deepcopy(item.metadata)
+
+    def delete_item(self, item_id):
+        record = self._record(item_id=item_id)
+        with self.lock:
+            self._records.pop(item_id)
+        if record['filepath'].startswith(os.path.abspath(self.root_dir)):
+            os.remove(record['filepath'])
+
+    def find(self, dataset_id, filters=None):
+        with self.lock:
+            return [record for record in self._records.values()
+                    if (dataset_id is None or record['datasetId'] == dataset_id) and
+                    (filters is None or filters.match(record))]
+
+    def update_items(self, dataset_id, filters, system_update_values):
+        records = self.find(dataset_id=dataset_id, filters=filters)
+        with self.lock:
+            for record in records:
+                record['metadata'].setdefault('system', dict()).update(copy.deepcopy(system_update_values))
+        return len(records)
+
+    def report(self):
+        with self.lock:
+            return {'calls': dict(self.calls),
+                    'failures': dict(self.failures),
+                    'mails': len(self.mails),
+                    'executions': len(self.executions)}
+
+
+def install(root_dir='.fake_platform', **kwargs):
+    """
+    replace the dtlpy module with the stand-in, before the converter modules are imported
+
+    :param str root_dir: dir of the uploaded files
+    :param kwargs: latency, jitter, bandwidth, failure_rates and seed of FakePlatform
+    :return: the FakePlatform
+    """
+    imported = [name for name in CONVERTER_MODULES if name in sys.modules]
+    if imported:
+        raise RuntimeError('install the fake platform before importing {}'.format(imported))
+    platform = FakePlatform(root_dir=os.path.abspath(root_dir), **kwargs)
+    module = types.ModuleType('dtlpy')
+    module.__doc__ = 'local stand-in for the Dataloop SDK, see fake_platform.py'
+    module.Item = Item
+    module.item = Item
+    module.Dataset = Dataset
+    module.Filters = Filters
+    module.Progress = Progress
+    module.Context = Context
+    module.BaseServiceRunner = BaseServiceRunner
+    module.MODALITY_REF_TYPE_ID = 'id'
+    module.exceptions = types.SimpleNamespace(PlatformException=PlatformException)
+    module.items = platform.items
+    module.datasets = platform.datasets
+    module.projects = platform.projects
+    module.services = platform.services
+    module.client_api = platform.client_api
+    module.environment = lambda: platform.client_api.environment
+    module.platform = platform
+    sys.modules['dtlpy'] = module
+    return platform
@@ -0,0 +1,189 @@
+from contextlib import contextmanager
+import contextvars
+import threading
+import logging
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+METRICS_PREFIX = 'webm_converter'
+# the stage running in this thread, the commands it spawns add their resource usage to it
+_current_stage = contextvars.ContextVar('metrics_stage', default=None)
+
+
+def record_command_usage(cpu_time, peak_rss_mb):
+    """
+    add the resource usage of a finished command to the stage that spawned it, nothing outside a stage
+
+    :param float cpu_time: cpu seconds (user + system) of the command process
+    :param float peak_rss_mb: peak rss of the command process in MB
+    """
+    current = _current_stage.get()
+    if current is None:
+        return
+    metrics, stage = current
+    with metrics._lock:
+        stage['cpu_time'] += cpu_time
+        stage['peak_rss_mb'] = max(stage['peak_rss_mb'], peak_rss_mb)
+        stage['commands'] += 1
+
+
+class ItemMetrics:
+    """
+    timing and resource usage of the stages of one item conversion
+    """
+
+    def __init__(self, item_id):
+        self.item_id = item_id
+        self.stages = dict()
+        self.input_bytes = None
+        self.output_bytes = None
+        self.video_duration = None
+        self.tries = 0
+        self.success = None
+        # platform api calls by kind
+        self.api_calls = dict()
+        # what the encode time depends on - codec, resolution, frames, profile, threads, and the prediction
+        self.source = dict()
+        self._lock = threading.Lock()
+
+    def count_api_call(self, name, n=1):
+        with self._lock:
+            self.api_calls[name] = self.api_calls.get(name, 0) + n
+
+    @contextmanager
+    def stage(self, name):
+        """
+        measure wall time, cpu time and peak rss of a stage, a stage measured again (a retry) adds up
+        cpu time is the stage thread plus the commands the stage spawned, peak rss is the largest of its commands -
+        the process wide getrusage counters mix the items converted at the same time
+        """
+        with self._lock:
+            stage = self.stages.setdefault(name, {'wall_time': 0,
+                                                  'cpu_time': 0,
+                                                  'peak_rss_mb': 0,
+                                                  'commands': 0,
+                                                  'runs': 0})
+        tic = time.time()
+        thread_tic = time.thread_time()
+        token = _current_stage.set((self, stage))
+        try:
+            yield
+        finally:
+            _current_stage.reset(token)
+            with self._lock:
+                stage['wall_time'] += time.time() - tic
+                stage['cpu_time'] += time.thread_time() - thread_tic
+                stage['runs'] += 1
+
+    def realtime_factor(self):
+        """
+        seconds of video encoded per second of wall time, None when unknown
+        """
+        encode = self.stages.get('encode', None)
+        if not self.video_duration or encode is None or encode['wall_time'] <= 0:
+            return None
+        return self.video_duration / encode['wall_time']
+
+    def to_dict(self):
+        realtime_factor = self.realtime_factor()
+        return {
+            'item_id': self.item_id,
+            'success': self.success,
+            'tries': self.tries,
+            'input_bytes': self.input_bytes,
+            'output_bytes': self.output_bytes,
+            'video_duration': self.video_duration,
+            'realtime_factor': round(realtime_factor, 3) if realtime_factor is not None else None,
+            'api_calls': dict(self.api_calls),
+            'source': self.source,
+            'stages': {name: {'wall_time': round(stage['wall_time'], 3),
+                              'cpu_time': round(stage['cpu_time'], 3),
+                              'peak_rss_mb': round(stage['peak_rss_mb'], 1),
+                              'commands': stage['commands'],
+                              'runs': stage['runs']}
+                       for name, stage in self.stages.items()}
+        }
+
+    def compact(self):
+        """
+        short form for the item system metadata - wall seconds per stage, bytes and realtime factor
+        """
+        realtime_factor = self.realtime_factor()
+        return {
+            'wall': {name: round(stage['wall_time'], 1) for name, stage in self.stages.items()},
+            'inBytes': self.input_bytes,
+            'outBytes': self.output_bytes,
+            'rtf': round(realtime_factor, 2) if realtime_factor is not None else None,
+            'tries': self.tries,
+            'api': sum(self.api_calls.values())
+        }
+
+
+class MetricsExporter:
+    """
+    export the metrics of every item: a structured log line, and optionally json lines and a prometheus textfile
+    the prometheus file holds process totals, scrape it with the node exporter textfile collector
+    """
+
+    def __init__(self, json_path=None, prometheus_path=None):
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self._lock = threading.Lock()
+        self._items = {'success': 0, 'failed': 0}
+        self._stage_totals = dict()
+        self._bytes = {'input': 0, 'output': 0}
+        self._api_calls = dict()
+
+    def export(self, metrics: ItemMetrics):
+        record = metrics.to_dict()
+        logger.info('[metrics] {}'.format(json.dumps(record)))
+        try:
+            with self._lock:
+                self._add(metrics=metrics)
+                if self.json_path:
+                    with open(self.json_path, 'a') as f:
+                        f.write(json.dumps(record) + '\n')
+                if self.prometheus_path:
+                    self._write_prometheus()
+        except OSError:
+            logger.exception('Failed to export metrics')
+
+    def _add(self, metrics: ItemMetrics):
+        self._items['success' if metrics.success else 'failed'] += 1
+        self._bytes['input'] += metrics.input_bytes or 0
+        self._bytes['output'] += metrics.output_bytes or 0
+        for name, count in metrics.api_calls.items():
+            self._api_calls[name] = self._api_calls.get(name, 0) + count
+        for name, stage in metrics.stages.items():
+            totals = self._stage_totals.setdefault(name, {'wall_time': 0, 'cpu_time': 0, 'runs': 0})
+            totals['wall_time'] += stage['wall_time']
+            totals['cpu_time'] += stage['cpu_time']
+            totals['runs'] += stage['runs']
+
+    def _write_prometheus(self):
+        lines = ['# TYPE {}_items_total counter'.format(METRICS_PREFIX)]
+        for status, value in self._items.items():
+            lines.append('{}_items_total{{status="{}"}} {}'.format(METRICS_PREFIX, status, value))
+        lines.append('# TYPE {}_bytes_total counter'.format(METRICS_PREFIX))
+        for direction, value in self._bytes.items():
+            lines.append('{}_bytes_total{{direction="{}"}} {}'.format(METRICS_PREFIX, direction, value))
+        lines.append('# TYPE {}_api_calls_total counter'.format(METRICS_PREFIX))
+        for name, value in self._api_calls.items():
+            lines.append('{}_api_calls_total{{call="{}"}} {}'.format(METRICS_PREFIX, name, value))
+        for key in ['wall_time', 'cpu_time']:
+            lines.append('# TYPE {}_stage_{}_seconds_total counter'.format(METRICS_PREFIX, key))
+            for name, totals in self._stage_totals.items():
+                lines.append('{}_stage_{}_seconds_total{{stage="{}"}} {}'.format(METRICS_PREFIX,
+                                                                               key,
+                                                                               name,
+                                                                               round(totals[key], 3)))
+        lines.append('# TYPE {}_stage_runs_total counter'.format(METRICS_PREFIX))
+        for name, totals in self._stage_totals.items():
+            lines.append('{}_stage_runs_total{{stage="{}"}} {}'.format(METRICS_PREFIX, name, totals['runs']))
+        # the collector may read at any time, write and rename
+        tmp_path = self.prometheus_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.prometheus_path)
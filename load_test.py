@@ -0,0 +1,175 @@
+"""
+End-to-end load test
+
+Pushes synthetic video items through WebmConverter.run on a local stand-in of the platform (fake_platform.py) that
+serves the files from disk and injects latency and failures in the platform calls. Reports the throughput, the
+latency percentiles of run(), the platform calls and the retries as JSON.
+
+    python load_test.py --items 300 --concurrency 4 --output load.json
+    python load_test.py --items 200 --latency 0.05 --jitter 0.5 --fail upload=0.1 item_update=0.02
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+import numpy as np
+import itertools
+import argparse
+import logging
+import shutil
+import json
+import time
+import os
+
+import fake_platform
+
+# the converter modules import dtlpy, the stand-in is configured in main()
+PLATFORM = fake_platform.install(root_dir=os.path.join('.load_test', 'platform'))
+
+from webm_converter import WebmConverter, ConversionMethod, VerificationLevel  # noqa: E402
+import benchmark  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESOLUTIONS = ['320x240', '640x360']
+DEFAULT_DURATIONS = [2, 5]
+PERCENTILES = [50, 90, 95, 99]
+
+
+def make_items(platform, clips, nb_items):
+    """
+    add nb_items items to the fake platform, the clips are served round robin
+
+    :return: list of the items
+    """
+    items = list()
+    for i_item, clip_filepath in zip(range(nb_items), itertools.cycle(clips)):
+        items.append(platform.add_item(filepath=clip_filepath,
+                                       name='item_{:05d}{}'.format(i_item, os.path.splitext(clip_filepath)[1]),
+                                       remote_path='/load_test'))
+    return items
+
+
+def run_item(converter, item):
+    """
+    run the converter on one item as an execution of the service
+
+    :return: dict of the item id, wall time and error
+    """
+    tic = time.time()
+    error = None
+    try:
+        converter.run(item=item, context=fake_platform.Context())
+    except Exception as e:
+        error = str(e)[-500:]
+    return {'item_id': item.id, 'wall_time': time.time() - tic, 'error': error}
+
+
+def summarize(results, metrics_lines, platform, wall_time):
+    """
+    the load test report - throughput, run() latency percentiles, platform calls and retries
+    """
+    latencies = np.array([result['wall_time'] for result in results], dtype=np.float64)
+    succeeded = [result for result in results if result['error'] is None]
+    metrics = [json.loads(line) for line in metrics_lines if line.strip()]
+    tries = Counter(m['tries'] for m in metrics)
+    api_calls = Counter()
+    for m in metrics:
+        api_calls.update(m['api_calls'])
+    return {
+        'items': len(results),
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded),
+        'wall_time': round(wall_time, 3),
+        'throughput': round(len(succeeded) / wall_time, 3) if wall_time > 0 else None,
+        'latency': {'p{}'.format(p): round(float(v), 3)
+                    for p, v in zip(PERCENTILES, np.percentile(latencies, PERCENTILES))} if len(results) else {},
+        'latency_mean': round(float(np.mean(latencies)), 3) if len(results) else None,
+        # tries per item - 1 is a first time success, NUM_RETRIES and failed is an exhausted item
+        'tries': {str(n): count for n, count in sorted(tries.items())},
+        'retried_items': sum(count for n, count in tries.items() if n > 1),
+        'api_calls_per_item': round(sum(api_calls.values()) / max(1, len(metrics)), 2),
+        'item_api_calls': dict(api_calls),
+        'platform': platform.report(),
+        'errors': Counter(result['error'].strip().splitlines()[-1] for result in results
+                          if result['error'] and result['error'].strip()).most_common(10)
+    }
+
+
+def parse_failure_rates(values):
+    failure_rates = dict()
+    for value in values:
+        name, rate = value.split('=')
+        failure_rates[name] = float(rate)
+    return failure_rates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load test of WebmConverter.run on a fake platform')
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4, help='executions running at the same time')
+    parser.add_argument('--method', default=ConversionMethod.FFMPEG)
+    parser.add_argument('--profile', default='realtime', help='encoder profile, empty string for the ffmpeg defaults')
+    parser.add_argument('--verification', default=VerificationLevel.FAST)
+    parser.add_argument('--resolutions', nargs='+', default=DEFAULT_RESOLUTIONS)
+    parser.add_argument('--durations', nargs='+', type=int, default=DEFAULT_DURATIONS)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds of a platform call')
+    parser.add_argument('--jitter', type=float, default=0.5, help='latency varies by +- this fraction')
+    parser.add_argument('--bandwidth-mb', type=float, default=0, help='MB/s of downloads and uploads, 0 unlimited')
+    parser.add_argument('--fail', nargs='*', default=list(),
+                        help='failure rates of platform calls e.g upload=0.1 download=0.05 *=0.01')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--clips-dir', default=benchmark.DEFAULT_CLIPS_DIR)
+    parser.add_argument('--workdir', default='.load_test')
+    parser.add_argument('--output', help='json output path, stdout when missing')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    PLATFORM.latency = args.latency
+    PLATFORM.jitter = args.jitter
+    PLATFORM.bandwidth = args.bandwidth_mb * 1024 * 1024 if args.bandwidth_mb else None
+    PLATFORM.failure_rates = parse_failure_rates(values=args.fail)
+    PLATFORM.seed(args.seed)
+
+    os.makedirs(args.clips_dir, exist_ok=True)
+    clips = list()
+    for resolution, duration in itertools.product(args.resolutions, args.durations):
+        width, height = [int(v) for v in resolution.split('x')]
+        clips.append(benchmark.generate_clip(clips_dir=args.clips_dir,
+                                             width=width,
+                                             height=height,
+                                             fps='25',
+                                             duration=duration,
+                                             audio=True))
+    items = make_items(platform=PLATFORM, clips=clips, nb_items=args.items)
+
+    metrics_filepath = os.path.join(args.workdir, 'metrics.jsonl')
+    if os.path.isfile(metrics_filepath):
+        os.remove(metrics_filepath)
+    converter = WebmConverter(method=args.method,
+                              encoder_profile=args.profile or None,
+                              verification=args.verification,
+                              metrics_json_path=metrics_filepath,
+                              scratch_root=os.path.join(args.workdir, 'scratch'),
+                              concurrency=args.concurrency,
+                              cache_lookup_platform=False)
+
+    logger.warning('running {} items, concurrency {}'.format(len(items), args.concurrency))
+    tic = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda item: run_item(converter=converter, item=item), items))
+    wall_time = time.time() - tic
+    # the failures of the open alert windows
+    converter.alerts.flush()
+
+    with open(metrics_filepath) as f:
+        report = summarize(results=results, metrics_lines=f.readlines(), platform=PLATFORM, wall_time=wall_time)
+    report['config'] = vars(args)
+    shutil.rmtree(PLATFORM.root_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,41 +8,39 @@ class MailHandler(dl.BaseServiceRunner):
     def __init__(self, service_name: str):
         self.service_name = service_name
 
-    def send_mail(self, email: str, item: dl.Item, msg: str):
+    def send_digest(self, email: str, project_id, dataset_id, failures, nb_failures):
+        """
+        one mail for the failed items of a dataset
+
+        :param str email: the creator of the items
+        :param str project_id: project of the dataset
+        :param str dataset_id: the dataset
+        :param list failures: dicts of item_id, name, url, execution_id and msg, the first failures of the window
+        :param int nb_failures: number of failed items, more than the listed ones when the list was full
+        """
         try:
+            project = dl.projects.get(project_id=project_id)
+            dataset = project.datasets.get(dataset_id=dataset_id)
+            rows = ['<br> Item: {} ({}) <br> Execution ID: {} <br> Item URL: {} <br> Failure message: {} <br>'.format(
+                failure['name'],
+                failure['item_id'],
+                failure['execution_id'],
+                failure['url'],
+                failure['msg']) for failure in failures]
+            if nb_failures > len(failures):
+                rows.append('<br> and {} more items'.format(nb_failures - len(failures)))
             # noinspection PyProtectedMember
-            executions = item.resource_executions.list()
-            execution_id = ''
-            for page in executions:
-                for exe in page:
-                    if exe.package_name == self.service_name:
-                        execution_id = exe.execution_id
             dl.projects._send_mail(
-                project_id=item.project_id,
+                project_id=project_id,
                 send_to=email,
-                title='Dataloop WEBM Conversion failed on item :  {}'.format(item.id),
-                content='A video file in your project failed the process of conversion into WEBM format.'
-                        ' Please read the description below and correct the file as needed – it may contain corrupted headers,'
-                        ' frames and metadata, causing the conversion process to fail and preventing annotation work on this item. '
-                        '<br> Project: {} <br> Dataset: {} <br> Item ID: {} <br> Execution ID: {} <br> Item URL: {} <br> Failure message: {}'.format(
-                    item.project.name,
-                    item.dataset.name,
-                    item.id,
-                    execution_id,
-                    item.platform_url,
-                    msg
-                )
+                title='Dataloop WEBM Conversion failed on {} items of dataset {}'.format(nb_failures, dataset.name),
+                content='Video files in your project failed the process of conversion into WEBM format.'
+                        ' Please read the descriptions below and correct the files as needed – they may contain corrupted headers,'
+                        ' frames and metadata, causing the conversion process to fail and preventing annotation work on these items. '
+                        '<br> Project: {} <br> Dataset: {} <br> Failed items: {} <br> {}'.format(project.name,
+                                                                                               dataset.name,
+                                                                                               nb_failures,
+                                                                                               ''.join(rows))
             )
         except Exception:
             logger.exception('Failed to send mail to {}'.format(email))
-
-    def send_alert(self, item: dl.Item, msg):
-        try:
-            item.metadata['system']['{}_fail'.format(self.service_name)] = msg
-            item.update(system_metadata=True)
-            for email in [
-                item.creator
-            ]:
-                self.send_mail(email=email, item=item, msg=msg)
-        except:
-            logger.exception('Failed to send mail')
@@ -0,0 +1,102 @@
+import dtlpy as dl
+import threading
+import logging
+
+import video_utilities
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataSession:
+    """
+    platform writes of one item conversion - errors, fail flags, system fields and modality changes are applied to
+    the item metadata locally and sent in a single update by flush(), at the end of the pipeline or on failure
+    counts the api calls of the item on its metrics
+    """
+
+    def __init__(self, item: dl.Item, metrics=None, alerts=None):
+        """
+        :param dl.Item item: the converted item
+        :param ItemMetrics metrics: counts the api calls
+        :param AlertAggregator alerts: collects the error notification in a digest, sent right away when None
+        """
+        self.item = item
+        self.metrics = metrics
+        self.alerts = alerts
+        self._pending = False
+        self._modalities_changed = False
+        self._error_event = False
+        # the verification and the upload stages run at the same time
+        self._lock = threading.RLock()
+
+    def count(self, name, n=1):
+        """
+        count api calls of the item, by kind e.g item_update, upload, download
+        """
+        if self.metrics is not None:
+            self.metrics.count_api_call(name=name, n=n)
+
+    def add_errors(self, error_dicts, error_event=False):
+        """
+        add errors to the item, an error of a type that is already there replaces it
+
+        :param list error_dicts: list of the errors (video_utilities.error_dict)
+        :param bool error_event: also publish the conversion failed notification on flush
+        """
+        with self._lock:
+            video_utilities.add_item_errors(item=self.item, error_dicts=error_dicts)
+            self._error_event = self._error_event or error_event
+            self._pending = True
+
+    def clean(self, service_name):
+        """
+        remove the errors and the fail flag of the service, before a new try
+        """
+        with self._lock:
+            video_utilities.clean_item(item=self.item, service_name=service_name)
+            self._pending = True
+
+    def set_system(self, key, value):
+        with self._lock:
+            self.item.metadata['system'][key] = value
+            self._pending = True
+
+    def fail(self, service_name, msg):
+        self.set_system(key='{}_fail'.format(service_name), value=msg)
+
+    def modalities_changed(self):
+        """
+        the item modalities were changed with item.modalities, flush() also updates them on the clones of the item
+        """
+        with self._lock:
+            self._modalities_changed = True
+            self._pending = True
+
+    def flush(self):
+        """
+        send the pending changes - one item update, the modalities of the clones when changed, the notification
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            self.item.update(system_metadata=True)
+            self.count(name='item_update')
+            if self._modalities_changed:
+                # no fetch of the dataset entity for its items repository
+                dataset = dl.datasets.get(fetch=False, dataset_id=self.item.datasetId)
+                modalities = self.item.metadata['system'].get('modalities', [])
+                dataset.items.update(filters=dl.Filters(field='spec.parentDatasetItemId',
+                                                        values=self.item.id,
+                                                        use_defaults=False),
+                                     system_update_values={'modalities': modalities},
+                                     system_metadata=True)
+                self.count(name='clones_update')
+            if self._error_event:
+                if self.alerts is not None:
+                    self.alerts.add_event(item=self.item)
+                else:
+                    video_utilities.send_error_event(item=self.item)
+                    self.count(name='notification')
+            self._pending = False
+            self._modalities_changed = False
+            self._error_event = False
@@ -0,0 +1,181 @@
+"""
+Dataset pre-flight audit
+
+Reads the platform metadata of the video items of a dataset page by page, without downloading anything, and runs
+the checks of validate_metadata and validate_video on all of them at once. Lists the items that will fail or whose
+frame count mismatches fps x duration, and sums the conversion cost to size a backfill.
+
+    python preflight_audit.py --dataset-id <dataset id> --output audit.json
+    python preflight_audit.py --dataset-id <dataset id> --query '{"filter": {"dir": "/videos"}}'
+"""
+import numpy as np
+import dtlpy as dl
+import argparse
+import logging
+import json
+
+from resource_manager import ResourceManager
+import video_utilities
+
+logger = logging.getLogger(__name__)
+PAGE_SIZE = 1000
+# metadata validate_metadata requires, the frame count is checked apart
+REQUIRED_FIELDS = ['height', 'width', 'fps', 'duration']
+
+
+def _number(value):
+    try:
+        return float(value) if value is not None else np.nan
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def item_row(item: dl.Item):
+    """
+    the metadata the converter reads from an item that is already probed by the platform (see _probe_stage)
+
+    :return: dict of the item id, has ffmpeg metadata, fps, duration, start time, frames, height, width, size
+    """
+    system = item.metadata.get('system', dict())
+    ffmpeg = system.get('ffmpeg', None) or dict()
+    return {
+        'id': item.id,
+        'probed': bool(ffmpeg) and 'nb_read_frames' in ffmpeg,
+        'fps': _number(item.metadata.get('fps', None)),
+        'duration': _number(system.get('duration', None)),
+        'start_time': _number(item.metadata.get('startTime', 0)),
+        'frames': _number(ffmpeg.get('nb_read_frames', None)),
+        'height': _number(system.get('height', None) or ffmpeg.get('height', None)),
+        'width': _number(system.get('width', None) or ffmpeg.get('width', None)),
+        'size': _number(system.get('size', None))
+    }
+
+
+def expected_frames(fps, duration, start_time):
+    """
+    validate_video on arrays - the expected frame count and its rounding, nan where fps or duration is unknown
+
+    :return: np.ndarray of fps x duration (truncated to 1/100 s) and of the candidate rounding
+    """
+    start_time = np.where(np.isnan(start_time), 0, start_time)
+    exp_frames_count = fps * np.trunc((duration - start_time) * 100) / 100
+    return exp_frames_count, np.round(exp_frames_count), np.floor(exp_frames_count) + 1
+
+
+def frames_mismatch(fps, duration, start_time, frames):
+    """
+    items whose frame count is not fps x duration, the same rule as validate_video
+
+    :return: boolean np.ndarray, the expected frames np.ndarray
+    """
+    exp_frames_count, rounded, rounded_up = expected_frames(fps=fps, duration=duration, start_time=start_time)
+    exp_frames = np.where((rounded == rounded_up) | (rounded == frames), rounded, rounded_up)
+    # validate_video passes when one of the values is missing or 0
+    known = (fps > 0) & (duration > 0) & (frames > 0)
+    with np.errstate(invalid='ignore'):
+        mismatch = known & (exp_frames != frames) & (np.abs(exp_frames_count - frames) > 0.5)
+    return mismatch, exp_frames
+
+
+def audit_rows(rows):
+    """
+    run the checks on the metadata rows of the items
+
+    :param list rows: dicts of item_row
+    :return: dict report - counts, the failing item ids by reason and the conversion cost
+    """
+    ids = np.array([row['id'] for row in rows], dtype=object)
+    probed = np.array([row['probed'] for row in rows], dtype=bool)
+    columns = {key: np.array([row[key] for row in rows], dtype=np.float64)
+               for key in ['fps', 'duration', 'start_time', 'frames', 'height', 'width', 'size']}
+
+    # validate_metadata - a zero or a missing value fails the conversion
+    missing = np.zeros((len(rows), len(REQUIRED_FIELDS) + 1), dtype=bool)
+    for i_field, field in enumerate(REQUIRED_FIELDS):
+        missing[:, i_field] = ~(columns[field] > 0)
+    missing[:, -1] = np.isnan(columns['frames'])
+    # items without ffmpeg metadata are probed by the converter, their metadata is not known yet
+    missing &= probed[:, None]
+    missing_names = np.array(REQUIRED_FIELDS + ['nb_read_frames'])
+
+    mismatch, exp_frames = frames_mismatch(fps=columns['fps'],
+                                           duration=columns['duration'],
+                                           start_time=columns['start_time'],
+                                           frames=columns['frames'])
+    mismatch &= probed & ~missing.any(axis=1)
+
+    # conversion cost - frames x pixels, the disk of a download conversion
+    frames = np.where(np.isnan(columns['frames']), columns['duration'] * columns['fps'], columns['frames'])
+    pixels = np.nan_to_num(frames * columns['height'] * columns['width'])
+    sizes = np.nan_to_num(columns['size'])
+
+    failing = missing.any(axis=1)
+    report = {
+        'items': len(rows),
+        'ok': int(np.sum(probed & ~failing & ~mismatch)),
+        'unprobed': ids[~probed].tolist(),
+        'missing_metadata': {item_id: missing_names[row].tolist()
+                             for item_id, row in zip(ids[failing], missing[failing])},
+        'frames_mismatch': {item_id: {'frames': int(frames_count), 'expected': int(expected)}
+                            for item_id, frames_count, expected in zip(ids[mismatch],
+                                                                       columns['frames'][mismatch],
+                                                                       exp_frames[mismatch])},
+        'cost': {
+            'gigapixels': round(float(np.sum(pixels)) / 1e9, 3),
+            'video_hours': round(float(np.nansum(columns['duration'])) / 3600, 3),
+            'input_bytes': int(np.sum(sizes)),
+            # the disk estimate grows with the size, the biggest item sizes the scratch disk
+            'max_item_disk_bytes': ResourceManager.estimate_disk_bytes(size=float(np.max(sizes))) if len(rows) else 0,
+            'unknown_cost_items': int(np.sum(pixels == 0))
+        }
+    }
+    return report
+
+
+def audit_dataset(dataset: dl.Dataset, query=None, page_size=PAGE_SIZE):
+    """
+    audit the video items of a dataset from their platform metadata, nothing is downloaded
+
+    :param dl.Dataset dataset: the dataset
+    :param dict query: dl.Filters custom filter, the items of the service trigger when None
+    :param int page_size: items per page of the query
+    :return: dict report, see audit_rows
+    """
+    filters = dl.Filters(custom_filter=query if query is not None else video_utilities.trigger_query())
+    filters.page_size = page_size
+    rows = list()
+    for page in dataset.items.list(filters=filters):
+        rows.extend(item_row(item=item) for item in page)
+    report = audit_rows(rows=rows)
+    logger.info('[webm-converter] audit of dataset {}: {} items, {} ok, {} unprobed, {} missing metadata, '
+                '{} frames mismatch'.format(dataset.id,
+                                            report['items'],
+                                            report['ok'],
+                                            len(report['unprobed']),
+                                            len(report['missing_metadata']),
+                                            len(report['frames_mismatch'])))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-flight audit of the video items of a dataset')
+    parser.add_argument('--dataset-id', required=True)
+    parser.add_argument('--query', default=None, help='dl.Filters custom filter as json')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--output', default=None, help='json report path, printed when not set')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    dataset = dl.datasets.get(dataset_id=args.dataset_id)
+    report = audit_dataset(dataset=dataset,
+                           query=json.loads(args.query) if args.query else None,
+                           page_size=args.page_size)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
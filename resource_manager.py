@@ -0,0 +1,123 @@
+import threading
+import tempfile
+import logging
+import shutil
+import os
+
+import video_utilities
+
+logger = logging.getLogger(__name__)
+# the webm is estimated at the size of the source, segmented encoding keeps another copy of the source
+OUTPUT_SIZE_FACTOR = 1.0
+SEGMENTS_SIZE_FACTOR = 1.0
+# part of the free disk of the scratch root used when no budget is given
+DEFAULT_DISK_FRACTION = 0.9
+
+
+class Allocation:
+    """
+    resources of one execution - its own scratch dir, the disk it reserved and its share of the cpus
+    """
+
+    def __init__(self, manager, workdir, disk_bytes, threads):
+        self.manager = manager
+        self.workdir = workdir
+        self.disk_bytes = disk_bytes
+        self.threads = threads
+        self._released = False
+
+    def release(self, keep_workdir=False):
+        """
+        give back the disk reservation and remove the scratch dir
+
+        :param bool keep_workdir: keep the scratch dir, the caller removes it later
+        """
+        if self._released:
+            return
+        self._released = True
+        if not keep_workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        self.manager._release(allocation=self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class ResourceManager:
+    """
+    share the disk and the cpus of the pod between the executions running at the same time in this process
+    every execution gets a unique scratch dir under scratch_root, waits until its estimated disk usage fits the
+    budget, and gets cpus / concurrency ffmpeg threads
+    """
+
+    def __init__(self, scratch_root=None, disk_budget_bytes=None, concurrency=1):
+        self.scratch_root = scratch_root or os.path.join(os.getcwd(), 'workdirs')
+        os.makedirs(self.scratch_root, exist_ok=True)
+        if not disk_budget_bytes:
+            disk_budget_bytes = int(shutil.disk_usage(self.scratch_root).free * DEFAULT_DISK_FRACTION)
+        self.disk_budget_bytes = disk_budget_bytes
+        self.concurrency = max(1, concurrency or 1)
+        self.threads = max(1, video_utilities.available_cpus() // self.concurrency)
+        self.reserved_bytes = 0
+        self._active = 0
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def estimate_disk_bytes(size, downloaded=True, segmented=False):
+        """
+        disk needed to convert a source of size bytes
+
+        :param int size: the source size in bytes
+        :param bool downloaded: the source is downloaded to the scratch dir (not streamed)
+        :param bool segmented: segmented encoding keeps the segments of the source
+        """
+        size = size or 0
+        estimate = size * OUTPUT_SIZE_FACTOR
+        if downloaded:
+            estimate += size
+        if segmented:
+            estimate += size * SEGMENTS_SIZE_FACTOR
+        return int(estimate)
+
+    def acquire(self, name, disk_bytes, timeout=None, workdir=None):
+        """
+        wait until the disk reservation fits the budget and create the scratch dir
+        an execution bigger than the whole budget runs alone instead of waiting forever
+
+        :param str name: prefix of the scratch dir, e.g the item id
+        :param int disk_bytes: estimated disk usage
+        :param float timeout: seconds to wait for the disk, None waits until there is room
+        :param str workdir: existing scratch dir to take over instead of creating one, e.g of a failed try
+
+        :return: Allocation
+        """
+        with self._condition:
+            admitted = self._condition.wait_for(
+                lambda: self._active == 0 or self.reserved_bytes + disk_bytes <= self.disk_budget_bytes,
+                timeout=timeout)
+            if not admitted:
+                raise TimeoutError('no disk for {} bytes, {} of {} reserved'.format(disk_bytes,
+                                                                                   self.reserved_bytes,
+                                                                                   self.disk_budget_bytes))
+            self.reserved_bytes += disk_bytes
+            self._active += 1
+        try:
+            if workdir is None:
+                workdir = tempfile.mkdtemp(prefix='{}-'.format(name), dir=self.scratch_root)
+        except Exception:
+            with self._condition:
+                self.reserved_bytes -= disk_bytes
+                self._active -= 1
+                self._condition.notify_all()
+            raise
+        logger.debug('allocated {} - {} bytes, {} threads'.format(workdir, disk_bytes, self.threads))
+        return Allocation(manager=self, workdir=workdir, disk_bytes=disk_bytes, threads=self.threads)
+
+    def _release(self, allocation):
+        with self._condition:
+            self.reserved_bytes -= allocation.disk_bytes
+            self._active -= 1
+            self._condition.notify_all()
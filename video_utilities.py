@@ -1,43 +1,369 @@
 import math
+from collections import deque
 from copy import deepcopy
 
+import numpy as np
 import dtlpy as dl
+import instrumentation
+import contextvars
+import contextlib
 import subprocess
+import selectors
+import signal
+import functools
 import logging
 import json
+import glob
+import time
+import os
 
 logger = logging.getLogger(__name__)
 NUM_TRIES_COMMAND = 1
+# lines of stderr kept for the error message of a failed command
+STDERR_TAIL_LINES = 100
+READ_SIZE = 65536
+# codecs that the webm container and the browsers play as is
+WEB_VIDEO_CODECS = ['vp8', 'vp9', 'av1']
+WEB_AUDIO_CODECS = ['opus', 'vorbis']
+# frame locations kept in the value of a packet timestamps error
+MAX_ERROR_LOCATIONS = 10
+# seconds between two timestamps that are the same timestamp
+PTS_EPSILON = 1e-4
+# org id by project id, for the notifications
+_project_org_ids = dict()
+# seconds without progress before a command is killed as stalled
+STALL_TIMEOUT = 120
+# seconds between two watchdog checks
+WATCHDOG_INTERVAL = 1
+# items the service converts - video files up to 0.5GB with an fps, not the webm outputs (the deploy trigger filter)
+TRIGGER_FILTER = {
+    '$and': [
+        {'metadata.system.mimetype': {'$eq': 'video*'}},
+        {'metadata.system.size': {'$lt': 536870912}},
+        {'metadata.system.mimetype': {'$ne': 'video/webm'}},
+        {'metadata.system.fps': {'$gt': 0}},
+        {'hidden': False},
+        {'type': 'file'}
+    ]
+}
+# runs the commands of execute_cmd instead of a local process, set by the async engine for its pipeline threads
+_command_runner = contextvars.ContextVar('command_runner', default=None)
+# wall clock budget of a stage: (base seconds, seconds per second of video)
+STAGE_BUDGETS = {
+    'probe': (120, 0.5),
+    'split': (120, 0.5),
+    'encode': (300, 10),
+    'mux': (120, 1),
+    'verify': (120, 0.5)
+}
+
+
+class CommandStalledError(Exception):
+    """
+    the command made no progress for longer than the stall timeout and was killed
+    """
+
+
+class CommandTimeoutError(Exception):
+    """
+    the command ran longer than its wall clock budget and was killed
+    """
+
+
+class CommandCancelledError(Exception):
+    """
+    the execution was cancelled, its running command was killed
+    """
+
+
+@contextlib.contextmanager
+def command_runner(runner):
+    """
+    run the commands of execute_cmd in this thread with runner, see async_engine.AsyncEngine
+
+    :param runner: callable getting the arguments of execute_cmd, returns the command output
+    """
+    token = _command_runner.set(runner)
+    try:
+        yield
+    finally:
+        _command_runner.reset(token)
+
+
+def bind_command_runner(fn):
+    """
+    fn with the command runner and the metrics stage of the calling thread, for the pool threads of a stage
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        # a context is entered by one thread at a time, every call gets its own copy
+        return context.copy().run(fn, *args, **kwargs)
+
+    return wrapper
+
+
+def progress_cmd(cmd, progress_fd):
+    """
+    the ffmpeg command with its progress report on progress_fd, the stats line is dropped
+    global options go right after the binary
+    """
+    return [cmd[0], '-progress', 'pipe:{}'.format(progress_fd), '-nostats', *cmd[1:]]
+
+
+class FfmpegProgress:
+    """
+    parse the key=value output of ffmpeg `-progress` into snapshots, one snapshot per `progress=` line
+    and follow the work on a dl.Progress in whole percents
+    """
+    # minimal seconds between two dl.Progress updates
+    MIN_UPDATE_INTERVAL = 1
+
+    def __init__(self, progress: dl.Progress = None, nb_frames=None, on_progress=None):
+        self.progress = progress
+        self.nb_frames = nb_frames
+        self.on_progress = on_progress
+        self.current = dict()
+        self.last = dict()
+        self._buffer = b''
+        self._last_percent = 0
+        self._last_update = 0
+        # monotonic time of the last report that moved frame, out_time or total_size forward
+        self.advanced_at = time.monotonic()
+
+    @staticmethod
+    def _number(value, suffix=''):
+        value = value.strip()
+        if suffix and value.endswith(suffix):
+            value = value[:-len(suffix)]
+        try:
+            return float(value)
+        except ValueError:
+            # N/A at the start of the encode
+            return None
+
+    def feed(self, data: bytes):
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            key, _, value = line.decode('utf-8', errors='replace').strip().partition('=')
+            if not key:
+                continue
+            self.current[key] = value
+            if key == 'progress':
+                self._snapshot()
+
+    def _snapshot(self):
+        out_time_us = self._number(self.current.get('out_time_us', 'N/A'))
+        frame = self._number(self.current.get('frame', 'N/A'))
+        total_size = self._number(self.current.get('total_size', 'N/A'))
+        previous = self.last
+        self.last = {
+            'frame': int(frame) if frame is not None else None,
+            'fps': self._number(self.current.get('fps', 'N/A')),
+            'speed': self._number(self.current.get('speed', 'N/A'), suffix='x'),
+            'out_time': out_time_us / 1000000 if out_time_us is not None else None,
+            'bitrate': self._number(self.current.get('bitrate', 'N/A'), suffix='kbits/s'),
+            'total_size': int(total_size) if total_size is not None else None,
+            'progress': self.current.get('progress')
+        }
+        self.current = dict()
+        if self._advanced(previous=previous):
+            self.advanced_at = time.monotonic()
+        if self.on_progress is not None:
+            self.on_progress(self.last)
+        self._update_progress()
+
+    def _advanced(self, previous):
+        for key in ['frame', 'out_time', 'total_size']:
+            if self.last[key] is not None and self.last[key] != previous.get(key, None):
+                return True
+        return False
+
+    def _update_progress(self):
+        if self.progress is None or not self.nb_frames or self.last['frame'] is None:
+            return
+        percent = min(100, int(100 * self.last['frame'] / self.nb_frames))
+        now = time.time()
+        if percent > self._last_percent and now - self._last_update >= self.MIN_UPDATE_INTERVAL:
+            self.progress.update(progress=percent)
+            self._last_percent = percent
+            self._last_update = now
+
+
+class OutputTail:
+    """
+    keep the last lines of a stream, ffmpeg `\r` status lines are split as well
+    """
+
+    def __init__(self, max_lines=STDERR_TAIL_LINES):
+        self.lines = deque(maxlen=max_lines)
+        self._buffer = b''
+
+    def feed(self, data: bytes):
+        self._buffer += data.replace(b'\r', b'\n')
+        *lines, self._buffer = self._buffer.split(b'\n')
+        self.lines.extend(line for line in lines if line.strip())
+        # a single line without a new line should not grow forever
+        self._buffer = self._buffer[-READ_SIZE:]
+
+    def text(self):
+        lines = list(self.lines)
+        if self._buffer.strip():
+            lines.append(self._buffer)
+        return b'\n'.join(lines).decode('utf-8', errors='replace')
+
+
+def _wait_process(proc):
+    """
+    wait for the process with os.wait4 in place of Popen.wait, for the resource usage of the process itself
+    Popen.wait / poll / kill must not be called before, they reap the process without its resource usage
+
+    :return: cpu seconds (user + system) and peak rss in MB of the process
+    """
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KB on linux
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
 
 
-def execute_cmd(cmd, progress: dl.Progress = None, nb_frames=None):
+def process_usage(pid):
+    """
+    cpu seconds (user + system) and peak rss in MB of a running process from /proc, None when it is gone
+    the rss of an exited process that was not waited yet is 0
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # the command name may hold spaces, the fields after it start at the state (field 3)
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu_time = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        peak_rss_mb = 0
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    peak_rss_mb = int(line.split()[1]) / 1024
+                    break
+    except (OSError, IndexError, ValueError):
+        return None
+    return cpu_time, peak_rss_mb
+
+
+def _run_process(cmd, progress_parser=None, stdin=None, timeout=None, stall_timeout=None):
+    """
+    run a command, read stdout, stderr and the ffmpeg progress pipe as they are written
+    a watchdog kills the command when it runs longer than timeout or makes no progress for stall_timeout.
+    progress is the ffmpeg progress report moving forward, any output for other commands.
+    the cpu time and peak rss of the command go to the metrics stage of the calling thread
+
+    :return: return code, stdout and the stderr tail
+    """
+    pass_fds = ()
+    progress_read = None
+    if progress_parser is not None:
+        progress_read, progress_write = os.pipe()
+        cmd = progress_cmd(cmd=cmd, progress_fd=progress_write)
+        pass_fds = (progress_write,)
+    try:
+        proc = subprocess.Popen(cmd,
+                                stdin=stdin,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                pass_fds=pass_fds)
+    except Exception:
+        if progress_read is not None:
+            os.close(progress_read)
+        raise
+    finally:
+        if progress_read is not None:
+            # the child has its own copy, closing ours gives EOF when the child exits
+            os.close(progress_write)
+
+    stdout_chunks = list()
+    stderr_tail = OutputTail()
+    selector = selectors.DefaultSelector()
+    selector.register(proc.stdout, selectors.EVENT_READ, stdout_chunks.append)
+    selector.register(proc.stderr, selectors.EVENT_READ, stderr_tail.feed)
+    if progress_read is not None:
+        selector.register(progress_read, selectors.EVENT_READ, progress_parser.feed)
+    select_timeout = WATCHDOG_INTERVAL if timeout or stall_timeout else None
+    started_at = last_read_at = time.monotonic()
+    try:
+        while selector.get_map():
+            for key, _ in selector.select(timeout=select_timeout):
+                data = os.read(key.fd, READ_SIZE)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    continue
+                last_read_at = time.monotonic()
+                key.data(data)
+            now = time.monotonic()
+            if timeout and now - started_at > timeout:
+                raise CommandTimeoutError('{} exceeded its time budget of {}[s]\nstderr:{}'.format(
+                    cmd[0], timeout, stderr_tail.text()))
+            advanced_at = progress_parser.advanced_at if progress_parser is not None else last_read_at
+            if stall_timeout and now - advanced_at > stall_timeout:
+                raise CommandStalledError('{} stalled, no progress for {}[s]\nstderr:{}'.format(
+                    cmd[0], stall_timeout, stderr_tail.text()))
+        usage = _wait_process(proc)
+    finally:
+        selector.close()
+        if proc.returncode is None:
+            # not Popen.kill, it reaps an exited process without its resource usage. the pid is kept until waited
+            os.kill(proc.pid, signal.SIGKILL)
+            usage = _wait_process(proc)
+        instrumentation.record_command_usage(*usage)
+        proc.stdout.close()
+        proc.stderr.close()
+        if progress_read is not None:
+            os.close(progress_read)
+    return proc.returncode, b''.join(stdout_chunks), stderr_tail.text()
+
+
+def execute_cmd(cmd,
+                progress: dl.Progress = None,
+                nb_frames=None,
+                on_progress=None,
+                stdin=None,
+                timeout=None,
+                stall_timeout=None):
     """
     execute bash command
+    ffmpeg commands report their progress on a dedicated `-progress` pipe, only the tail of stderr is kept.
+    a killed command raises CommandTimeoutError / CommandStalledError and is not tried again
 
     :param list cmd: list of the bash command
     :param dl.Progress progress: progress object, to follow thw work Progress
     :param int nb_frames: number of frames
+    :param on_progress: callable getting a dict with frame, fps, speed, out_time[s], bitrate[kbits/s],
+                        total_size and progress ('continue'/'end') on every ffmpeg progress report
+    :param stdin: file object / fd for the command stdin
+    :param float timeout: wall clock budget in seconds, None for no limit
+    :param float stall_timeout: seconds without progress before the command is killed, None for no limit
 
     :return: the command output
     """
+    runner = _command_runner.get()
+    if runner is not None:
+        return runner(cmd=cmd,
+                      progress=progress,
+                      nb_frames=nb_frames,
+                      on_progress=on_progress,
+                      stdin=stdin,
+                      timeout=timeout,
+                      stall_timeout=stall_timeout)
     exception = ''
-    progress_conv = 10
     for _ in range(NUM_TRIES_COMMAND):
-        if progress is not None and nb_frames is not None:
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-            while proc.poll() is None:
-                line = proc.stdout.readline()
-                if progress is not None:
-                    if 'frame=' in line:
-                        frames = int(line.split('=')[1].split('f')[0].strip())
-                        if frames / nb_frames >= progress_conv / 100:
-                            progress.update(progress=progress_conv)
-                            progress_conv += 10
-        else:
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        outs, errs = proc.communicate()
-
-        if proc.returncode == 0:
+        progress_parser = None
+        if os.path.basename(cmd[0]) == 'ffmpeg':
+            progress_parser = FfmpegProgress(progress=progress, nb_frames=nb_frames, on_progress=on_progress)
+        returncode, outs, errs = _run_process(cmd=cmd,
+                                              progress_parser=progress_parser,
+                                              stdin=stdin,
+                                              timeout=timeout,
+                                              stall_timeout=stall_timeout)
+
+        if returncode == 0:
             # if success return the result
             logger.debug(outs)
             return outs
@@ -48,43 +374,347 @@ def execute_cmd(cmd, progress: dl.Progress = None, nb_frames=None):
     raise Exception(exception)
 
 
-def extract_metadata(item_stream, with_headers=False):
+def stage_timeout(stage, duration=None, nb_frames=None, fps=None):
+    """
+    wall clock budget of a stage, scaled to the length of the video
+
+    :param str stage: one of STAGE_BUDGETS
+    :param float duration: video duration in seconds
+    :param int nb_frames: number of frames, used with fps when the duration is unknown
+    :param float fps: frames per second
+
+    :return: budget in seconds, None when the length of the video is unknown
+    """
+    if not duration and nb_frames and fps:
+        duration = nb_frames / fps
+    if not duration:
+        return None
+    base, per_second = STAGE_BUDGETS[stage]
+    return base + per_second * float(duration)
+
+
+def trigger_query():
+    """
+    dl.Filters custom filter of the items of the trigger, for the dataset queries of a batch / an audit
+    """
+    return {'filter': deepcopy(TRIGGER_FILTER)}
+
+
+def stream_input_options():
+    """
+    ffmpeg/ffprobe input options for reading an item stream url directly from the platform
+    authorization header and reconnect on dropped connections, must be placed before the `-i` of the stream
+
+    :return: list of the input options
+    """
+    return ['-headers',
+            "{}:{}".format('authorization', dl.client_api.auth['authorization']),
+            '-reconnect', '1',
+            '-reconnect_streamed', '1',
+            '-reconnect_on_network_error', '1',
+            '-reconnect_delay_max', '30']
+
+
+def available_cpus():
+    """
+    number of cpus this process may use, respects the cpu affinity and the container cgroup quota
+
+    :return: number of cpus
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        # cgroup v2 - "<quota> <period>" or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def split_at_keyframes(input_filepath,
+                       output_dir,
+                       segment_duration,
+                       with_headers=False,
+                       timeout=None,
+                       stall_timeout=None):
+    """
+    split the video stream of the input into segments without re-encoding
+    stream copy can only cut on keyframes, so each segment starts with a keyframe and is
+    about segment_duration long
+
+    :param str input_filepath: the file path / stream to split
+    :param str output_dir: dir for the segment files
+    :param float segment_duration: target length of each segment in seconds
+    :param bool with_headers: input is an item stream url
+    :param float timeout: wall clock budget in seconds
+    :param float stall_timeout: seconds without progress before the split is killed
+
+    :return: sorted list of the segment file paths
+    """
+    input_options = stream_input_options() if with_headers else []
+    cmd = ['ffmpeg',
+           *input_options,
+           '-i', input_filepath,
+           '-map', '0:v:0',
+           '-c', 'copy',
+           '-f', 'segment',
+           '-segment_time', str(segment_duration),
+           '-segment_format', 'matroska',
+           '-reset_timestamps', '1',
+           '-hide_banner',
+           '-y',
+           os.path.join(output_dir, 'segment_%05d.mkv')]
+    execute_cmd(cmd=cmd, timeout=timeout, stall_timeout=stall_timeout)
+    return sorted(glob.glob(os.path.join(output_dir, 'segment_*.mkv')))
+
+
+def count_packets(stream, with_headers=False, timeout=None):
+    """
+    count the video packets of a stream without decoding
+
+    :param str stream: item stream or file path
+    :param bool with_headers: url item or regular
+    :param float timeout: wall clock budget in seconds
+
+    :return: number of video packets
+    """
+    input_options = stream_input_options() if with_headers else []
+    cmd = ['ffprobe',
+           *input_options,
+           '-v', 'error',
+           '-select_streams', 'v:0',
+           '-count_packets',
+           '-show_entries', 'stream=nb_read_packets',
+           '-of', 'json',
+           stream]
+    outs = execute_cmd(cmd=cmd, timeout=timeout)
+    streams = json.loads(outs.decode('utf-8')).get('streams', [])
+    if len(streams) == 0 or streams[0].get('nb_read_packets', None) is None:
+        return None
+    return int(streams[0]['nb_read_packets'])
+
+
+def read_packets(stream, with_headers=False, timeout=None):
+    """
+    read the video packets of a stream in one pass without decoding - their count, timestamps and keyframes
+    webm (vp8/vp9) has one packet per frame in display order, so the packet number is the frame number
+
+    :param str stream: item stream or file path
+    :param bool with_headers: url item or regular
+    :param float timeout: wall clock budget in seconds
+
+    :return: dict of count, pts (sorted np.ndarray in seconds, None when the stream has no packet timestamps) and
+             keyframes (list of [frame number, pts time in seconds, byte offset of the packet in the file])
+    """
+    input_options = stream_input_options() if with_headers else []
+    cmd = ['ffprobe',
+           *input_options,
+           '-v', 'error',
+           '-select_streams', 'v:0',
+           '-show_entries', 'packet=pts_time,pos,flags',
+           '-of', 'csv=print_section=0',
+           stream]
+    outs = execute_cmd(cmd=cmd, timeout=timeout)
+    count = 0
+    pts = list()
+    keyframes = list()
+    for frame, line in enumerate(outs.decode('utf-8').splitlines()):
+        pts_time, pos, flags = (line.split(',') + ['', '', ''])[:3]
+        count += 1
+        # packets are in decode order, raw streams have no pts (N/A)
+        pts_time = float(pts_time) if pts_time not in ['', 'N/A'] else None
+        if pts_time is not None:
+            pts.append(pts_time)
+        if 'K' in flags:
+            keyframes.append([frame, pts_time, int(pos) if pos not in ['', 'N/A'] else None])
+    return {'count': count,
+            'pts': np.sort(np.array(pts, dtype=np.float64)) if len(pts) > 0 else None,
+            'keyframes': keyframes}
+
+
+def keyframe_index(stream, with_headers=False, timeout=None):
+    """
+    list the keyframes of the video stream from its packets, without decoding, see read_packets
+
+    :return: list of [frame number, pts time in seconds, byte offset of the packet in the file]
+    """
+    return read_packets(stream=stream, with_headers=with_headers, timeout=timeout)['keyframes']
+
+
+def max_keyframe_gap(keyframes, duration=None):
+    """
+    longest time between two keyframes of a keyframe_index, the last keyframe runs to the end of the video
+
+    :param list keyframes: list of [frame number, pts time, byte offset], see keyframe_index
+    :param float duration: duration of the video in seconds, None when unknown
+
+    :return: the gap in seconds, None when the keyframes have no timestamps
+    """
+    times = sorted(pts_time for _, pts_time, _ in keyframes if pts_time is not None)
+    if duration is not None and times and float(duration) > times[-1]:
+        times.append(float(duration))
+    if len(times) < 2:
+        return None
+    return max(after - before for before, after in zip(times, times[1:]))
+
+
+def packet_timestamps(stream, with_headers=False, timeout=None):
+    """
+    pts of the video packets of a stream in presentation order, read from the packets without decoding
+
+    :param str stream: item stream or file path
+    :param bool with_headers: url item or regular
+    :param float timeout: wall clock budget in seconds
+
+    :return: sorted np.ndarray of the pts in seconds, None when the stream has no packet timestamps
+    """
+    return read_packets(stream=stream, with_headers=with_headers, timeout=timeout)['pts']
+
+
+def _nearest_distance(values, reference):
+    """
+    distance of every value to the closest one of the sorted reference
+    """
+    index = np.clip(np.searchsorted(reference, values), 1, len(reference) - 1)
+    return np.minimum(np.abs(values - reference[index - 1]), np.abs(values - reference[index]))
+
+
+def _locations(frames, timestamps):
+    return {'count': int(len(frames)),
+            'frames': frames[:MAX_ERROR_LOCATIONS].tolist(),
+            'times': np.round(timestamps[frames[:MAX_ERROR_LOCATIONS]], 3).tolist()}
+
+
+def compare_packet_timestamps(orig_pts, webm_pts, fps, prefix_check='web'):
+    """
+    find the dropped, inserted and duplicated frames and the timestamp drift of the webm against the source
+    both start at 0, a frame matches when a frame of the other stream is within half a frame interval
+
+    :param np.ndarray orig_pts: sorted pts of the source (packet_timestamps)
+    :param np.ndarray webm_pts: sorted pts of the webm
+    :param float fps: fps of the source
+    :param str prefix_check: prefix of the error types
+
+    :return: list of error dicts, the value of each holds the count and the first frames and times
+    """
+    if orig_pts is None or webm_pts is None or len(orig_pts) < 2 or len(webm_pts) < 2 or not fps:
+        return []
+    orig_pts = orig_pts - orig_pts[0]
+    webm_pts = webm_pts - webm_pts[0]
+    tolerance = 0.5 / float(fps)
+    errors = list()
+    dropped = np.flatnonzero(_nearest_distance(values=orig_pts, reference=webm_pts) > tolerance)
+    if len(dropped) > 0:
+        errors.append(error_dict(err_type=prefix_check + 'DroppedFrames',
+                                 err_message='Webm is missing frames of the original video',
+                                 err_value=_locations(frames=dropped, timestamps=orig_pts),
+                                 service_name='WebmConverter'))
+    inserted = np.flatnonzero(_nearest_distance(values=webm_pts, reference=orig_pts) > tolerance)
+    if len(inserted) > 0:
+        errors.append(error_dict(err_type=prefix_check + 'InsertedFrames',
+                                 err_message='Webm has frames that are not in the original video',
+                                 err_value=_locations(frames=inserted, timestamps=webm_pts),
+                                 service_name='WebmConverter'))
+    duplicated = np.flatnonzero(np.diff(webm_pts) < PTS_EPSILON) + 1
+    if len(duplicated) > 0:
+        errors.append(error_dict(err_type=prefix_check + 'DuplicatedFrames',
+                                 err_message='Webm has frames with the same timestamp',
+                                 err_value=_locations(frames=duplicated, timestamps=webm_pts),
+                                 service_name='WebmConverter'))
+    if len(orig_pts) == len(webm_pts):
+        # same number of frames, the webm frames should keep the source times
+        drift = webm_pts - orig_pts
+        drifted = np.flatnonzero(np.abs(drift) > tolerance)
+        if len(drifted) > 0:
+            value = _locations(frames=drifted, timestamps=orig_pts)
+            value['max'] = round(float(np.max(np.abs(drift))), 3)
+            errors.append(error_dict(err_type=prefix_check + 'TimestampDrift',
+                                     err_message='Webm frame times drift from the original video',
+                                     err_value=value,
+                                     service_name='WebmConverter'))
+    return errors
+
+
+def extract_audio_codec(stream, with_headers=False, timeout=None):
+    """
+    get the codec of the first audio stream, reads the stream headers only
+
+    :param str stream: item stream
+    :param bool with_headers: url item or regular
+    :param float timeout: wall clock budget in seconds
+
+    :return: the audio codec name, None when there is no audio
+    """
+    input_options = stream_input_options() if with_headers else []
+    cmd = ['ffprobe',
+           '-v', 'error',
+           '-select_streams', 'a:0',
+           '-show_entries', 'stream=codec_name',
+           '-of', 'json',
+           *input_options,
+           stream]
+    outs = execute_cmd(cmd=cmd, timeout=timeout)
+    streams = json.loads(outs.decode('utf-8')).get('streams', [])
+    if len(streams) == 0:
+        return None
+    return streams[0].get('codec_name', None)
+
+
+def select_codec_plan(video_codec, audio_codec):
+    """
+    decide per stream whether it can be stream copied into the webm or needs encoding
+
+    :param str video_codec: codec name of the video stream
+    :param str audio_codec: codec name of the audio stream, None when there is no audio
+
+    :return: dict with 'video' and 'audio' set to 'copy' or 'encode' ('audio' is None without audio)
+    """
+    plan = {'video': 'copy' if video_codec in WEB_VIDEO_CODECS else 'encode',
+            'audio': None}
+    if audio_codec is not None:
+        plan['audio'] = 'copy' if audio_codec in WEB_AUDIO_CODECS else 'encode'
+    return plan
+
+
+def extract_metadata(item_stream, with_headers=False, count_frames=True, count_packets=True, timeout=None):
     """
     build and run the command to extract metadata
 
     :param str item_stream: item stream
     :param bool with_headers: url item or regular
+    :param bool count_frames: decode the whole stream to count the frames, otherwise only the packets are counted
+    :param bool count_packets: read the whole stream to count the packets, False reads the headers only
+    :param float timeout: wall clock budget in seconds
 
-    :return: the command output
+    :return: the command output, all the streams so the audio codec comes from the same probe
     """
+    count_options = (['-count_frames'] if count_frames else []) + (['-count_packets'] if count_packets else [])
     if with_headers:
         cmd = ['ffprobe',
-               '-select_streams',
-               'v:0',
                '-hide_banner',
-               '-count_frames',
-               '-count_packets',
+               *count_options,
                '-show_format',
                '-show_streams',
                '-of',
                'json',
-               '-headers',
-               "{}:{}".format('authorization', dl.client_api.auth['authorization']),
+               *stream_input_options(),
                item_stream]
     else:
         # without headers
         cmd = ['ffprobe',
-               '-select_streams',
-               'v:0',
-               '-count_frames',
-               '-count_packets',
+               *count_options,
                '-show_format',
                '-show_streams',
                '-of',
                'json',
                item_stream]
 
-    return execute_cmd(cmd=cmd)
+    return execute_cmd(cmd=cmd, timeout=timeout)
 
 
 def duration_str_to_sec(time_str):
@@ -99,18 +729,25 @@ def duration_str_to_sec(time_str):
         return None
 
 
-def metadata_extractor_from_ffmpeg(stream, with_headers):
+def metadata_extractor_from_ffmpeg(stream, with_headers, count_frames=True, count_packets=True, timeout=None):
     """
     get the item metadata from ffmpeg
 
     :param str stream: item stream
     :param bool with_headers: url item or regular
+    :param bool count_frames: decode the whole stream to count the frames (nb_read_frames),
+                              otherwise only nb_read_packets is counted
+    :param bool count_packets: count nb_read_packets, False when the caller counts the frames in another pass
+    :param float timeout: wall clock budget in seconds
 
-    :return: dict of the metadata
+    :return: dict of the metadata, with the codec of the first audio stream (None without audio)
     """
     outs = extract_metadata(
         item_stream=stream,
-        with_headers=with_headers
+        with_headers=with_headers,
+        count_frames=count_frames,
+        count_packets=count_packets,
+        timeout=timeout
     )
 
     probe_result = json.loads(outs.decode('utf-8'))
@@ -120,6 +757,7 @@ def metadata_extractor_from_ffmpeg(stream, with_headers):
 
     if video_stream is None:
         raise ValueError('missing video stream for: {}'.format(stream))
+    audio_stream = next((stream for stream in probe_result['streams'] if stream['codec_type'] == 'audio'), None)
 
     start_time = video_stream.get('start_time', None)
     start_time = eval(start_time) if start_time is not None else 0
@@ -136,6 +774,9 @@ def metadata_extractor_from_ffmpeg(stream, with_headers):
     nb_read_frames = video_stream.get('nb_read_frames', None)
     nb_read_frames = eval(nb_read_frames) if nb_read_frames is not None else None
 
+    nb_read_packets = video_stream.get('nb_read_packets', None)
+    nb_read_packets = int(nb_read_packets) if nb_read_packets is not None else None
+
     if 'duration' not in video_stream:
         tags = video_stream.get("tags", dict())
         duration = duration_str_to_sec(tags.get("DURATION", None))
@@ -155,13 +796,30 @@ def metadata_extractor_from_ffmpeg(stream, with_headers):
         'fps': fps,
         'duration': float(duration) if duration is not None else None,
         'nb_read_frames': nb_read_frames,
-        'nb_streams': nb_streams
+        'nb_streams': nb_streams,
+        'audio_codec': audio_stream.get('codec_name', None) if audio_stream is not None else None
     }
     if nb_frames is not None:
         res_dict['nb_frames'] = nb_frames
+    if nb_read_packets is not None:
+        res_dict['nb_read_packets'] = nb_read_packets
     return res_dict
 
 
+def frame_count(metadata):
+    """
+    best known number of frames of a metadata dict: decoded frames, then counted packets, then the container header
+
+    :param dict metadata: dict of the metadata (metadata_extractor_from_ffmpeg format)
+
+    :return: number of frames or None
+    """
+    for key in ['nb_read_frames', 'nb_read_packets', 'nb_frames']:
+        if metadata.get(key, None) is not None:
+            return int(metadata[key])
+    return None
+
+
 def validate_video(fps, duration, r_frames, default_start_time=0, prefix_check='web'):
     if fps and duration and r_frames:
         if default_start_time is None:
@@ -197,19 +855,41 @@ def error_dict(err_type, err_message, err_value, service_name):
     }
 
 
+def project_org_id(project_id):
+    """
+    org id of a project, fetched once per project
+    """
+    if project_id not in _project_org_ids:
+        _project_org_ids[project_id] = dl.projects.get(project_id=project_id).org['id']
+    return _project_org_ids[project_id]
+
+
 def send_error_event(item: dl.Item):
     """
     send error event
     """
+    send_error_digest_event(project_id=item.project_id, dataset_id=item.datasetId)
+
+
+def send_error_digest_event(project_id, dataset_id, nb_items=None):
+    """
+    send one error event for the failed items of a dataset
+
+    :param str project_id: project of the dataset
+    :param str dataset_id: the dataset
+    :param int nb_items: number of failed items, in the body of the event
+    """
     payload = {
         "notificationCode": "Platform.DataManagement.Item.ETL.ProcessFailed",
-        "context": {"project": item.project.id, "org": item.project.org['id'], "dataset": item.dataset.id},
+        "context": {"project": project_id,
+                    "org": project_org_id(project_id=project_id),
+                    "dataset": dataset_id},
         "eventMessage": {"title": 'WebM Conversion Failed',
                          "description": f"One or more files finished conversion to WebM but may not be available for annotation work. This often results from Metadata missmatch, such as height-width information, or corrupted files. Investigate the files from enclosed links and resolve by adding new, correct files to the task."
                          },
         "priority": 100,
         "type": 'system',
-        "body": {},
+        "body": {"items": nb_items} if nb_items is not None else {},
     }
     dl.client_api.gen_request(req_type='post',
                               path='/notifications/publish',
@@ -221,6 +901,17 @@ def update_item_errors(item: dl.Item, error_dicts):
     """
     update the item metadata with the relevant errors
 
+    :param dl.item item: the item object of the file
+    :param list error_dicts: list of the errors
+    """
+    add_item_errors(item=item, error_dicts=error_dicts)
+    item.update(True)
+
+
+def add_item_errors(item: dl.Item, error_dicts):
+    """
+    add the errors to the item metadata without updating the item on the platform
+
     :param dl.item item: the item object of the file
     :param list error_dicts: list of the errors
     """
@@ -238,7 +929,6 @@ def update_item_errors(item: dl.Item, error_dicts):
                 add_err = False
         if add_err:
             item.metadata['system']['errors'].append(err_dict)
-    item.update(True)
 
 
 def clean_item(item: dl.Item, service_name: str):
@@ -1,17 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import traceback
+import threading
 import numpy as np
 import dtlpy as dl
 import datetime
 import logging
+import json
 import shutil
 import time
 import os
 
+from instrumentation import ItemMetrics, MetricsExporter
+from metadata_session import MetadataSession
+from alert_aggregator import AlertAggregator, ALERT_WINDOW
+from async_engine import AsyncEngine
+from cost_model import CostModel
+import cost_model
+from resource_manager import ResourceManager
+import preflight_audit
 from mail_handler import MailHandler
+import conversion_cache
 import video_utilities
 
 logger = logging.getLogger(__name__)
 NUM_RETRIES = 2
+# preview rendition - fast vp9 settings, the height is scaled down keeping the aspect ratio
+PREVIEW_HEIGHT = 360
+PREVIEW_BITRATE = '500k'
+# thumbnail strip - width of a thumbnail, seconds between thumbnails when the duration is unknown
+THUMBNAIL_WIDTH = 160
+THUMBNAILS_INTERVAL = 10
+# rendition names that are the suffix of another output of the item (<item id>_<suffix>)
+RESERVED_RENDITION_NAMES = ['preview', 'thumbnails']
+# batch pipeline - items downloaded ahead of the encoder, encoded webms waiting for upload
+BATCH_PREFETCH = 2
+BATCH_UPLOAD_QUEUE = 2
+# cost model tuning - encode budget per second of video before a faster profile is used, predicted encode
+# seconds above which the encode is segmented (with AUTO_SEGMENT_DURATION when segment_duration is not set),
+# predicted encode seconds of a heavy item, wall clock budget of the encode in predicted encode times
+AUTO_TUNE_SECONDS_PER_VIDEO_SECOND = 2
+AUTO_SEGMENT_MIN_SECONDS = 120
+AUTO_SEGMENT_DURATION = 30
+HEAVY_ENCODE_SECONDS = 1800
+ENCODE_BUDGET_FACTOR = 5
+# tries of the upload of one output file, seconds before the first retry (doubled on every retry)
+UPLOAD_RETRIES = 3
+UPLOAD_BACKOFF = 2
 
 
 class ConversionMethod:
@@ -19,17 +54,377 @@ class ConversionMethod:
     OPENCV = 'opencv'
 
 
+class EncoderProfile:
+    REALTIME = 'realtime'
+    BALANCED = 'balanced'
+    ARCHIVAL = 'archival'
+
+
+# libvpx settings per profile. threads None means all the available cpus,
+# crf with bitrate '0' is constant quality, a bitrate without crf is a target bitrate
+ENCODER_PROFILES = {
+    EncoderProfile.REALTIME: {
+        'codec': 'libvpx-vp9',
+        'deadline': 'realtime',
+        'cpu_used': 8,
+        'row_mt': 1,
+        'tile_columns': 2,
+        'threads': None,
+        'crf': None,
+        'bitrate': '2M'
+    },
+    EncoderProfile.BALANCED: {
+        'codec': 'libvpx-vp9',
+        'deadline': 'good',
+        'cpu_used': 4,
+        'row_mt': 1,
+        'tile_columns': 2,
+        'threads': None,
+        'crf': 32,
+        'bitrate': '0'
+    },
+    EncoderProfile.ARCHIVAL: {
+        'codec': 'libvpx-vp9',
+        'deadline': 'good',
+        'cpu_used': 1,
+        'row_mt': 1,
+        'tile_columns': 1,
+        'threads': None,
+        'crf': 24,
+        'bitrate': '0'
+    }
+}
+
+
+def encoder_options(profile=None, threads=None):
+    """
+    build the ffmpeg video encoder options of a profile
+
+    :param str profile: name of the encoder profile, None keeps the ffmpeg defaults
+    :param int threads: number of encoder threads, overrides the profile threads
+
+    :return: list of ffmpeg output options
+    """
+    if profile is None:
+        return ['-threads', str(threads)] if threads else []
+    settings = ENCODER_PROFILES[profile]
+    threads = threads or settings['threads'] or video_utilities.available_cpus()
+    options = ['-c:v', settings['codec'],
+               '-deadline', settings['deadline'],
+               '-cpu-used', str(settings['cpu_used']),
+               '-threads', str(threads)]
+    if settings['row_mt'] is not None:
+        options += ['-row-mt', str(settings['row_mt'])]
+    if settings['tile_columns'] is not None:
+        options += ['-tile-columns', str(settings['tile_columns'])]
+    if settings['crf'] is not None:
+        options += ['-crf', str(settings['crf'])]
+    if settings['bitrate'] is not None:
+        options += ['-b:v', settings['bitrate']]
+    return options
+
+
+class VerificationLevel:
+    # count the packets of the output, no decoding
+    FAST = 'fast'
+    # decode the whole output to count the frames
+    STRICT = 'strict'
+    # compare the packet timestamps of the output and the source, no decoding
+    PACKETS = 'packets'
+
+
+class InputMode:
+    # download the source to the workdir before probing and encoding
+    DOWNLOAD = 'download'
+    # feed ffprobe/ffmpeg directly from the item stream url, only the output is written to disk
+    STREAM = 'stream'
+
+
+class Stage:
+    DOWNLOAD = 'download'
+    CACHE = 'cache'
+    PROBE = 'probe'
+    PREVIEW = 'preview'
+    ENCODE = 'encode'
+    VERIFY = 'verify'
+    UPLOAD = 'upload'
+    LINK = 'link'
+
+
+class StageArtifacts:
+    """
+    artifacts of the finished pipeline stages, saved as json in the workdir
+    so a retry resumes from the first stage that did not finish
+    """
+    FILENAME = '.stages.json'
+    # output files uploaded so far by the upload stage, a retry does not send them again
+    UPLOADED_FILES = 'uploaded_files'
+
+    def __init__(self, workdir):
+        self.filepath = os.path.join(workdir, self.FILENAME)
+        self.artifacts = dict()
+        # the verification and the upload stages run at the same time
+        self._lock = threading.Lock()
+        if os.path.isfile(self.filepath):
+            try:
+                with open(self.filepath) as f:
+                    self.artifacts = json.load(f)
+            except ValueError:
+                logger.warning('failed to read the stage artifacts, running all the stages')
+
+    def get(self, stage):
+        return self.artifacts.get(stage, None)
+
+    def done(self, stage, artifact):
+        with self._lock:
+            self.artifacts[stage] = artifact
+            # write and rename, a failure in the middle keeps the previous file
+            tmp_filepath = self.filepath + '.tmp'
+            with open(tmp_filepath, 'w') as f:
+                json.dump(self.artifacts, f)
+            os.replace(tmp_filepath, self.filepath)
+
+
+
+def _webm_remote_path(item):
+    """
+    platform directory of the outputs of an item - its folder under /.dataloop/webm
+    """
+    pre, _ = os.path.splitext(item.filename)
+    return '/.dataloop/webm{}'.format('/'.join(pre.split('/')[:-1]))
+
+
+def _rendition_filepath(workdir, item_id, rendition):
+    return os.path.join(workdir, '{}_{}.webm'.format(item_id, rendition['name']))
+
+
+def _seek_index_filepath(workdir, item_id):
+    return os.path.join(workdir, '{}.seek.json'.format(item_id))
+
+
+def _thumbnails_filepath(workdir, item_id):
+    return os.path.join(workdir, '{}_thumbnails.jpg'.format(item_id))
+
+
+class ConversionJob:
+    """
+    state of one item going through the stages
+    """
+
+    def __init__(self, item: dl.Item, workdir, metrics=None, threads=None, session=None):
+        self.item = item
+        self.workdir = workdir
+        self.threads = threads
+        self.metrics = metrics if metrics is not None else ItemMetrics(item_id=item.id)
+        # the metadata writes of the item, sent once by the link stage
+        self.session = session if session is not None else MetadataSession(item=item, metrics=self.metrics)
+        self.artifacts = StageArtifacts(workdir=workdir)
+        self.log_header = '[preprocess][on_create][{item_id}][{func}]'.format(item_id=item.id, func='webm-converter')
+        self.orig_filepath = None
+        self.orig_metadata = None
+        self.codec_plan = None
+        # encoder profile, threads and segmentation of the encode, see WebmConverter.plan_encode
+        self.plan = None
+        self.cache_key = None
+        # multiplies the encode budget, raised after an encode ran out of time
+        self.timeout_scale = 1
+        self.webm_item = None
+        self.rendition_items = list()
+        self.thumbnails_item = None
+        self.seek_index_item = None
+        self.encoded_frames = None
+        self.valid = True
+        self.msg = ''
+        # the resources of a batch job, released after publishing
+        self.allocation = None
+
+
+def source_fingerprint(item: dl.Item, method, encoder_profile=None, keyframe_interval=None, seek_index=False):
+    """
+    what the webm of an item depends on - the source binary and the conversion settings
+    metadata only updates (tags, errors, modalities) leave it unchanged
+
+    :return: dict of the fingerprint
+    """
+    return {
+        'size': item.metadata['system'].get('size', None),
+        'md5': item.metadata['system'].get('md5', None),
+        'createdAt': item.created_at,
+        'method': method,
+        'encoderProfile': encoder_profile,
+        # None for the defaults, the fingerprints saved before these settings stay valid
+        'keyframeInterval': keyframe_interval or None,
+        'seekIndex': True if seek_index else None
+    }
+
+
+class BatchJobError(Exception):
+    """
+    a batch job failed, keeps the job so it can be retried in its scratch dir
+    """
+
+    def __init__(self, job):
+        super().__init__('batch job of item {} failed'.format(job.item.id))
+        self.job = job
+
+
+def conversion_cost(item: dl.Item):
+    """
+    rough relative cost of converting an item - number of frames x pixels per frame, from the platform metadata
+    the size of the file when the frames or the resolution are unknown
+
+    :return: the cost, items with a smaller cost are converted first
+    """
+    system = item.metadata.get('system', dict())
+    ffmpeg = system.get('ffmpeg', dict())
+    nb_frames = ffmpeg.get('nb_read_frames', None) or ffmpeg.get('nb_frames', None)
+    if nb_frames is None and system.get('duration', None) and system.get('fps', None):
+        nb_frames = float(system['duration']) * float(system['fps'])
+    height = system.get('height', None) or ffmpeg.get('height', None)
+    width = system.get('width', None) or ffmpeg.get('width', None)
+    try:
+        if nb_frames and height and width:
+            return float(nb_frames) * float(height) * float(width)
+    except (TypeError, ValueError):
+        pass
+    return float(system.get('size', None) or 0)
+
+
+def _is_complete_file(filepath, size):
+    return os.path.isfile(filepath) and os.path.getsize(filepath) == size
+
+
+def _is_stream_url(filepath):
+    """
+    the source is read from the item stream url, not from a local file
+    """
+    return filepath.startswith(('http://', 'https://'))
+
+
 class WebmConverter(dl.BaseServiceRunner):
     """
     Plugin runner class
 
     """
 
-    def __init__(self, method=None):
+    def __init__(self,
+                 method=None,
+                 input_mode=None,
+                 segment_duration=None,
+                 segment_workers=None,
+                 encoder_profile=None,
+                 verification=None,
+                 stall_timeout=None,
+                 metrics_json_path=None,
+                 metrics_prometheus_path=None,
+                 metrics_to_item=False,
+                 cache_dir=None,
+                 cache_max_size_mb=None,
+                 cache_lookup_platform=False,
+                 scratch_root=None,
+                 disk_budget_mb=None,
+                 concurrency=None,
+                 preview=False,
+                 preview_height=None,
+                 renditions=None,
+                 thumbnail_strip=None,
+                 keyframe_interval=None,
+                 seek_index=False,
+                 reject_unverified=False,
+                 alert_window=None,
+                 cost_model_path=None,
+                 auto_tune=False,
+                 heavy_encode_seconds=None,
+                 heavy_service_name=None,
+                 encode_budget_factor=None):
         if not method:
             method = ConversionMethod.FFMPEG
+        if not input_mode:
+            input_mode = InputMode.DOWNLOAD
+        if not verification:
+            verification = VerificationLevel.FAST
+        if method == ConversionMethod.OPENCV and input_mode == InputMode.STREAM:
+            # the opencv converter reads local files only
+            logger.warning('stream input mode is not supported with opencv method, using download')
+            input_mode = InputMode.DOWNLOAD
+        if encoder_profile and encoder_profile not in ENCODER_PROFILES:
+            raise ValueError('unknown encoder profile: {}, possible values: {}'.format(encoder_profile,
+                                                                                      list(ENCODER_PROFILES)))
         self.mail_handler = MailHandler(service_name='custom-webm-converter')
+        # failures are mailed and notified in a digest per dataset and creator every alert_window seconds,
+        # 0 sends every failure right away
+        self.alerts = AlertAggregator(mail_handler=self.mail_handler,
+                                      window=ALERT_WINDOW if alert_window is None else alert_window)
         self.method = method
+        # None keeps the ffmpeg default encoder settings
+        self.encoder_profile = encoder_profile or None
+        self.input_mode = input_mode
+        self.verification = verification
+        # segmented encoding - 0/None disables it, workers default to the available cpus
+        self.segment_duration = segment_duration
+        self.segment_workers = segment_workers
+        # a low resolution webm linked before the full conversion starts, replaced when it finishes
+        self.preview = preview
+        self.preview_height = preview_height or PREVIEW_HEIGHT
+        # extra webm renditions e.g [{'name': '480p', 'height': 480, 'bitrate': '1M'}] and the number of thumbnails
+        # in a strip image, made from the decode of the main webm
+        self.renditions = renditions or list()
+        for rendition in self.renditions:
+            missing = [key for key in ['name', 'height', 'bitrate'] if not rendition.get(key, None)]
+            if missing:
+                raise ValueError('rendition {} is missing {}'.format(rendition, missing))
+            # the name is in the file name, the modality and the error types of the rendition
+            if rendition['name'] in RESERVED_RENDITION_NAMES:
+                raise ValueError('rendition name {} is reserved, reserved names: {}'.format(rendition['name'],
+                                                                                          RESERVED_RENDITION_NAMES))
+        names = [rendition['name'] for rendition in self.renditions]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError('duplicate rendition names: {}'.format(duplicates))
+        self.thumbnail_strip = thumbnail_strip or 0
+        # seekability - max seconds between keyframes (0 keeps the encoder default) and a keyframe index sidecar
+        self.keyframe_interval = keyframe_interval or 0
+        self.seek_index = seek_index
+        # a webm that fails the verification is not linked and its uploaded items are deleted,
+        # by default it is linked and the mismatches are in the item errors
+        self.reject_unverified = reject_unverified
+        # predicted encode time and webm size per item, calibrated with cost_model.py. auto_tune picks the threads,
+        # a faster encoder profile when the configured one is too slow and the segmentation of every item.
+        # heavy items are forwarded to the heavy_service_name service, e.g deployed on a large pod.
+        # the encode gets encode_budget_factor times its predicted time before it is killed
+        self.cost_model = CostModel.load(path=cost_model_path or None)
+        self.auto_tune = auto_tune
+        self.heavy_encode_seconds = heavy_encode_seconds or HEAVY_ENCODE_SECONDS
+        self.heavy_service_name = heavy_service_name or None
+        self.encode_budget_factor = encode_budget_factor or ENCODE_BUDGET_FACTOR
+        # the profile the webm depends on, for the fingerprint and the cache key
+        self.profile_label = 'auto-{}'.format(self.encoder_profile or 'default') if auto_tune else self.encoder_profile
+        if (self.renditions or self.thumbnail_strip) and (cache_dir or cache_lookup_platform):
+            # the cache holds the main webm only
+            logger.warning('conversion cache is not supported with renditions / thumbnail strip, disabling it')
+            cache_dir = None
+            cache_lookup_platform = False
+        # seconds without ffmpeg progress before the command is killed, 0 disables the stall watchdog
+        if stall_timeout is None:
+            stall_timeout = video_utilities.STALL_TIMEOUT
+        self.stall_timeout = stall_timeout or None
+        # per item stage timings - always logged, optionally json lines / prometheus textfile / item metadata
+        self.metrics_exporter = MetricsExporter(json_path=metrics_json_path or None,
+                                                prometheus_path=metrics_prometheus_path or None)
+        self.metrics_to_item = metrics_to_item
+        # conversion cache by source content and encoder settings - webm files on local disk and/or
+        # an existing webm item of the same source in the dataset
+        self.local_cache = None
+        if cache_dir and cache_max_size_mb:
+            self.local_cache = conversion_cache.LocalConversionCache(cache_dir=cache_dir,
+                                                                     max_size_bytes=cache_max_size_mb * 1024 * 1024)
+        self.cache_lookup_platform = cache_lookup_platform
+        # executions running at the same time share the disk budget and the cpus of the pod
+        self.resources = ResourceManager(scratch_root=scratch_root or None,
+                                         disk_budget_bytes=disk_budget_mb * 1024 * 1024 if disk_budget_mb else None,
+                                         concurrency=concurrency)
+        # run_async - items beyond the concurrency wait in the queue of the engine, not in a thread
+        self.engine = AsyncEngine(pipeline_workers=self.resources.concurrency)
         if method == ConversionMethod.OPENCV:
             cmd_build_file = ['chmod', '777', 'opencv4_converter']
             video_utilities.execute_cmd(cmd=cmd_build_file)
@@ -43,13 +438,14 @@ class WebmConverter(dl.BaseServiceRunner):
                                           alias=new_env,
                                           url=url)
 
-    def convert_to_webm_opencv(self, item, dir_path, nb_streams):
+    def convert_to_webm_opencv(self, item, dir_path, nb_streams, timeout=None):
         """
         Convert and Save the item file in webm format by opencv
 
         :param dl.item item: the item object of the file
         :param str dir_path: the dir that have the input and output files
         :param int nb_streams: the number if streams of the file example (nb_streams=2 when the video have an audio)
+        :param float timeout: wall clock budget of the encode in seconds, the converter reports no progress
         """
         output_file_path = os.path.join(dir_path, '{}.webm'.format(item.id))
         input_file_path = os.path.join(dir_path, item.name)
@@ -64,80 +460,180 @@ class WebmConverter(dl.BaseServiceRunner):
             input_file_path,
             webm_video
         ]
-        video_utilities.execute_cmd(cmd=cmd)
+        video_utilities.execute_cmd(cmd=cmd, timeout=timeout)
 
-        if nb_streams == 2:
-            have_audio = True
-            # start extract the audio
-            webm_audio = os.path.join(dir_path, '{}.aac'.format(item.id))
-            try:
-                cmd = [
-                    'ffmpeg',
-                    '-i',
-                    input_file_path,
-                    '-vn',  # is no video.
-                    '-acodec',
-                    'copy',  # -acodec copy says use the same audio stream that's already in there.
-                    '-y',
-                    webm_audio
-                ]
-                video_utilities.execute_cmd(cmd=cmd)
-            except Exception as err:
-                if 'does not contain any stream' in str(err):
-                    have_audio = False
-                    pass
-                else:
-                    raise err
-
-            # marge video and audio file into one webm file
-            if have_audio:
-                cmd = [
-                    'ffmpeg',
-                    '-i',
-                    webm_video,
-                    '-i',
-                    webm_audio,
-                    '-c:v',
-                    'copy',  # copy video as ot with out encode
-                    '-c:a',
-                    'libopus',  # encode audio
-                    '-map',
-                    '0:0',
-                    '-map',
-                    '1:0',
-                    '-hide_banner',
-                    # -map 0:0 -map 1:0 - we map stream 0 (video) from first file, and stream 0 from second file (mp3) to output.
-                    output_file_path
-                ]
-                video_utilities.execute_cmd(cmd=cmd)
-            else:
-                if os.path.isfile(output_file_path):
-                    os.remove(output_file_path)
-                os.rename(webm_video, output_file_path)
+        if int(nb_streams) > 1:
+            # mux the audio straight from the source, no intermediate audio file
+            cmd = [
+                'ffmpeg',
+                '-i',
+                webm_video,
+                '-i',
+                input_file_path,
+                '-map',
+                '0:v:0',
+                '-map',
+                '1:a:0?',  # the other stream may not be an audio stream
+                '-c:v',
+                'copy',  # copy video as ot with out encode
+                '-c:a',
+                'libopus',  # encode audio
+                '-hide_banner',
+                '-y',
+                output_file_path
+            ]
+            video_utilities.execute_cmd(cmd=cmd, stall_timeout=self.stall_timeout)
+            os.remove(webm_video)
         else:
             if os.path.isfile(output_file_path):
                 os.remove(output_file_path)
             os.rename(webm_video, output_file_path)
 
+    def _seek_options(self, fps, video_copy=False):
+        """
+        ffmpeg output options of the seekability settings - the keyframe interval of an encoded stream and
+        the cues (the webm seek index) written at the start of the file, so the player seeks without reading the end
+        a copied stream keeps its keyframes: the probe stage encodes the sources whose keyframes are too far apart,
+        the segments of a segmented encode are encoded with the interval
+        """
+        options = list()
+        if self.keyframe_interval and not video_copy and fps:
+            options += ['-g', str(max(1, int(round(float(fps) * self.keyframe_interval))))]
+        if self.keyframe_interval or self.seek_index:
+            options += ['-cues_to_front', '1']
+        return options
+
+    def convert_to_webm_preview(self,
+                                input_filepath,
+                                output_filepath,
+                                fps,
+                                nb_frames=None,
+                                with_headers=False,
+                                threads=None,
+                                timeout=None):
+        """
+        Convert to a low resolution webm with the fastest encoder settings, playable while the full webm is encoded
+
+        :param str input_filepath: the file path to convert
+        :param str output_filepath: the output file path
+        :param int fps: the fps of the file (Frames per second)
+        :param int nb_frames: the number of frames of the file
+        :param bool with_headers: input is an item stream url (read with authorization and reconnect)
+        :param int threads: number of encoder threads, all the available cpus when None
+        :param float timeout: wall clock budget in seconds
+        """
+        input_options = video_utilities.stream_input_options() if with_headers else []
+        cmds = [
+            'ffmpeg',
+            '-r', str(fps),
+            *input_options,
+            '-i', input_filepath,
+            '-y',
+            '-hide_banner',
+            '-v', 'info',
+            '-max_muxing_queue_size', '9999',
+            # never upscale, keep even dimensions for the encoder
+            '-vf', "scale=-2:'min({},ih)'".format(self.preview_height),
+            '-c:v', 'libvpx-vp9',
+            '-deadline', 'realtime',
+            '-cpu-used', '8',
+            '-row-mt', '1',
+            '-threads', str(threads or video_utilities.available_cpus()),
+            '-b:v', PREVIEW_BITRATE,
+            '-c:a', 'libopus',
+            output_filepath
+        ]
+        video_utilities.execute_cmd(cmd=cmds,
+                                    nb_frames=nb_frames,
+                                    timeout=timeout,
+                                    stall_timeout=self.stall_timeout)
+
     def convert_to_webm_ffmpeg(self,
                                input_filepath,
                                output_filepath,
                                fps,
                                nb_frames=None,
-                               progress=None):
+                               progress=None,
+                               with_headers=False,
+                               threads=None,
+                               codec_plan=None,
+                               timeout=None,
+                               renditions=None,
+                               thumbnails_filepath=None,
+                               nb_thumbnails=None,
+                               encoder_profile=None):
         """
         Convert and Save the item file in webm format by ffmpeg
+        the renditions and the thumbnail strip are made from the same decode, split in the filter graph
 
         :param str input_filepath: the file path to convert
         :param str output_filepath: the output file path
         :param int fps: the fps of the file (Frames per second)
         :param int nb_frames: the number of frames of the file
         :param dl.Progress progress: progress object to follow the work progress
+        :param bool with_headers: input is an item stream url (read with authorization and reconnect)
+        :param int threads: number of encoder threads, the profile threads when None
+        :param dict codec_plan: streams to copy instead of encode, see video_utilities.select_codec_plan
+        :param float timeout: wall clock budget in seconds, scaled to nb_frames / fps when None
+        :param list renditions: list of (rendition dict with height and bitrate, output file path) to encode as well
+        :param str thumbnails_filepath: output path of a thumbnail strip image, None for no strip
+        :param int nb_thumbnails: number of thumbnails in the strip, spread over the video
+        :param str encoder_profile: encoder profile of this conversion, the profile of the converter when None
+        :return: number of frames written by the encoder, from its final progress report
         """
+        encoder_profile = encoder_profile or self.encoder_profile
+        if timeout is None:
+            timeout = video_utilities.stage_timeout(stage='encode', nb_frames=nb_frames, fps=fps)
+        input_options = video_utilities.stream_input_options() if with_headers else []
+        codec_options = list()
+        video_copy = codec_plan is not None and codec_plan['video'] == 'copy'
+        if video_copy:
+            codec_options += ['-c:v', 'copy']
+        else:
+            codec_options += encoder_options(profile=encoder_profile, threads=threads)
+        if codec_plan is not None and codec_plan['audio'] == 'copy':
+            codec_options += ['-c:a', 'copy']
+        codec_options += self._seek_options(fps=fps, video_copy=video_copy)
+        # To force the frame rate of the output file, a copied stream keeps its own timestamps
+        rate_options = [] if video_copy else ['-r', str(fps)]
+        renditions = renditions or list()
+        graph_options = list()
+        map_options = list()
+        extra_outputs = list()
+        if renditions or thumbnails_filepath:
+            # one decode split to the main output (unless copied), every rendition and the thumbnails
+            nb_branches = len(renditions) + (1 if thumbnails_filepath else 0) + (0 if video_copy else 1)
+            branches = ['[s{}]'.format(i) for i in range(nb_branches)]
+            graph = ['[0:v:0]split={}{}'.format(nb_branches, ''.join(branches))]
+            if video_copy:
+                map_options = ['-map', '0:v:0', '-map', '0:a:0?']
+            else:
+                map_options = ['-map', branches.pop(0), '-map', '0:a:0?']
+            audio_options = ['-c:a', 'copy'] if codec_plan is not None and codec_plan['audio'] == 'copy' else []
+            for i, (rendition, rendition_filepath) in enumerate(renditions):
+                # never upscale, keep even dimensions for the encoder
+                graph.append("{}scale=-2:'min({},ih)'[r{}]".format(branches.pop(0), rendition['height'], i))
+                extra_outputs += ['-map', '[r{}]'.format(i),
+                                  '-map', '0:a:0?',
+                                  *encoder_options(profile=encoder_profile, threads=threads),
+                                  '-b:v', str(rendition['bitrate']),
+                                  *self._seek_options(fps=fps),
+                                  *audio_options,
+                                  '-max_muxing_queue_size', '9999',
+                                  rendition_filepath]
+            if thumbnails_filepath:
+                duration = nb_frames / fps if nb_frames and fps else None
+                interval = duration / nb_thumbnails if duration else THUMBNAILS_INTERVAL
+                graph.append('{}fps=1/{},scale={}:-2,tile={}x1[t]'.format(branches.pop(0),
+                                                                          interval,
+                                                                          THUMBNAIL_WIDTH,
+                                                                          nb_thumbnails))
+                extra_outputs += ['-map', '[t]', '-frames:v', '1', thumbnails_filepath]
+            graph_options = ['-filter_complex', ';'.join(graph)]
         cmds = [
             'ffmpeg',
-            # To force the frame rate of the output file
-            '-r', str(fps),
+            *rate_options,
+            *input_options,
             # Item local path / stream
             '-i', input_filepath,
             # Overwrite output files without asking
@@ -147,42 +643,193 @@ class WebmConverter(dl.BaseServiceRunner):
             '-v', 'info',
             # Duplicate or drop input frames to achieve constant output frame rate fps.
             '-max_muxing_queue_size', '9999',
-            output_filepath
+            *graph_options,
+            *map_options,
+            *codec_options,
+            output_filepath,
+            *extra_outputs
         ]
-        video_utilities.execute_cmd(cmd=cmds, nb_frames=nb_frames, progress=progress)
+        final_stats = dict()
+        video_utilities.execute_cmd(cmd=cmds,
+                                    nb_frames=nb_frames,
+                                    progress=progress,
+                                    on_progress=final_stats.update,
+                                    timeout=timeout,
+                                    stall_timeout=self.stall_timeout)
+
+        return final_stats.get('frame', None)
+
+    def convert_to_webm_ffmpeg_segmented(self,
+                                         input_filepath,
+                                         output_filepath,
+                                         fps,
+                                         workdir,
+                                         nb_frames=None,
+                                         progress=None,
+                                         with_headers=False,
+                                         codec_plan=None,
+                                         cpus=None,
+                                         segment_duration=None,
+                                         encoder_profile=None,
+                                         timeout=None):
+        """
+        Convert to webm by splitting the video at keyframes and encoding the segments concurrently.
+        Each segment is encoded by its own ffmpeg process, the segments are concatenated without re-encoding
+        and muxed with the audio of the source. Falls back to a single ffmpeg process when the segments
+        do not add up to the frame count of the source.
+
+        :param str input_filepath: the file path to convert
+        :param str output_filepath: the output file path
+        :param int fps: the fps of the file (Frames per second)
+        :param str workdir: the dir for the segment files
+        :param int nb_frames: the number of frames of the file
+        :param dl.Progress progress: progress object to follow the work progress
+        :param bool with_headers: input is an item stream url (read with authorization and reconnect)
+        :param dict codec_plan: streams to copy instead of encode, only the audio is used here
+        :param int cpus: cpus shared by the segment workers, all the available cpus when None
+        :param float segment_duration: seconds of a segment, the segment duration of the converter when None
+        :param str encoder_profile: encoder profile of this conversion, the profile of the converter when None
+        :param float timeout: wall clock budget of every segment encode, scaled to nb_frames / fps when None
+        :return: number of frames written to the output
+        """
+        segments_dir = os.path.join(workdir, 'segments')
+        if os.path.isdir(segments_dir):
+            shutil.rmtree(segments_dir)
+        os.makedirs(segments_dir)
+        try:
+            segments = video_utilities.split_at_keyframes(
+                input_filepath=input_filepath,
+                output_dir=segments_dir,
+                segment_duration=segment_duration or self.segment_duration,
+                with_headers=with_headers,
+                timeout=video_utilities.stage_timeout(stage='split', nb_frames=nb_frames, fps=fps),
+                stall_timeout=self.stall_timeout)
+            # every segment gets the budget of the whole encode, the concurrent encodes share the wall clock
+            encode_timeout = timeout or video_utilities.stage_timeout(stage='encode', nb_frames=nb_frames, fps=fps)
+            cpus = cpus or video_utilities.available_cpus()
+            workers = self.segment_workers or cpus
+            workers = max(1, min(workers, len(segments)))
+            threads = max(1, cpus // workers)
+            logger.info('encoding {} segments with {} workers, {} threads each'.format(len(segments),
+                                                                                       workers,
+                                                                                       threads))
+
+            def encode_segment(segment_filepath):
+                segment_webm = os.path.splitext(segment_filepath)[0] + '.webm'
+                self.convert_to_webm_ffmpeg(input_filepath=segment_filepath,
+                                            output_filepath=segment_webm,
+                                            fps=fps,
+                                            threads=threads,
+                                            timeout=encode_timeout,
+                                            encoder_profile=encoder_profile)
+                return segment_webm, video_utilities.count_packets(stream=segment_webm)
+
+            # the work is done by the ffmpeg subprocesses, threads are enough to drive them
+            encoded = list()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for segment_webm, segment_frames in pool.map(video_utilities.bind_command_runner(encode_segment),
+                                                             segments):
+                    encoded.append((segment_webm, segment_frames))
+                    if progress is not None:
+                        progress.update(progress=int(90 * len(encoded) / len(segments)))
+
+            encoded_frames = sum(frames or 0 for _, frames in encoded)
+            if nb_frames is not None and encoded_frames != nb_frames:
+                logger.warning('segments have {} frames, expected {}. converting in a single pass'.format(
+                    encoded_frames, nb_frames))
+                return self.convert_to_webm_ffmpeg(input_filepath=input_filepath,
+                                                   output_filepath=output_filepath,
+                                                   fps=fps,
+                                                   nb_frames=nb_frames,
+                                                   progress=progress,
+                                                   with_headers=with_headers,
+                                                   codec_plan=codec_plan,
+                                                   threads=cpus,
+                                                   timeout=timeout,
+                                                   encoder_profile=encoder_profile)
+
+            concat_list = os.path.join(segments_dir, 'concat.txt')
+            with open(concat_list, 'w') as f:
+                for segment_webm, _ in encoded:
+                    f.write("file '{}'\n".format(os.path.abspath(segment_webm)))
 
-        return
+            input_options = video_utilities.stream_input_options() if with_headers else []
+            audio_copy = codec_plan is not None and codec_plan['audio'] == 'copy'
+            cmds = [
+                'ffmpeg',
+                '-f', 'concat',
+                '-safe', '0',
+                '-i', concat_list,
+                *input_options,
+                '-i', input_filepath,
+                # video from the encoded segments, audio (if any) from the source
+                '-map', '0:v:0',
+                '-map', '1:a:0?',
+                '-c:v', 'copy',
+                '-c:a', 'copy' if audio_copy else 'libopus',
+                *self._seek_options(fps=fps, video_copy=True),
+                '-y',
+                '-hide_banner',
+                '-v', 'info',
+                '-max_muxing_queue_size', '9999',
+                output_filepath
+            ]
+            final_stats = dict()
+            video_utilities.execute_cmd(cmd=cmds,
+                                        on_progress=final_stats.update,
+                                        timeout=video_utilities.stage_timeout(stage='mux',
+                                                                              nb_frames=nb_frames,
+                                                                              fps=fps),
+                                        stall_timeout=self.stall_timeout)
+            return final_stats.get('frame', None)
+        finally:
+            shutil.rmtree(segments_dir, ignore_errors=True)
 
     @staticmethod
-    def _upload_webm_item(item, webm_file_path):
+    def _upload_webm_item(item, webm_file_path, item_metadata=None):
         """
         Upload the webm file to the platform
+        dtlpy sends a whole file per request, a failed try sends the file again from its start
 
         :param dl.item item: the item object of the file
         :param str webm_file_path: the webm file (output file of the converter method)
+        :param dict item_metadata: metadata of the uploaded webm item
         :return: the uploaded item
         """
         dataset = dl.datasets.get(fetch=False, dataset_id=item.datasetId)
-        pre, _ = os.path.splitext(item.filename)
-        item_arr = pre.split('/')[:-1]
-        item_folder = '/'.join(item_arr)
-
-        remote_path = '/.dataloop/webm{}'.format(item_folder)
-        webm_item = dataset.items.upload(
-            local_path=webm_file_path,
-            remote_path=remote_path,
-            overwrite=True
-        )
+        remote_path = _webm_remote_path(item=item)
+        webm_item = None
+        for i_try in range(UPLOAD_RETRIES):
+            if i_try > 0:
+                # a network hiccup, the file is sent again after a back off
+                time.sleep(UPLOAD_BACKOFF * 2 ** (i_try - 1))
+            try:
+                webm_item = dataset.items.upload(
+                    local_path=webm_file_path,
+                    remote_path=remote_path,
+                    overwrite=True,
+                    item_metadata=item_metadata
+                )
+            except Exception:
+                if i_try == UPLOAD_RETRIES - 1:
+                    raise
+                logger.exception('failed to upload {}, try {}/{}'.format(webm_file_path, i_try + 1, UPLOAD_RETRIES))
+                continue
+            if isinstance(webm_item, dl.Item):
+                break
+            logger.warning('failed to upload {}, try {}/{}'.format(webm_file_path, i_try + 1, UPLOAD_RETRIES))
 
         return webm_item
 
     @staticmethod
-    def _set_item_modality(item: dl.Item, modality_item):
+    def _set_item_modality(item: dl.Item, modality_item, rendition_items=None, session=None):
         """
         set the item modality
 
         :param dl.item item: the item object of the file
         :param dl.item modality_item: the webm item
+        :param list rendition_items: webm items of the other renditions, each added as a preview modality
+        :param MetadataSession session: collects the update for its flush, the item is updated right away when None
         :return: the uploaded item
         """
         d = datetime.datetime.utcnow()
@@ -195,31 +842,86 @@ class WebmConverter(dl.BaseServiceRunner):
             name=modality_item.name,
             timestamp=int(now)
         )
+        for rendition_item in rendition_items or list():
+            item.modalities.create(
+                modality_type='preview',
+                ref=rendition_item.id,
+                ref_type=dl.MODALITY_REF_TYPE_ID,
+                name=rendition_item.name,
+                timestamp=int(now)
+            )
+        if session is not None:
+            session.modalities_changed()
+            return
         item.update(system_metadata=True)
         item.dataset.items.update(filters=dl.Filters(field='spec.parentDatasetItemId',
                                                      values=item.id, use_defaults=False),
                                   system_update_values={'modalities': item.metadata['system'].get('modalities', [])},
                                   system_metadata=True)
 
-    def verify_webm_conversion(self, webm_filepath: str, orig_metadata: dict, item=None):
+    def verify_webm_conversion(self,
+                               webm_filepath: str,
+                               orig_metadata: dict,
+                               item=None,
+                               encoded_frames=None,
+                               orig_filepath=None,
+                               with_headers=False,
+                               session=None,
+                               rendition_name=None,
+                               webm_packets=None,
+                               orig_packets=None):
         """
         Check and add validation to the webm output
 
         :param str webm_filepath: the webm file (output file of the converter method)
         :param dict orig_metadata: dict of the original file metadata
         :param dl.item item: the item object of the file
+        :param int encoded_frames: frames count from the encoder final statistics, used by the fast level
+        :param str orig_filepath: the source path or stream url, used by the packets level
+        :param bool with_headers: orig_filepath is an url item
+        :param MetadataSession session: collects the errors for its flush, the item is updated right away when None
+        :param str rendition_name: the webm is this rendition, its errors get their own types (e.g webFPSDiff_480p)
+                                   so they do not replace the errors of the main webm
+        :param dict webm_packets: count and pts of the webm packets when already read (see read_packets),
+                                  the webm is not read again for them
+        :param dict orig_packets: count and pts of the source packets when already read, used by the packets level
         """
-        webm_ffprobe = video_utilities.metadata_extractor_from_ffmpeg(stream=webm_filepath, with_headers=False)
-
-        webm_nb_read_frames = webm_ffprobe.get('nb_read_frames', None)
-        if webm_nb_read_frames is None:
-            webm_nb_read_frames = webm_ffprobe.get('nb_frames', None)
-        webm_nb_read_frames = int(webm_nb_read_frames) if webm_nb_read_frames is not None else None
+        verify_timeout = video_utilities.stage_timeout(stage='verify',
+                                                       duration=orig_metadata.get('duration', None),
+                                                       nb_frames=video_utilities.frame_count(metadata=orig_metadata),
+                                                       fps=orig_metadata.get('fps', None))
+        packets_level = self.verification == VerificationLevel.PACKETS and orig_filepath is not None
+        if packets_level and (webm_packets is None or webm_packets['pts'] is None):
+            # the count and the timestamps in a single pass
+            webm_packets = video_utilities.read_packets(stream=webm_filepath, timeout=verify_timeout)
+        # webm has one packet per shown frame, the fast level takes the encoder count or the packets count
+        known_frames = encoded_frames
+        if known_frames is None and webm_packets is not None:
+            known_frames = webm_packets['count']
+        webm_ffprobe = video_utilities.metadata_extractor_from_ffmpeg(
+            stream=webm_filepath,
+            with_headers=False,
+            count_frames=self.verification == VerificationLevel.STRICT,
+            count_packets=known_frames is None,
+            timeout=verify_timeout
+        )
 
-        orig_nb_read_frames = orig_metadata.get('nb_read_frames', None)
-        if orig_nb_read_frames is None:
-            orig_nb_read_frames = orig_metadata.get('nb_frames', None)
-        orig_nb_read_frames = int(orig_nb_read_frames) if orig_nb_read_frames is not None else None
+        webm_nb_read_frames = video_utilities.frame_count(metadata=webm_ffprobe)
+        if self.verification != VerificationLevel.STRICT and known_frames is not None:
+            webm_nb_read_frames = int(known_frames)
+        orig_nb_read_frames = video_utilities.frame_count(metadata=orig_metadata)
+        packet_errors = list()
+        if packets_level:
+            if orig_packets is None:
+                orig_packets = video_utilities.read_packets(stream=orig_filepath,
+                                                            with_headers=with_headers,
+                                                            timeout=verify_timeout)
+            # every packet is a frame, the packets without a timestamp (N/A) are only left out of the timestamps
+            webm_nb_read_frames = webm_packets['count']
+            orig_nb_read_frames = orig_packets['count']
+            packet_errors = video_utilities.compare_packet_timestamps(orig_pts=orig_packets['pts'],
+                                                                      webm_pts=webm_packets['pts'],
+                                                                      fps=orig_metadata.get('fps', None))
 
         webm_fps = webm_ffprobe['fps']
         orig_fps = orig_metadata['fps']
@@ -260,31 +962,171 @@ class WebmConverter(dl.BaseServiceRunner):
                                                        err_value=abs(orig_nb_read_frames - webm_nb_read_frames),
                                                        service_name='WebmConverter'))
             success = False
+        # where the frames were dropped, inserted or moved
+        if len(packet_errors) > 0:
+            err_dict.extend(packet_errors)
+            success = False
         if not success:
-            video_utilities.update_item_errors(item=item, error_dicts=err_dict)
+            if rendition_name is not None:
+                for err in err_dict:
+                    err['type'] = '{}_{}'.format(err['type'], rendition_name)
+            if session is not None:
+                session.add_errors(error_dicts=err_dict)
+            else:
+                video_utilities.update_item_errors(item=item, error_dicts=err_dict)
         return success, summary
 
-    def webm_converter(self,
-                       item: dl.Item,
-                       workdir,
-                       progress=None,
-                       ):
+    def _download_stage(self, item: dl.Item, workdir, artifacts, log_header, session):
         """
-        Convert to webm for web
+        get the path ffprobe/ffmpeg read the source from, a local download or the item stream url
 
-        :param dl.item item: the item object of the file
-        :param str workdir: the dir that have the input and output files
-        :param progress: progress
-        :return:
+        :return: the source file path / url
         """
-        log_header = '[preprocess][on_create][{item_id}][{func}]'.format(item_id=item.id, func='webm-converter')
-        webm_filepath = os.path.join(workdir, '{}.webm'.format(item.id))
+        if self.input_mode == InputMode.STREAM:
+            if self._source_reads(item=item) == 1:
+                # ffmpeg reads the source from the platform while encoding, no local copy
+                logger.info('{header} streaming item'.format(header=log_header))
+                return item.stream
+            # every pass would fetch the whole source from the platform again
+            logger.info('{header} the conversion reads the source more than once, downloading it'.format(
+                header=log_header))
+        artifact = artifacts.get(Stage.DOWNLOAD)
+        if artifact is not None and _is_complete_file(filepath=artifact['filepath'], size=artifact['size']):
+            logger.info('{header} reusing downloaded item'.format(header=log_header))
+            return artifact['filepath']
+        logger.info('{header} downloading item'.format(header=log_header))
         orig_filepath = os.path.join(workdir, item.name)
         orig_filepath = item.download(local_path=orig_filepath)
+        session.count(name='download')
+        artifacts.done(Stage.DOWNLOAD, {'filepath': orig_filepath, 'size': os.path.getsize(orig_filepath)})
+        return orig_filepath
+
+    def _clone_cached(self, item: dl.Item, cached_item, key, workdir, log_header, session):
+        """
+        copy a cached webm item, and its seek index sidecar, under the outputs of this item
+        the cached item belongs to another source item, it is replaced or deleted when that item is converted again
+
+        :return: the copied webm item and seek index item (None without seek index),
+                 None, None when they could not be made and the item is converted
+        """
+        webm_name = '{}.webm'.format(item.id)
+        cached_seek_index_id = conversion_cache.seek_index_item_id(webm_item=cached_item)
+        if self.seek_index and cached_seek_index_id is None:
+            logger.info('{header} cached webm item {webm_id} has no seek index'.format(header=log_header,
+                                                                                     webm_id=cached_item.id))
+            return None, None
+        try:
+            seek_index_item = None
+            if self.seek_index:
+                # the sidecar names its webm, it is written again for the copy
+                downloaded_filepath = dl.items.get(item_id=cached_seek_index_id).download(local_path=workdir)
+                session.count(name='item_get')
+                session.count(name='download')
+                with open(downloaded_filepath, 'r') as f:
+                    seek_index = json.load(f)
+                os.remove(downloaded_filepath)
+                seek_index['webm'] = webm_name
+                seek_index_filepath = _seek_index_filepath(workdir=workdir, item_id=item.id)
+                with open(seek_index_filepath, 'w') as f:
+                    json.dump(seek_index, f)
+                # not recorded as an uploaded file, a conversion after a failed copy uploads its own sidecar over it
+                seek_index_item = self._upload_webm_item(item=item, webm_file_path=seek_index_filepath)
+                session.count(name='upload')
+                if not isinstance(seek_index_item, dl.Item):
+                    raise Exception('Failed to upload {}'.format(os.path.basename(seek_index_filepath)))
+            webm_item = cached_item.clone(
+                remote_filepath='{}/{}'.format(_webm_remote_path(item=item), webm_name),
+                metadata=conversion_cache.cache_key_metadata(
+                    key=key,
+                    seek_index_item_id=seek_index_item.id if seek_index_item is not None else None)
+            )
+            session.count(name='item_clone')
+        except Exception:
+            logger.exception('{header} failed to copy the cached webm item {webm_id}'.format(header=log_header,
+                                                                                            webm_id=cached_item.id))
+            return None, None
+        return webm_item, seek_index_item
+
+    def _cache_stage(self, item: dl.Item, workdir, orig_filepath, artifacts, log_header, session):
+        """
+        get the conversion cache key of the source and look for a webm item of the same source in the dataset,
+        a found webm item is copied under the outputs of this item
+
+        :return: the cache key (None when caching is off or the source hash is unknown), the copied webm item or None,
+                 the copied seek index item or None
+        """
+        if self.local_cache is None and not self.cache_lookup_platform:
+            return None, None, None
+        artifact = artifacts.get(Stage.CACHE)
+        if artifact is not None:
+            webm_item = None
+            if artifact['item_id'] is not None:
+                webm_item = dl.items.get(item_id=artifact['item_id'])
+                session.count(name='item_get')
+            seek_index_item = None
+            if artifact.get('seek_index_id', None) is not None:
+                seek_index_item = dl.items.get(item_id=artifact['seek_index_id'])
+                session.count(name='item_get')
+            return artifact['key'], webm_item, seek_index_item
+        content_hash = item.metadata['system'].get('md5', None)
+        if content_hash is None and not _is_stream_url(orig_filepath):
+            content_hash = conversion_cache.file_md5(filepath=orig_filepath)
+        if content_hash is None:
+            # a streamed source without an md5 is not read twice just for the hash
+            return None, None, None
+        key = conversion_cache.cache_key(content_hash=content_hash,
+                                         method=self.method,
+                                         encoder_profile=self.profile_label,
+                                         keyframe_interval=self.keyframe_interval,
+                                         seek_index=self.seek_index)
+        webm_item = None
+        seek_index_item = None
+        if self.cache_lookup_platform:
+            dataset = dl.datasets.get(fetch=False, dataset_id=item.datasetId)
+            cached_item = conversion_cache.find_webm_item(dataset=dataset, key=key)
+            session.count(name='item_query')
+            if cached_item is not None:
+                logger.info('{header} found converted webm item {webm_id}'.format(header=log_header,
+                                                                                 webm_id=cached_item.id))
+                webm_item, seek_index_item = self._clone_cached(item=item,
+                                                                cached_item=cached_item,
+                                                                key=key,
+                                                                workdir=workdir,
+                                                                log_header=log_header,
+                                                                session=session)
+        artifacts.done(Stage.CACHE, {'key': key,
+                                     'item_id': webm_item.id if webm_item is not None else None,
+                                     'seek_index_id': seek_index_item.id if seek_index_item is not None else None})
+        return key, webm_item, seek_index_item
 
+    def _probe_stage(self, item: dl.Item, orig_filepath, artifacts, log_header):
+        """
+        get the source metadata and the codec plan
+
+        :return: dict of the source metadata, the codec plan (None for the opencv method)
+        """
+        artifact = artifacts.get(Stage.PROBE)
+        if artifact is not None:
+            logger.info('{header} reusing probe result'.format(header=log_header))
+            return artifact['metadata'], artifact['codec_plan']
+        with_headers = _is_stream_url(orig_filepath)
+        # the probe runs before the duration is known from ffprobe, use the one the platform extracted
+        probe_timeout = video_utilities.stage_timeout(stage='probe',
+                                                      duration=item.metadata['system'].get('duration', None))
+        # a copied source is checked against the keyframe interval, its packets are counted in the same pass
+        count_with_keyframes = bool(self.keyframe_interval) and self.method == ConversionMethod.FFMPEG and \
+            self.verification != VerificationLevel.STRICT
+        probed = False
         # if metadata in the item no need to extract it
         if 'ffmpeg' not in item.metadata['system'] or 'nb_read_frames' not in item.metadata['system']['ffmpeg']:
-            orig_metadata = video_utilities.metadata_extractor_from_ffmpeg(stream=orig_filepath, with_headers=False)
+            orig_metadata = video_utilities.metadata_extractor_from_ffmpeg(
+                stream=orig_filepath,
+                with_headers=with_headers,
+                count_frames=self.verification == VerificationLevel.STRICT,
+                count_packets=not count_with_keyframes,
+                timeout=probe_timeout
+            )
+            probed = True
         else:
             orig_metadata = {
                 'ffmpeg': item.metadata['system']['ffmpeg'],
@@ -304,34 +1146,246 @@ class WebmConverter(dl.BaseServiceRunner):
             if item.metadata['system']['ffmpeg'].get('nb_frames', None) is not None:
                 orig_metadata['nb_frames'] = int(item.metadata['system']['ffmpeg']['nb_frames'])
 
-        logger.info('{header} downloading item'.format(header=log_header))
+        codec_plan = None
+        if self.method == ConversionMethod.FFMPEG:
+            # the probe of the source has the audio codec, the platform metadata does not
+            audio_codec = orig_metadata.get('audio_codec', None)
+            if 'audio_codec' not in orig_metadata and int(orig_metadata.get('nb_streams', 1)) > 1:
+                audio_codec = video_utilities.extract_audio_codec(stream=orig_filepath,
+                                                                  with_headers=with_headers,
+                                                                  timeout=probe_timeout)
+            codec_plan = video_utilities.select_codec_plan(video_codec=orig_metadata['ffmpeg'].get('codec_name'),
+                                                           audio_codec=audio_codec)
+            if codec_plan['video'] == 'copy' and self.keyframe_interval:
+                # -g does not apply to a copied stream, the source keyframes must already be close enough
+                packets = video_utilities.read_packets(stream=orig_filepath,
+                                                       with_headers=with_headers,
+                                                       timeout=probe_timeout)
+                if probed and count_with_keyframes:
+                    orig_metadata['nb_read_packets'] = packets['count']
+                gap = video_utilities.max_keyframe_gap(keyframes=packets['keyframes'],
+                                                       duration=orig_metadata.get('duration', None))
+                fps = float(orig_metadata.get('fps', None) or 0)
+                if gap is None or gap > self.keyframe_interval + (1 / fps if fps > 0 else 0):
+                    logger.warning('{} source keyframes are {}[s] apart, over the keyframe interval of {}[s], '
+                                   'encoding the video instead of copying it'.format(log_header,
+                                                                                     gap,
+                                                                                     self.keyframe_interval))
+                    codec_plan['video'] = 'encode'
+            elif probed and count_with_keyframes:
+                # an encoded source needs its packet count only
+                orig_metadata['nb_read_packets'] = video_utilities.count_packets(stream=orig_filepath,
+                                                                                 with_headers=with_headers,
+                                                                                 timeout=probe_timeout)
+            logger.info('{} codec plan: {}'.format(log_header, codec_plan))
+        artifacts.done(Stage.PROBE, {'metadata': orig_metadata, 'codec_plan': codec_plan})
+        return orig_metadata, codec_plan
+
+    def _encode_timeout(self, plan, orig_metadata):
+        """
+        wall clock budget of the encode - encode_budget_factor times the encode time the cost model predicts for
+        the plan, over the base budget of the stage. the fixed budget per second of video when there is no prediction
+
+        :return: budget in seconds, None when the length of the video is unknown
+        """
+        prediction = plan.get('prediction', None)
+        if prediction is not None:
+            base, _ = video_utilities.STAGE_BUDGETS['encode']
+            return base + self.encode_budget_factor * prediction['encode_seconds']
+        return video_utilities.stage_timeout(stage='encode',
+                                             duration=orig_metadata.get('duration', None),
+                                             nb_frames=video_utilities.frame_count(metadata=orig_metadata),
+                                             fps=orig_metadata['fps'])
 
-        logger.info('{} converting with {}'.format(log_header, self.method))
-        valid_data, msg = video_utilities.validate_metadata(metadata=orig_metadata)
-        if not valid_data:
-            return valid_data, msg
+    def _encode_stage(self,
+                      item: dl.Item,
+                      workdir,
+                      orig_filepath,
+                      orig_metadata,
+                      codec_plan,
+                      artifacts,
+                      log_header,
+                      progress=None,
+                      cache_key=None,
+                      plan=None,
+                      timeout_scale=1):
+        """
+        convert the source to the webm file of the workdir
+        plan is the encoder profile, threads and segmentation of plan_encode, the converter settings when None
+        the wall clock budget of the encode is multiplied by timeout_scale
+
+        :return: number of frames written by the encoder, None when unknown
+        """
+        webm_filepath = os.path.join(workdir, '{}.webm'.format(item.id))
+        artifact = artifacts.get(Stage.ENCODE)
+        if artifact is not None and _is_complete_file(filepath=webm_filepath, size=artifact['size']):
+            logger.info('{header} reusing encoded webm'.format(header=log_header))
+            return artifact['encoded_frames']
+        if cache_key is not None and self.local_cache is not None and self.local_cache.get(key=cache_key,
+                                                                                           output_filepath=webm_filepath):
+            logger.info('{header} webm found in the local conversion cache'.format(header=log_header))
+            artifacts.done(Stage.ENCODE, {'size': os.path.getsize(webm_filepath),
+                                          'encoded_frames': None,
+                                          'packets': self._index_packets(webm_filepath=webm_filepath,
+                                                                         orig_metadata=orig_metadata,
+                                                                         encoded_frames=None)})
+            return None
+        if plan is None:
+            plan = {'profile': self.encoder_profile, 'threads': None, 'segment_duration': self.segment_duration}
+        threads = plan['threads']
+        with_headers = _is_stream_url(orig_filepath)
+        timeout = self._encode_timeout(plan=plan, orig_metadata=orig_metadata)
+        if timeout is not None:
+            timeout *= timeout_scale
+        logger.info('{} converting with {}, encode budget {}[s]'.format(log_header, self.method, timeout))
+        encoded_frames = None
         tic = time.time()
-        if self.method == ConversionMethod.FFMPEG:
-            self.convert_to_webm_ffmpeg(
+        video_duration = orig_metadata.get('duration', None)
+        segment_duration = plan['segment_duration']
+        segmented = segment_duration and (video_duration is None or video_duration > 2 * segment_duration)
+        renditions = [(rendition, _rendition_filepath(workdir=workdir, item_id=item.id, rendition=rendition))
+                      for rendition in self.renditions]
+        thumbnails_filepath = _thumbnails_filepath(workdir=workdir, item_id=item.id) if self.thumbnail_strip else None
+        if renditions or thumbnails_filepath:
+            # all the outputs come from a single decode of the source
+            segmented = False
+        if self.method == ConversionMethod.FFMPEG and codec_plan['video'] == 'copy':
+            # already web playable - remux only
+            encoded_frames = self.convert_to_webm_ffmpeg(
                 input_filepath=orig_filepath,
                 output_filepath=webm_filepath,
                 fps=orig_metadata['fps'],
-                nb_frames=orig_metadata.get('nb_read_frames', None),
-                progress=progress
+                nb_frames=video_utilities.frame_count(metadata=orig_metadata),
+                progress=progress,
+                with_headers=with_headers,
+                codec_plan=codec_plan,
+                threads=threads,
+                encoder_profile=plan['profile'],
+                renditions=renditions,
+                thumbnails_filepath=thumbnails_filepath,
+                nb_thumbnails=self.thumbnail_strip,
+                timeout=timeout
+            )
+        elif self.method == ConversionMethod.FFMPEG and segmented:
+            encoded_frames = self.convert_to_webm_ffmpeg_segmented(
+                input_filepath=orig_filepath,
+                output_filepath=webm_filepath,
+                fps=orig_metadata['fps'],
+                workdir=workdir,
+                nb_frames=video_utilities.frame_count(metadata=orig_metadata),
+                progress=progress,
+                with_headers=with_headers,
+                codec_plan=codec_plan,
+                cpus=threads,
+                segment_duration=segment_duration,
+                encoder_profile=plan['profile'],
+                timeout=timeout
+            )
+        elif self.method == ConversionMethod.FFMPEG:
+            encoded_frames = self.convert_to_webm_ffmpeg(
+                input_filepath=orig_filepath,
+                output_filepath=webm_filepath,
+                fps=orig_metadata['fps'],
+                nb_frames=video_utilities.frame_count(metadata=orig_metadata),
+                progress=progress,
+                with_headers=with_headers,
+                codec_plan=codec_plan,
+                threads=threads,
+                encoder_profile=plan['profile'],
+                renditions=renditions,
+                thumbnails_filepath=thumbnails_filepath,
+                nb_thumbnails=self.thumbnail_strip,
+                timeout=timeout
             )
         elif self.method == ConversionMethod.OPENCV:
             self.convert_to_webm_opencv(
                 item=item,
                 dir_path=workdir,
-                nb_streams=orig_metadata.get('nb_streams', 1))
+                nb_streams=orig_metadata.get('nb_streams', 1),
+                timeout=timeout)
         else:
             raise Exception(" unsupported converter method")
 
         duration = time.time() - tic
+        logger.info(
+            '{header} converted with {method}. conversion took: {dur}[s]'.format(
+                header=log_header,
+                method=self.method,
+                dur=duration
+            )
+        )
+        artifacts.done(Stage.ENCODE, {'size': os.path.getsize(webm_filepath),
+                                      'encoded_frames': encoded_frames,
+                                      'packets': self._index_packets(webm_filepath=webm_filepath,
+                                                                     orig_metadata=orig_metadata,
+                                                                     encoded_frames=encoded_frames)})
+        return encoded_frames
+
+    def _index_packets(self, webm_filepath, orig_metadata, encoded_frames):
+        """
+        one pass over the packets of the webm for the verification and the seek index - the frame count, the
+        timestamps and the keyframes. the timestamps are saved next to the webm for the packets verification
+
+        :return: dict of count, keyframes and pts_filepath (None without timestamps), None when nothing uses them
+        """
+        packets_verification = self.verification == VerificationLevel.PACKETS
+        fast_without_count = self.verification == VerificationLevel.FAST and encoded_frames is None
+        if not (self.seek_index or packets_verification or fast_without_count):
+            return None
+        packets = video_utilities.read_packets(
+            stream=webm_filepath,
+            timeout=video_utilities.stage_timeout(stage='verify',
+                                                  duration=orig_metadata.get('duration', None),
+                                                  nb_frames=video_utilities.frame_count(metadata=orig_metadata),
+                                                  fps=orig_metadata.get('fps', None)))
+        pts_filepath = None
+        if packets_verification and packets['pts'] is not None:
+            pts_filepath = os.path.splitext(webm_filepath)[0] + '.pts.npy'
+            np.save(pts_filepath, packets['pts'])
+        return {'count': packets['count'], 'keyframes': packets['keyframes'], 'pts_filepath': pts_filepath}
+
+    def _verify_stage(self, item: dl.Item, workdir, orig_filepath, orig_metadata, encoded_frames, artifacts,
+                      log_header, session):
+        """
+        verify the webm against the source, mismatches are written to the item errors
+
+        :return: True when the webm and the renditions passed the verification
+        """
+        artifact = artifacts.get(Stage.VERIFY)
+        if artifact is not None:
+            logger.info('{header} reusing verification result'.format(header=log_header))
+            # run() cleans the item errors before every try, put back the ones of the verification
+            if len(artifact['errors']) > 0:
+                session.add_errors(error_dicts=artifact['errors'])
+            return artifact.get('verified', True)
+        webm_filepath = os.path.join(workdir, '{}.webm'.format(item.id))
+        # the packets of the webm were read once at the end of the encode
+        packets = (artifacts.get(Stage.ENCODE) or dict()).get('packets', None)
+        webm_packets = None
+        if packets is not None:
+            webm_packets = {'count': packets['count'], 'pts': None}
+            if packets['pts_filepath'] is not None and os.path.isfile(packets['pts_filepath']):
+                webm_packets['pts'] = np.load(packets['pts_filepath'])
+        orig_packets = None
+        if self.verification == VerificationLevel.PACKETS:
+            # the source is read once for the webm and all the renditions
+            orig_packets = video_utilities.read_packets(
+                stream=orig_filepath,
+                with_headers=_is_stream_url(orig_filepath),
+                timeout=video_utilities.stage_timeout(stage='verify',
+                                                      duration=orig_metadata.get('duration', None),
+                                                      nb_frames=video_utilities.frame_count(metadata=orig_metadata),
+                                                      fps=orig_metadata.get('fps', None)))
         same, summary = self.verify_webm_conversion(
             webm_filepath=webm_filepath,
             orig_metadata=orig_metadata,
-            item=item
+            item=item,
+            encoded_frames=encoded_frames,
+            orig_filepath=orig_filepath,
+            with_headers=_is_stream_url(orig_filepath),
+            session=session,
+            webm_packets=webm_packets,
+            orig_packets=orig_packets
         )
 
         # check video correctness fps * duration == frames number
@@ -342,52 +1396,602 @@ class WebmConverter(dl.BaseServiceRunner):
                                                                                 'webm_start_time'],
                                                                             prefix_check='web')
         if not validate:
-            video_utilities.update_item_errors(item=item, error_dicts=validate_msg)
-            video_utilities.send_error_event(item)
+            session.add_errors(error_dicts=validate_msg, error_event=True)
+        verified = same and validate
+        for rendition in self.renditions:
+            rendition_filepath = _rendition_filepath(workdir=workdir, item_id=item.id, rendition=rendition)
+            if os.path.isfile(rendition_filepath):
+                rendition_same, _ = self.verify_webm_conversion(webm_filepath=rendition_filepath,
+                                                                orig_metadata=orig_metadata,
+                                                                item=item,
+                                                                orig_filepath=orig_filepath,
+                                                                with_headers=_is_stream_url(orig_filepath),
+                                                                session=session,
+                                                                rendition_name=rendition['name'],
+                                                                orig_packets=orig_packets)
+                verified = verified and rendition_same
+        errors = [err for err in item.metadata['system'].get('errors', [])
+                  if err.get('service', '') == 'WebmConverter']
+        artifacts.done(Stage.VERIFY, {'summary': summary, 'errors': errors, 'verified': verified})
+        return verified
 
-        logger.info(
-            '{header} converted with {method}. conversion took: {dur}[s]'.format(
-                header=log_header,
-                method=self.method,
-                dur=duration
+    def _preview_stage(self, job):
+        """
+        encode, upload and link the preview rendition
+        a failed preview is logged and the full conversion goes on
+        """
+        if not self.preview or job.artifacts.get(Stage.PREVIEW) is not None:
+            return
+        if self.method != ConversionMethod.FFMPEG or job.codec_plan['video'] == 'copy':
+            # a remux is about as fast as the preview itself
+            return
+        item = job.item
+        preview_dir = os.path.join(job.workdir, 'preview')
+        os.makedirs(preview_dir, exist_ok=True)
+        preview_filepath = os.path.join(preview_dir, '{}_preview.webm'.format(item.id))
+        try:
+            self.convert_to_webm_preview(
+                input_filepath=job.orig_filepath,
+                output_filepath=preview_filepath,
+                fps=job.orig_metadata['fps'],
+                nb_frames=video_utilities.frame_count(metadata=job.orig_metadata),
+                with_headers=_is_stream_url(job.orig_filepath),
+                threads=job.threads,
+                timeout=video_utilities.stage_timeout(stage='encode',
+                                                      duration=job.orig_metadata.get('duration', None))
             )
-        )
+            preview_item = self._upload_webm_item(item=item, webm_file_path=preview_filepath)
+            job.session.count(name='upload')
+            if not isinstance(preview_item, dl.Item):
+                raise Exception('Failed to upload webm preview')
+            # the preview is published right away, with the metadata changes so far
+            self._set_item_modality(item=item, modality_item=preview_item, session=job.session)
+            job.session.flush()
+        except video_utilities.CommandCancelledError:
+            # a cancelled execution stops here, it is not a failed preview
+            raise
+        except Exception:
+            logger.exception('{header} failed to publish the preview'.format(header=job.log_header))
+            return
+        finally:
+            shutil.rmtree(preview_dir, ignore_errors=True)
+        logger.info('{header} preview linked'.format(header=job.log_header))
+        job.artifacts.done(Stage.PREVIEW, {'item_id': preview_item.id, 'name': preview_item.name})
+
+    def _upload_file(self, item: dl.Item, filepath, artifacts, log_header, session, item_metadata=None):
+        """
+        upload one output file of the upload stage - the upload is retried per file, not resumed within a file.
+        a file uploaded by a previous try is not sent again, a failed file is sent again whole
+
+        :return: the uploaded item
+        """
+        uploaded = artifacts.get(StageArtifacts.UPLOADED_FILES) or dict()
+        filename = os.path.basename(filepath)
+        if filename in uploaded:
+            logger.info('{header} reusing uploaded {filename}'.format(header=log_header, filename=filename))
+            session.count(name='item_get')
+            return dl.items.get(item_id=uploaded[filename])
+        tic = time.time()
+        uploaded_item = self._upload_webm_item(item=item, webm_file_path=filepath, item_metadata=item_metadata)
+        session.count(name='upload')
+        if not isinstance(uploaded_item, dl.Item):
+            raise Exception('Failed to upload {}'.format(filename))
+        uploaded[filename] = uploaded_item.id
+        artifacts.done(StageArtifacts.UPLOADED_FILES, uploaded)
+        logger.info('{header} uploaded {filename}, {size} bytes in {seconds:.1f}s'.format(
+            header=log_header,
+            filename=filename,
+            size=os.path.getsize(filepath),
+            seconds=time.time() - tic))
+        return uploaded_item
+
+    def _withdraw_upload(self, job):
+        """
+        delete the uploaded items of a job that are not linked, the next upload stage sends them again
+        """
+        uploaded = job.artifacts.get(StageArtifacts.UPLOADED_FILES) or dict()
+        for filename, item_id in uploaded.items():
+            try:
+                dl.items.delete(item_id=item_id)
+                job.session.count(name='item_delete')
+            except Exception:
+                logger.exception('{header} failed to delete the uploaded {filename}'.format(header=job.log_header,
+                                                                                          filename=filename))
+        job.artifacts.done(StageArtifacts.UPLOADED_FILES, None)
+        job.artifacts.done(Stage.UPLOAD, None)
+        job.webm_item = None
+
+    def _upload_stage(self, item: dl.Item, workdir, artifacts, log_header, session, progress=None):
+        """
+        upload the webm, the renditions and the thumbnail strip to the platform, retried per file (see _upload_file)
+        the progress is reported per uploaded file in the progress message
+
+        :return: the webm item, list of the rendition items, the thumbnail strip item or None,
+                 the seek index item or None
+        """
+        artifact = artifacts.get(Stage.UPLOAD)
+        if artifact is not None:
+            logger.info('{header} reusing uploaded webm item'.format(header=log_header))
+            rendition_items = [dl.items.get(item_id=item_id) for item_id in artifact['rendition_ids']]
+            thumbnails_item = None
+            if artifact['thumbnails_id'] is not None:
+                thumbnails_item = dl.items.get(item_id=artifact['thumbnails_id'])
+            seek_index_item = None
+            if artifact['seek_index_id'] is not None:
+                seek_index_item = dl.items.get(item_id=artifact['seek_index_id'])
+            session.count(name='item_get', n=1 + len(rendition_items) + int(thumbnails_item is not None) +
+                          int(seek_index_item is not None))
+            return dl.items.get(item_id=artifact['item_id']), rendition_items, thumbnails_item, seek_index_item
+        webm_filepath = os.path.join(workdir, '{}.webm'.format(item.id))
+        rendition_filepaths = [_rendition_filepath(workdir=workdir, item_id=item.id, rendition=rendition)
+                               for rendition in self.renditions]
+        thumbnails_filepath = _thumbnails_filepath(workdir=workdir, item_id=item.id)
+        output_filepaths = [webm_filepath, *rendition_filepaths]
+        if self.thumbnail_strip:
+            output_filepaths.append(thumbnails_filepath)
+        upload_bytes = {'done': 0,
+                        'total': sum(os.path.getsize(filepath) for filepath in output_filepaths
+                                     if os.path.isfile(filepath))}
+
+        def report_upload(filepath):
+            if progress is None:
+                return
+            upload_bytes['done'] += os.path.getsize(filepath)
+            progress.update(message='uploaded {:.1f}/{:.1f} MB'.format(upload_bytes['done'] / 1024 ** 2,
+                                                                       upload_bytes['total'] / 1024 ** 2))
 
         # upload web to platform
-        webm_item = self._upload_webm_item(
+        webm_item = self._upload_file(
             item=item,
-            webm_file_path=webm_filepath
+            filepath=webm_filepath,
+            artifacts=artifacts,
+            log_header=log_header,
+            session=session
         )
+        report_upload(filepath=webm_filepath)
+        seek_index_item = None
+        if self.seek_index:
+            # frame -> timestamp -> byte offset of every keyframe, a player seeks with a single range request
+            seek_index_filepath = _seek_index_filepath(workdir=workdir, item_id=item.id)
+            packets = (artifacts.get(Stage.ENCODE) or dict()).get('packets', None)
+            keyframes = packets['keyframes'] if packets is not None else \
+                video_utilities.keyframe_index(stream=webm_filepath)
+            with open(seek_index_filepath, 'w') as f:
+                json.dump({'webm': webm_item.name,
+                           'fields': ['frame', 'pts_time', 'pos'],
+                           'keyframes': keyframes}, f)
+            seek_index_item = self._upload_file(item=item,
+                                                filepath=seek_index_filepath,
+                                                artifacts=artifacts,
+                                                log_header=log_header,
+                                                session=session)
+        rendition_items = list()
+        for rendition_filepath in rendition_filepaths:
+            if not os.path.isfile(rendition_filepath):
+                continue
+            rendition_items.append(self._upload_file(item=item,
+                                                     filepath=rendition_filepath,
+                                                     artifacts=artifacts,
+                                                     log_header=log_header,
+                                                     session=session))
+            report_upload(filepath=rendition_filepath)
+        thumbnails_item = None
+        if self.thumbnail_strip and os.path.isfile(thumbnails_filepath):
+            thumbnails_item = self._upload_file(item=item,
+                                                filepath=thumbnails_filepath,
+                                                artifacts=artifacts,
+                                                log_header=log_header,
+                                                session=session)
+            report_upload(filepath=thumbnails_filepath)
+        artifacts.done(Stage.UPLOAD, {'item_id': webm_item.id,
+                                      'rendition_ids': [rendition_item.id for rendition_item in rendition_items],
+                                      'thumbnails_id': thumbnails_item.id if thumbnails_item is not None else None,
+                                      'seek_index_id': seek_index_item.id if seek_index_item is not None else None})
+        return webm_item, rendition_items, thumbnails_item, seek_index_item
+
+    def _prepare_job(self, job):
+        """
+        download, cache and probe stages - everything before the encode
+        """
+        item = job.item
+        with job.metrics.stage(Stage.DOWNLOAD):
+            job.orig_filepath = self._download_stage(item=item,
+                                                     workdir=job.workdir,
+                                                     artifacts=job.artifacts,
+                                                     log_header=job.log_header,
+                                                     session=job.session)
+        if job.artifacts.get(Stage.DOWNLOAD) is not None:
+            job.metrics.input_bytes = job.artifacts.get(Stage.DOWNLOAD)['size']
+        else:
+            job.metrics.input_bytes = item.metadata['system'].get('size', None)
+        with job.metrics.stage(Stage.CACHE):
+            job.cache_key, job.webm_item, job.seek_index_item = self._cache_stage(item=item,
+                                                                                  workdir=job.workdir,
+                                                                                  orig_filepath=job.orig_filepath,
+                                                                                  artifacts=job.artifacts,
+                                                                                  log_header=job.log_header,
+                                                                                  session=job.session)
+        # a webm of the same source is already on the platform - link it, nothing to convert
+        if job.webm_item is not None:
+            return
+        with job.metrics.stage(Stage.PROBE):
+            job.orig_metadata, job.codec_plan = self._probe_stage(item=item,
+                                                                  orig_filepath=job.orig_filepath,
+                                                                  artifacts=job.artifacts,
+                                                                  log_header=job.log_header)
+        job.metrics.video_duration = job.orig_metadata.get('duration', None)
+        job.valid, job.msg = video_utilities.validate_metadata(metadata=job.orig_metadata)
+        if job.valid:
+            job.plan = self.plan_encode(orig_metadata=job.orig_metadata,
+                                        codec_plan=job.codec_plan,
+                                        threads=job.threads,
+                                        input_bytes=job.metrics.input_bytes)
+            job.metrics.source = {'profile': job.plan['profile'],
+                                  'codec': job.orig_metadata['ffmpeg'].get('codec_name', None),
+                                  'width': job.orig_metadata.get('width', None),
+                                  'height': job.orig_metadata.get('height', None),
+                                  'frames': video_utilities.frame_count(metadata=job.orig_metadata),
+                                  'threads': job.plan['threads'],
+                                  'copy': job.codec_plan is not None and job.codec_plan['video'] == 'copy',
+                                  'segmented': bool(job.plan['segment_duration']),
+                                  'predicted_seconds': (job.plan['prediction'] or dict()).get('encode_seconds', None)}
+            logger.info('{} encode plan: {}'.format(job.log_header, job.plan))
+
+    def _convert_job(self, job, progress=None):
+        """
+        preview and encode stages, nothing to do for a job linked to a cached webm item
+        """
+        if job.webm_item is not None:
+            return
+        with job.metrics.stage(Stage.PREVIEW):
+            self._preview_stage(job=job)
+        with job.metrics.stage(Stage.ENCODE):
+            encoded_frames = self._encode_stage(item=job.item,
+                                                workdir=job.workdir,
+                                                orig_filepath=job.orig_filepath,
+                                                orig_metadata=job.orig_metadata,
+                                                codec_plan=job.codec_plan,
+                                                artifacts=job.artifacts,
+                                                log_header=job.log_header,
+                                                progress=progress,
+                                                cache_key=job.cache_key,
+                                                plan=job.plan,
+                                                timeout_scale=job.timeout_scale)
+        job.encoded_frames = encoded_frames
+        job.metrics.output_bytes = job.artifacts.get(Stage.ENCODE)['size']
+
+    def _verify_job(self, job):
+        with job.metrics.stage(Stage.VERIFY):
+            return self._verify_stage(item=job.item,
+                                      workdir=job.workdir,
+                                      orig_filepath=job.orig_filepath,
+                                      orig_metadata=job.orig_metadata,
+                                      encoded_frames=job.encoded_frames,
+                                      artifacts=job.artifacts,
+                                      log_header=job.log_header,
+                                      session=job.session)
+
+    def _cache_output(self, job):
+        """
+        cache the verified webm - on local disk and as the cache key in the metadata of the webm item
+        an unverified webm is never returned for another item
+        """
+        if job.cache_key is None:
+            return
+        if self.local_cache is not None:
+            self.local_cache.put(key=job.cache_key,
+                                 webm_filepath=os.path.join(job.workdir, '{}.webm'.format(job.item.id)))
+        seek_index_item_id = job.seek_index_item.id if job.seek_index_item is not None else None
+        job.webm_item.metadata.update(conversion_cache.cache_key_metadata(key=job.cache_key,
+                                                                          seek_index_item_id=seek_index_item_id))
+        job.webm_item.update()
+        job.session.count(name='item_update')
 
-        if not isinstance(webm_item, dl.Item):
-            raise Exception('Failed to upload webm')
+    def _publish_job(self, job, progress=None):
+        """
+        verify, upload and link stages
+        the verification runs while the outputs are uploaded, the webm is linked when both finished
+
+        :param progress: progress, gets the uploaded bytes
+        """
+        item = job.item
+        if job.webm_item is None:
+            verify_artifact = job.artifacts.get(Stage.VERIFY)
+            if self.reject_unverified and verify_artifact is not None and not verify_artifact.get('verified', True):
+                raise ValueError('webm failed the verification: {}'.format(verify_artifact['errors']))
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                verify_future = executor.submit(video_utilities.bind_command_runner(self._verify_job), job)
+                with job.metrics.stage(Stage.UPLOAD):
+                    job.webm_item, job.rendition_items, job.thumbnails_item, job.seek_index_item = \
+                        self._upload_stage(item=item,
+                                           workdir=job.workdir,
+                                           artifacts=job.artifacts,
+                                           log_header=job.log_header,
+                                           session=job.session,
+                                           progress=progress)
+            # a failed verification command raises here, the uploaded items stay unlinked for the next try
+            verified = verify_future.result()
+            if not verified and self.reject_unverified:
+                self._withdraw_upload(job=job)
+                raise ValueError('webm failed the verification: {}'.format(job.artifacts.get(Stage.VERIFY)['errors']))
+            if verified:
+                self._cache_output(job=job)
 
         # set modality on original
-        self._set_item_modality(
-            item=item,
-            modality_item=webm_item
-        )
+        if job.artifacts.get(Stage.LINK) is None:
+            # saved with the errors and the modalities in the single update of the session
+            fingerprint = source_fingerprint(item=item,
+                                             method=self.method,
+                                             encoder_profile=self.profile_label,
+                                             keyframe_interval=self.keyframe_interval,
+                                             seek_index=self.seek_index)
+            fingerprint['webmItemId'] = job.webm_item.id
+            job.session.set_system(key='webmFingerprint', value=fingerprint)
+            if job.thumbnails_item is not None:
+                job.session.set_system(key='webmThumbnails', value={'itemId': job.thumbnails_item.id,
+                                                                    'count': self.thumbnail_strip})
+            if job.seek_index_item is not None:
+                job.session.set_system(key='webmSeekIndex', value={'itemId': job.seek_index_item.id})
+            preview = job.artifacts.get(Stage.PREVIEW)
+            with job.metrics.stage(Stage.LINK):
+                if preview is not None:
+                    # the full webm replaces the preview
+                    item.modalities.delete(name=preview['name'])
+                self._set_item_modality(
+                    item=item,
+                    modality_item=job.webm_item,
+                    rendition_items=job.rendition_items,
+                    session=job.session
+                )
+                if self.metrics_to_item:
+                    job.session.set_system(key='webmConverterMetrics', value=job.metrics.compact())
+                job.session.flush()
+            job.artifacts.done(Stage.LINK, {'item_id': job.webm_item.id})
+            if preview is not None:
+                try:
+                    dl.items.delete(item_id=preview['item_id'])
+                    job.session.count(name='item_delete')
+                except Exception:
+                    logger.exception('{header} failed to delete the preview item'.format(header=job.log_header))
+
+    def webm_converter(self,
+                       item: dl.Item,
+                       workdir,
+                       progress=None,
+                       metrics=None,
+                       threads=None,
+                       session=None,
+                       timeout_scale=1
+                       ):
+        """
+        Convert to webm for web
+        runs the stages download, cache, probe, encode, verify, upload and link. the artifact of every finished stage
+        is kept in the workdir, calling again with the same workdir resumes from the first unfinished stage.
+        a webm item of the same source found by the cache stage is linked without converting
 
+        :param dl.item item: the item object of the file
+        :param str workdir: the dir that have the input and output files
+        :param progress: progress
+        :param ItemMetrics metrics: collects the stage timings, a new one when None
+        :param int threads: encoder threads of the execution, all the available cpus when None
+        :param MetadataSession session: the metadata writes of the item, a new one when None
+        :param float timeout_scale: multiplies the wall clock budget of the encode
+        :return:
+        """
+        job = ConversionJob(item=item, workdir=workdir, metrics=metrics, threads=threads, session=session)
+        job.timeout_scale = timeout_scale
+        self._prepare_job(job=job)
+        if not job.valid:
+            return job.valid, job.msg
+        self._convert_job(job=job, progress=progress)
+        self._publish_job(job=job, progress=progress)
         return True, ''
 
-    def run(self, item: dl.Item, progress=None):
-        ##################
-        # webm converter #
-        ##################
-        workdir = None
+    def plan_encode(self, orig_metadata, codec_plan=None, threads=None, input_bytes=None):
+        """
+        encoder profile, threads and segmentation of a conversion and its predicted cost
+        without auto_tune the settings of the converter are kept and only the prediction is added
+
+        :param dict orig_metadata: dict of the source metadata
+        :param dict codec_plan: streams to copy instead of encode
+        :param int threads: cpu share of the execution, all the available cpus when None
+        :param int input_bytes: size of the source
+        :return: dict of profile, threads, segment_duration and prediction (encode_seconds, output_bytes or None)
+        """
+        threads = threads or video_utilities.available_cpus()
+        width = orig_metadata.get('width', None)
+        copy = codec_plan is not None and codec_plan['video'] == 'copy'
+
+        def predict(profile, plan_threads):
+            return self.cost_model.predict(width=width,
+                                           height=orig_metadata.get('height', None),
+                                           frames=video_utilities.frame_count(metadata=orig_metadata),
+                                           codec=orig_metadata.get('ffmpeg', dict()).get('codec_name', None),
+                                           profile=profile,
+                                           threads=plan_threads,
+                                           copy=copy,
+                                           input_bytes=input_bytes)
+
+        plan = {'profile': self.encoder_profile, 'threads': threads, 'segment_duration': self.segment_duration}
+        if self.auto_tune and self.method == ConversionMethod.FFMPEG and not copy:
+            # threads that do not speed up this frame width only add contention
+            plan['threads'] = cost_model.useful_threads(width=width, threads=threads)
+            # never slower than the configured profile, faster ones when its encode is over the budget
+            speed_order = [EncoderProfile.ARCHIVAL, EncoderProfile.BALANCED, EncoderProfile.REALTIME]
+            if self.encoder_profile in speed_order:
+                candidates = speed_order[speed_order.index(self.encoder_profile):]
+            else:
+                candidates = [self.encoder_profile, EncoderProfile.BALANCED, EncoderProfile.REALTIME]
+            duration = orig_metadata.get('duration', None)
+            for profile in candidates:
+                plan['profile'] = profile
+                prediction = predict(profile=profile, plan_threads=plan['threads'])
+                if not duration or prediction is None or \
+                        prediction['encode_seconds'] <= duration * AUTO_TUNE_SECONDS_PER_VIDEO_SECOND:
+                    break
+            # segments pay off on long encodes only, they use all the cpus
+            prediction = predict(profile=plan['profile'], plan_threads=threads)
+            if prediction is not None and prediction['encode_seconds'] > AUTO_SEGMENT_MIN_SECONDS:
+                plan['segment_duration'] = self.segment_duration or AUTO_SEGMENT_DURATION
+                plan['threads'] = threads
+            else:
+                plan['segment_duration'] = 0
+        plan['prediction'] = predict(profile=plan['profile'], plan_threads=plan['threads'])
+        return plan
+
+    def predict(self, item: dl.Item):
+        """
+        predicted cost of converting an item from its platform metadata, nothing is downloaded
+
+        :param dl.item item: the item object of the file
+        :return: dict of encode_seconds, output_bytes, profile, threads, segment_duration and heavy,
+                 None when the metadata is unknown
+        """
+        row = preflight_audit.item_row(item=item)
+        if np.isnan(row['frames']) and row['fps'] > 0 and row['duration'] > 0:
+            row['frames'] = row['duration'] * row['fps']
+        if np.isnan(row['frames']) or not (row['width'] > 0 and row['height'] > 0):
+            return None
+        orig_metadata = {'ffmpeg': item.metadata['system'].get('ffmpeg', None) or dict(),
+                         'width': row['width'],
+                         'height': row['height'],
+                         'duration': None if np.isnan(row['duration']) else row['duration'],
+                         'nb_read_frames': int(row['frames'])}
+        codec_plan = None
+        if self.method == ConversionMethod.FFMPEG:
+            # the audio codec is not in the platform metadata, only the video stream matters for the cost
+            codec_plan = video_utilities.select_codec_plan(video_codec=orig_metadata['ffmpeg'].get('codec_name', None),
+                                                           audio_codec=None)
+        plan = self.plan_encode(orig_metadata=orig_metadata,
+                                codec_plan=codec_plan,
+                                threads=self.resources.threads,
+                                input_bytes=None if np.isnan(row['size']) else row['size'])
+        if plan['prediction'] is None:
+            return None
+        prediction = dict(plan['prediction'])
+        prediction.update({'profile': plan['profile'],
+                           'threads': plan['threads'],
+                           'segment_duration': plan['segment_duration'],
+                           'heavy': prediction['encode_seconds'] > self.heavy_encode_seconds})
+        return prediction
+
+    def is_up_to_date(self, item: dl.Item):
+        """
+        check if the replace modality of the item is a webm of the current source converted with the current settings
+
+        :param dl.item item: the item object of the file
+        :return: True when there is nothing to convert
+        """
+        fingerprint = item.metadata['system'].get('webmFingerprint', None)
+        if fingerprint is None:
+            return False
+        webm_item_id = fingerprint.get('webmItemId', None)
+        linked = any(modality.get('type', None) == 'replace' and modality.get('ref', None) == webm_item_id
+                     for modality in item.metadata['system'].get('modalities', []))
+        if not linked:
+            return False
+        current = source_fingerprint(item=item,
+                                     method=self.method,
+                                     encoder_profile=self.profile_label,
+                                     keyframe_interval=self.keyframe_interval,
+                                     seek_index=self.seek_index)
+        return all(fingerprint.get(key, None) == value for key, value in current.items())
+
+    def _may_segment(self, item: dl.Item):
+        """
+        the encode of the item may be segmented, predicted from the platform metadata before the probe
+        """
+        if self.method != ConversionMethod.FFMPEG or self.renditions or self.thumbnail_strip:
+            # all the outputs come from a single decode of the source, never segmented
+            return False
+        video_duration = item.metadata['system'].get('duration', None)
+        segment_duration = self.segment_duration
+        if self.auto_tune:
+            # the segmentation the plan picks, from the platform metadata. unknown metadata may be segmented
+            prediction = self.predict(item=item)
+            segment_duration = prediction['segment_duration'] if prediction is not None else \
+                self.segment_duration or AUTO_SEGMENT_DURATION
+        return bool(segment_duration) and (video_duration is None or float(video_duration) > 2 * segment_duration)
+
+    def _source_reads(self, item: dl.Item):
+        """
+        times the conversion reads the whole source, predicted from the settings and the platform metadata
+        the stream input mode streams only the sources that are read once
+
+        :return: number of passes over the source
+        """
+        ffmpeg = item.metadata['system'].get('ffmpeg', None) or dict()
+        copy = self.method == ConversionMethod.FFMPEG and \
+            ffmpeg.get('codec_name', None) in video_utilities.WEB_VIDEO_CODECS
+        # the encode, or the remux of a copied stream
+        reads = 1
+        if 'nb_read_frames' not in ffmpeg:
+            # the probe counts the packets / frames of the source
+            reads += 1
+        if copy and self.keyframe_interval:
+            # the keyframes of the source are checked against the interval
+            reads += 1
+        if self.preview and not copy:
+            reads += 1
+        if self.verification == VerificationLevel.PACKETS:
+            # the packet timestamps of the source
+            reads += 1
+        if not copy and self._may_segment(item=item):
+            # the split and the mux of the source audio
+            reads += 1
+        return reads
+
+    def _estimate_disk_bytes(self, item: dl.Item):
+        return ResourceManager.estimate_disk_bytes(size=item.metadata['system'].get('size', None),
+                                                   downloaded=self.input_mode == InputMode.DOWNLOAD or
+                                                   self._source_reads(item=item) > 1,
+                                                   segmented=self._may_segment(item=item))
+
+    def _run_with_retries(self, item: dl.Item, allocation, progress=None, metrics=None, execution_id=None):
+        """
+        convert with retries in the scratch dir of the allocation, alert on failure
+
+        :param dl.item item: the item object of the file
+        :param Allocation allocation: the resources of the execution
+        :param progress: progress
+        :param ItemMetrics metrics: collects the stage timings, a new one when None
+        :param str execution_id: the current execution, in the failure alert
+        """
         success = False
         msg = ''
+        if metrics is None:
+            metrics = ItemMetrics(item_id=item.id)
+        # the errors of the tries and the fail flag are sent with the link update or the alert, not one by one
+        session = MetadataSession(item=item, metrics=metrics, alerts=self.alerts)
+        timeout_scale = 1
         try:
             for _ in range(NUM_RETRIES):
+                metrics.tries += 1
                 try:
-                    workdir = item.id
-                    os.makedirs(workdir, exist_ok=True)
-                    video_utilities.clean_item(item=item, service_name='WebmConverter')
-                    success, msg = self.webm_converter(item=item, workdir=workdir, progress=progress)
+                    # the workdir is kept between the tries, a retry resumes from the first failed stage
+                    session.clean(service_name='WebmConverter')
+                    success, msg = self.webm_converter(item=item,
+                                                       workdir=allocation.workdir,
+                                                       progress=progress,
+                                                       metrics=metrics,
+                                                       threads=allocation.threads,
+                                                       session=session,
+                                                       timeout_scale=timeout_scale)
                     if success:
                         break
                     else:
                         continue
+                except video_utilities.CommandCancelledError:
+                    raise
+                except video_utilities.CommandStalledError:
+                    # a stalled command would hang again, free the replica instead of retrying
+                    msg = traceback.format_exc()
+                    break
+                except video_utilities.CommandTimeoutError:
+                    # the prediction the budget came from was off, the next try gets twice the time
+                    msg = traceback.format_exc()
+                    timeout_scale *= 2
+                    continue
                 except Exception:
                     msg = traceback.format_exc()
                     continue
@@ -395,11 +1999,253 @@ class WebmConverter(dl.BaseServiceRunner):
             if not success:
                 raise Exception(msg)
 
+        except video_utilities.CommandCancelledError:
+            # an aborted execution is not a conversion failure, nothing is flagged or alerted
+            logger.info('[webm-converter][{}] cancelled'.format(item.id))
+            raise
         except Exception as e:
             if 'Invalid data found when processing input' in str(e):
                 e = "Failed to convert to webm because the downloaded file is corrupted."
-            self.mail_handler.send_alert(item=item, msg=str(e))
+            try:
+                session.fail(service_name=self.mail_handler.service_name, msg=str(e))
+                session.flush()
+            except Exception:
+                logger.exception('[webm-converter][{}] failed to flag the item'.format(item.id))
+            self.alerts.add_failure(item=item, msg=str(e), execution_id=execution_id)
             raise ValueError('[webm-converter] failed\n error: {}'.format(e))
         finally:
-            if workdir is not None and os.path.isdir(workdir):
-                shutil.rmtree(workdir)
+            metrics.success = success
+            self.metrics_exporter.export(metrics=metrics)
+
+    def run(self, item: dl.Item, progress=None, context=None):
+        ##################
+        # webm converter #
+        ##################
+        # the trigger fires on every update of the item, including our own metadata updates
+        if self.is_up_to_date(item=item):
+            logger.info('[webm-converter][{}] webm is up to date, skipping'.format(item.id))
+            return
+        if self.heavy_service_name is not None and self._forward_heavy(item=item, context=context):
+            return
+        self._convert(item=item, progress=progress, context=context)
+
+    async def run_async(self, item: dl.Item, progress=None, context=None):
+        """
+        run() on the event loop of the caller, one process drives many items with asyncio.gather
+        the commands of the stages run on the loop and the platform calls outside of it. cancelling the task kills
+        the running command, the item is left as it was for the next execution
+
+        :param dl.item item: the item object of the file
+        :param progress: progress
+        :param context: the execution context
+        """
+        if self.is_up_to_date(item=item):
+            logger.info('[webm-converter][{}] webm is up to date, skipping'.format(item.id))
+            return
+        if self.heavy_service_name is not None and await self.engine.sdk(self._forward_heavy, item=item, context=context):
+            return
+        await self.engine.run_pipeline(self._convert, item=item, progress=progress, context=context)
+
+    def _forward_heavy(self, item: dl.Item, context=None):
+        """
+        execute the heavy service on an item predicted heavy, never the service running this execution
+
+        :param dl.item item: the item object of the file
+        :param context: the execution context, its service name is compared with heavy_service_name
+        :return: True when the item was forwarded
+        """
+        service_name = getattr(context, 'service_name', None)
+        if service_name is not None and service_name.lower() == self.heavy_service_name.lower():
+            # the heavy service itself, or a deployment with its own name as heavy service - convert here
+            return False
+        prediction = self.predict(item=item)
+        if prediction is None or not prediction['heavy']:
+            return False
+        # too long for this pod, the heavy service converts it with the same settings
+        logger.info('[webm-converter][{}] predicted encode of {:.0f}[s], forwarding to service {}'.format(
+            item.id, prediction['encode_seconds'], self.heavy_service_name))
+        dl.services.get(service_name=self.heavy_service_name).execute(item_id=item.id,
+                                                                      function_name='run',
+                                                                      project_id=item.project_id)
+        return True
+
+    def _convert(self, item: dl.Item, progress=None, context=None):
+        # waits for disk when the concurrent executions already reserved the budget
+        with self.resources.acquire(name=item.id, disk_bytes=self._estimate_disk_bytes(item=item)) as allocation:
+            self._run_with_retries(item=item,
+                                   allocation=allocation,
+                                   progress=progress,
+                                   execution_id=getattr(context, 'execution_id', None))
+
+    def audit(self, dataset: dl.Dataset, query=None):
+        """
+        pre-flight audit of the video items of a dataset from their platform metadata, nothing is converted
+        lists the items that will fail or mismatch the frame count and the total conversion cost
+
+        :param dl.Dataset dataset: the dataset
+        :param dict query: dl.Filters custom filter, the items of the service trigger when None
+        :return: dict report, see preflight_audit.audit_rows
+        """
+        return preflight_audit.audit_dataset(dataset=dataset, query=query)
+
+    def _batch_prepare(self, item: dl.Item, allocation):
+        """
+        prepare a batch item, runs in the download threads with the resources reserved by run_batch
+
+        :return: the job
+        """
+        job = ConversionJob(item=item, workdir=allocation.workdir, threads=allocation.threads)
+        job.session.alerts = self.alerts
+        job.allocation = allocation
+        try:
+            job.session.clean(service_name='WebmConverter')
+            job.metrics.tries = 1
+            self._prepare_job(job=job)
+            if not job.valid:
+                raise ValueError(job.msg)
+        except Exception as e:
+            raise BatchJobError(job=job) from e
+        return job
+
+    def _batch_publish(self, job):
+        """
+        publish a batch item, runs in the upload threads
+        """
+        try:
+            self._publish_job(job=job)
+        except Exception as e:
+            # run_batch may be waiting for this disk, the scratch dir is kept for the retry
+            job.allocation.release(keep_workdir=True)
+            raise BatchJobError(job=job) from e
+        job.metrics.success = True
+        self.metrics_exporter.export(metrics=job.metrics)
+        job.allocation.release()
+
+    def run_batch(self,
+                  items=None,
+                  dataset: dl.Dataset = None,
+                  query=None,
+                  progress=None,
+                  prefetch=BATCH_PREFETCH,
+                  upload_queue=BATCH_UPLOAD_QUEUE,
+                  context=None):
+        """
+        convert many items, shortest job first. the next items are downloaded and probed while the current one is
+        encoded, and the encoded ones are uploaded in the background. an item failing on the way is converted
+        again with run() after the batch, which resumes from its finished stages
+
+        :param list items: the items to convert
+        :param dl.Dataset dataset: dataset to query the items from, when items is None
+        :param dict query: dl.Filters custom filter of the dataset query, the items of the service trigger when None
+        :param dl.Progress progress: progress object to follow the work progress
+        :param int prefetch: number of items downloaded ahead of the encoder
+        :param int upload_queue: number of encoded items waiting for upload before the encoder waits
+        :param dl.Context context: the execution context, its id is in the failure alerts
+        :return: dict of the succeeded, skipped and failed item ids
+        """
+        if items is None:
+            # the items of the trigger, not the webm outputs of the converter
+            filters = dl.Filters(custom_filter=query if query is not None else video_utilities.trigger_query())
+            items = [item for page in dataset.items.list(filters=filters) for item in page]
+        items = sorted(items, key=conversion_cost)
+        logger.info('[webm-converter] batch of {} items'.format(len(items)))
+
+        results = {'succeeded': list(), 'skipped': list(), 'failed': dict()}
+        retry_items = list()
+        finished = 0
+
+        def item_done():
+            nonlocal finished
+            finished += 1
+            if progress is not None:
+                progress.update(progress=int(100 * finished / max(1, len(items))))
+
+        def batch_failed(item, error):
+            logger.error('[webm-converter][{}] batch conversion failed: {}'.format(item.id, error.__cause__ or error))
+            job = error.job if isinstance(error, BatchJobError) else None
+            if job is not None:
+                # the scratch dir is kept for the retry, only the reservation is given back
+                job.allocation.release(keep_workdir=True)
+            retry_items.append((item, job))
+
+        def wait_upload(uploading):
+            item, future = uploading
+            try:
+                future.result()
+                results['succeeded'].append(item.id)
+                item_done()
+            except Exception as e:
+                batch_failed(item=item, error=e)
+
+        pending = deque(items)
+        downloads = deque()
+        uploads = deque()
+        with ThreadPoolExecutor(max_workers=max(1, prefetch)) as download_pool, \
+                ThreadPoolExecutor(max_workers=max(1, upload_queue)) as upload_pool:
+            def fill_downloads(block):
+                """
+                reserve the resources in the order of the batch, a later item never takes the disk an earlier one
+                waits for. only blocks when the main thread holds nothing, the uploads give the disk back
+                """
+                while pending and len(downloads) < max(1, prefetch):
+                    item = pending[0]
+                    if self.is_up_to_date(item=item):
+                        logger.info('[webm-converter][{}] webm is up to date, skipping'.format(item.id))
+                        pending.popleft()
+                        results['skipped'].append(item.id)
+                        item_done()
+                        continue
+                    try:
+                        allocation = self.resources.acquire(name=item.id,
+                                                            disk_bytes=self._estimate_disk_bytes(item=item),
+                                                            timeout=None if block and not downloads else 0)
+                    except TimeoutError:
+                        # the prefetched items are converted first, the disk frees up as they are uploaded
+                        return
+                    pending.popleft()
+                    downloads.append((item, download_pool.submit(self._batch_prepare, item, allocation)))
+
+            while True:
+                fill_downloads(block=True)
+                if not downloads:
+                    break
+                item, future = downloads.popleft()
+                fill_downloads(block=False)
+                try:
+                    job = future.result()
+                    # the encoder runs here, one item at a time with the cpu share of the execution
+                    try:
+                        self._convert_job(job=job)
+                    except Exception as e:
+                        raise BatchJobError(job=job) from e
+                except Exception as e:
+                    batch_failed(item=item, error=e)
+                    continue
+                while len(uploads) >= max(1, upload_queue):
+                    wait_upload(uploads.popleft())
+                uploads.append((item, upload_pool.submit(self._batch_publish, job)))
+            while uploads:
+                wait_upload(uploads.popleft())
+
+        for item, job in retry_items:
+            try:
+                if job is None:
+                    self.run(item=item, context=context)
+                else:
+                    # resume in the scratch dir of the failed job
+                    allocation = self.resources.acquire(name=item.id,
+                                                        disk_bytes=self._estimate_disk_bytes(item=item),
+                                                        workdir=job.workdir)
+                    with allocation:
+                        self._run_with_retries(item=item,
+                                               allocation=allocation,
+                                               execution_id=getattr(context, 'execution_id', None))
+                results['succeeded'].append(item.id)
+            except Exception as e:
+                results['failed'][item.id] = str(e)
+            item_done()
+        # the batch closes the alert windows, one digest per dataset and creator
+        self.alerts.flush()
+        logger.info('[webm-converter] batch done: {} succeeded, {} skipped, {} failed'.format(
+            len(results['succeeded']), len(results['skipped']), len(results['failed'])))
+        return results